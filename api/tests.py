@@ -3,6 +3,66 @@ from rest_framework.test import APIClient
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 
+
+def create_textbook(title, subject='Science', grade='9', **fields):
+    """A textbook filed under the named subject and grade, created as needed"""
+    from knowledge_base.models import Subject, Grade, TextbookContent
+    return TextbookContent.objects.create(
+        title=title, subject=Subject.objects.get_or_create(name=subject)[0],
+        grade=Grade.objects.get_or_create(level=grade)[0],
+        file=f"textbooks/{title.lower().replace(' ', '_')}.txt", **fields
+    )
+
+
+def create_chunks(textbook, texts, embeddings):
+    """Stored chunks of a textbook, numbered in order"""
+    from knowledge_base.models import ContentChunk
+    return [
+        ContentChunk.objects.create(
+            textbook=textbook, chunk_text=text, chunk_index=index,
+            start_char=0, end_char=len(text), embedding_vector=embedding
+        )
+        for index, (text, embedding) in enumerate(zip(texts, embeddings))
+    ]
+
+
+def unit_vector(axis, dimension=768):
+    embedding = [0.0] * dimension
+    embedding[axis] = 1.0
+    return embedding
+
+
+def random_embeddings(count, seed=0, dimension=768):
+    """Unit vectors in random directions, as float lists ready to store on chunks"""
+    import numpy as np
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension)).astype(np.float32)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).tolist()
+
+
+@pytest.fixture
+def snapshot_dir(settings, tmp_path):
+    """Empty snapshot store for the unsharded index, with no driver cached by other tests"""
+    from protocol.cache_namespace import index_cache
+    settings.FAISS_SHARD_COUNT = 1
+    settings.FAISS_SNAPSHOT_DIR = str(tmp_path)
+    index_cache.invalidate()
+    yield str(tmp_path)
+    index_cache.invalidate()
+
+
+@pytest.fixture
+def embedded_texts(monkeypatch):
+    """Texts the local provider is asked to embed during the test"""
+    from protocol import llm_client
+    texts = []
+    original = llm_client.LocalLLMClient.generate_batch_embeddings
+    def counting(client, batch):
+        texts.extend(batch)
+        return original(client, batch)
+    monkeypatch.setattr(llm_client.LocalLLMClient, 'generate_batch_embeddings', counting)
+    return texts
+
+
 @pytest.mark.django_db
 class TestAPIEndpoints:
     def setup_method(self):
@@ -61,4 +121,763 @@ class TestAPIEndpoints:
     def test_analytics_endpoint(self):
         url = reverse('analytics')
         response = self.client.get(url)
-        assert response.status_code == 200 
\ No newline at end of file
+        assert response.status_code == 200 
+
+    def test_liveness_endpoint(self):
+        url = reverse('health-live')
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert response.data['status'] == 'alive'
+        assert 'state' in response.data['pipeline']
+
+    def test_readiness_endpoint(self):
+        url = reverse('health-ready')
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert response.data['pipeline']['state'] == 'ready'
+        assert response.data['pipeline']['index_version'] is not None
+        assert response.data['pipeline']['load_time_ms'] is not None
+
+    def test_ask_after_cache_clear(self):
+        from django.core.cache import cache
+        cache.clear()
+        url = reverse('ask-question')
+        response = self.client.post(url, {"question": "What is photosynthesis?", "type": "rag"}, format='json')
+        assert response.status_code != 503
+
+    def test_textbook_delete_only_invalidates_index_cache(self):
+        from django.core.cache import cache
+        from protocol.cache_namespace import index_cache, embedding_cache
+        cache.set('unrelated_key', 'kept', timeout=60)
+        embedding_cache.set('probe', [0.1, 0.2])
+        index_version = index_cache.version()
+        index_cache.set('probe', 'old index')
+        stale_key = index_cache.make_key('probe')
+        textbook = create_textbook('Algebra', subject='Math', content_text='Linear equations.')
+        response = self.client.delete(reverse('textbookcontent-detail', args=[textbook.id]))
+        assert response.status_code == 204
+        assert cache.get('unrelated_key') == 'kept'
+        assert embedding_cache.get('probe') == [0.1, 0.2]
+        assert index_cache.version() != index_version
+        # The old version's entries are deleted, not left to pile up in the cache
+        assert cache.get(stale_key) is None
+
+    def test_subject_delete_schedules_index_update_for_its_textbooks(self, monkeypatch):
+        from knowledge_base.models import TextbookContent
+        import api.views
+        textbook = create_textbook('Ancient Rome', subject='History', grade='6', content_text='The Republic.')
+        scheduled = []
+        monkeypatch.setattr(api.views, 'schedule_index_update', scheduled.append)
+        response = self.client.delete(reverse('manage-data'), {'type': 'subject', 'id': textbook.subject_id}, format='json')
+        assert response.status_code == 200
+        assert not TextbookContent.objects.filter(id=textbook.id).exists()
+        # The cascaded textbook's vectors are dropped by the index writer like a direct delete
+        assert scheduled == [textbook.id]
+
+    def test_ask_rag_reranks_candidates_and_reports_timings_to_staff(self, settings):
+        settings.DEBUG = False
+        textbook = create_textbook('Biology', grade='7', content_text='Plants.', processing_status='completed', chunk_count=8)
+        texts = [
+            'Photosynthesis turns light into sugar.' if index == 6 else f'Cells and tissues, part {index}.'
+            for index in range(8)
+        ]
+        create_chunks(textbook, texts, [unit_vector(0)] * 8)
+        response = self.client.post(reverse('ask-question'), {"question": "What is photosynthesis?", "type": "rag"}, format='json')
+        assert response.status_code == 200
+        assert response.data['context_chunks'] == 5
+        assert response.data['sources'][0]['chunk_index'] == 6
+        # Stage timings, SQL counts and provider errors are internals, kept from anonymous clients
+        assert not {'timings', 'sql', 'generation_error'} & set(response.data)
+
+        self.client.force_authenticate(get_user_model().objects.create_user('staff', is_staff=True))
+        response = self.client.post(reverse('ask-question'), {"question": "What is photosynthesis?", "type": "rag"}, format='json')
+        assert {'retrieve_ms', 'rerank_ms', 'generate_ms', 'total_ms'} <= set(response.data['timings'])
+
+    def test_cross_encoder_is_loaded_at_pipeline_load_not_in_the_scoring_timeout(self, settings, monkeypatch):
+        import sys
+        import time
+        import types
+        from context import reranker
+        from context.bootstrap import pipeline_bootstrap
+
+        class SlowLoadingCrossEncoder:
+            loads = 0
+
+            def __init__(self, model_name, device=None):
+                time.sleep(0.4)
+                SlowLoadingCrossEncoder.loads += 1
+
+            def predict(self, pairs):
+                return [len(text) for _, text in pairs]
+
+        monkeypatch.setitem(sys.modules, 'sentence_transformers', types.SimpleNamespace(CrossEncoder=SlowLoadingCrossEncoder))
+        monkeypatch.setattr(reranker, '_reranker', None)
+        monkeypatch.setattr(reranker.CrossEncoderReranker, '_models', {})
+        settings.RAG_RERANKER = 'cross_encoder'
+        settings.RAG_RERANK_TIMEOUT_MS = 250
+
+        pipeline_bootstrap._warm_reranker()
+        assert SlowLoadingCrossEncoder.loads == 1
+        candidates = [{'id': str(n), 'score': 0.5, 'metadata': {}, 'text': 'x' * n} for n in (1, 3, 2)]
+        ranked = reranker.get_reranker().rerank('question', candidates, top_n=2)
+        # Scored by the model, not left in vector order by a timeout
+        assert [hit['id'] for hit in ranked] == ['3', '2']
+        assert SlowLoadingCrossEncoder.loads == 1
+
+    def test_ask_rag_skips_near_duplicate_chunks(self, settings):
+        from protocol.faiss_shards import get_faiss_driver
+        textbook = create_textbook('Chemistry', grade='8', content_text='Atoms.', processing_status='completed')
+        # Chunks 0-4 share one embedding (overlapping text), chunks 5-8 each point elsewhere
+        create_chunks(
+            textbook, [f'Atoms and molecules, part {index}.' for index in range(9)],
+            [unit_vector(max(0, index - 4)) for index in range(9)]
+        )
+        settings.RAG_INDEX_CHECK_INTERVAL = 0
+        get_faiss_driver().rebuild_index()
+        response = self.client.post(reverse('ask-question'), {"question": "What is an atom?", "type": "rag"}, format='json')
+        assert response.status_code == 200
+        chunk_indexes = [source['chunk_index'] for source in response.data['sources']]
+        assert len(chunk_indexes) == 5
+        assert len([index for index in chunk_indexes if index < 5]) == 1
+
+    def test_ask_rag_expands_hits_with_neighbouring_chunks(self, settings, django_assert_num_queries):
+        from protocol.faiss_shards import get_faiss_driver
+        textbook = create_textbook('Physics', content_text='Forces.', processing_status='completed')
+        chunks = create_chunks(
+            textbook, [f'Forces and motion, part {index}.' for index in range(8)], [unit_vector(index) for index in range(8)]
+        )
+        settings.RAG_INDEX_CHECK_INTERVAL = 0
+        settings.DEBUG = True
+        get_faiss_driver().rebuild_index()
+
+        driver = get_faiss_driver()
+        with django_assert_num_queries(0):
+            hits = driver.search(chunks[5].embedding_vector, top_k=1, neighbor_window=2)
+        assert hits[0]['text'] == 'Forces and motion, part 5.'
+        assert [neighbor['id'] for neighbor in hits[0]['neighbors']] == [str(chunk.id) for chunk in chunks[3:8]]
+        assert hits[0]['neighbors'][0]['text'] == 'Forces and motion, part 3.'
+
+        response = self.client.post(reverse('ask-question'), {"question": "What is a force?", "type": "rag", "context_window": 1}, format='json')
+        assert response.status_code == 200
+        assert 'expand_ms' in response.data['timings']
+        response = self.client.post(reverse('ask-question'), {"question": "What is a force?", "type": "rag", "context_window": -1}, format='json')
+        assert response.status_code == 400
+
+    def test_ask_rag_stays_within_sql_budget(self, settings, django_assert_max_num_queries):
+        from knowledge_base.models import QueryLog
+        from protocol.faiss_shards import get_faiss_driver
+        textbook = create_textbook(
+            'Geography', subject='Social Studies', grade='6', content_text='Rivers.', processing_status='completed'
+        )
+        create_chunks(
+            textbook, [f'Rivers and valleys, part {index}.' for index in range(6)], [unit_vector(index) for index in range(6)]
+        )
+        settings.RAG_INDEX_CHECK_INTERVAL = 0
+        settings.DEBUG = True
+        get_faiss_driver().rebuild_index()
+        self.client.post(reverse('ask-question'), {"question": "Warm up", "type": "rag"}, format='json')
+
+        with django_assert_max_num_queries(settings.RAG_SQL_BUDGET):
+            response = self.client.post(
+                reverse('ask-question'), {"question": "How do rivers form?", "type": "rag", "context_window": 1},
+                format='json', HTTP_USER_AGENT='pytest'
+            )
+        assert response.status_code == 200
+        assert response.data['sql']['total'] <= settings.RAG_SQL_BUDGET
+        query_log = QueryLog.objects.get(id=response.data['query_log_id'])
+        assert query_log.user_agent == 'pytest'
+        assert query_log.retrieved_chunks.count() == response.data['context_chunks']
+
+    def test_textbook_list_query_count_is_independent_of_corpus_size(self, django_assert_max_num_queries):
+        from knowledge_base.corpus import corpus_stats, invalidate_corpus_stats
+        for index in range(5):
+            create_textbook(
+                f'History {index}', subject='History', grade='10',
+                content_text='Empires.', processing_status='completed', chunk_count=index
+            )
+        # Page count plus the page itself, with subject and grade joined in
+        with django_assert_max_num_queries(2):
+            response = self.client.get(reverse('textbookcontent-list'))
+        assert response.status_code == 200
+        assert sorted(textbook['chunks_count'] for textbook in response.data['results']) == [0, 1, 2, 3, 4]
+
+        invalidate_corpus_stats()
+        stats = corpus_stats()
+        assert stats['total_chunks'] == 10
+        assert stats['by_grade'] == [{'grade': '10', 'textbooks': 5, 'chunks': 10}]
+
+    def test_analytics_reads_incrementally_maintained_rollups(self, django_assert_max_num_queries):
+        from datetime import timedelta
+        from django.utils import timezone
+        from knowledge_base.models import QueryLog, QueryRollup
+        from knowledge_base.tasks import rollup_query_analytics
+        two_days_ago = timezone.now() - timedelta(days=2)
+        for persona, latency, rating in [('socratic', 120, 4), ('socratic', 800, None), ('helpful_tutor', 40, 2)]:
+            QueryLog.objects.create(
+                query_text='q', response_text='a', persona_used=persona, subject_filter='Science',
+                response_time_ms=latency, rating=rating, context_chunks_count=1
+            )
+        QueryLog.objects.filter(persona_used='socratic').update(created_at=two_days_ago)
+
+        rollup_query_analytics()
+        QueryLog.objects.create(query_text='q', response_text='a', response_time_ms=60)
+        rollup_query_analytics()
+        assert QueryRollup.objects.filter(granularity='day').count() == 3
+
+        # The log itself is never read
+        with django_assert_max_num_queries(5):
+            response = self.client.get(reverse('analytics'))
+        assert response.status_code == 200
+        assert response.data['total_queries'] == 4
+        assert response.data['avg_response_time'] == 255
+        assert response.data['avg_rating'] == 3
+        assert response.data['top_personas'][0] == {'persona_used': 'socratic', 'count': 2}
+        assert response.data['top_subjects'] == [{'subject_filter': 'Science', 'count': 3}]
+        assert len(response.data['daily_queries']) == 2
+        assert sum(response.data['latency_histogram']['counts']) == 4
+
+        response = self.client.get(reverse('session-stats'))
+        assert response.data['total_questions'] == 2
+        assert response.data['total_sources'] == 1
+
+    def test_stage_latency_percentiles_exported_and_flushed(self, settings):
+        from knowledge_base.models import SystemMetrics
+        from context.instrumentation import LatencyHistogram, metrics_flusher
+        from protocol.faiss_shards import get_faiss_driver
+        settings.RAG_METRICS_FLUSH_INTERVAL = 0
+        settings.RAG_INDEX_CHECK_INTERVAL = 0
+        get_faiss_driver().rebuild_index()
+        histogram = LatencyHistogram()
+        for ms in range(1, 1001):
+            histogram.record(ms)
+        assert abs(histogram.percentile(0.99) - 990) < 990 * 0.02
+
+        self.client.post(reverse('ask-question'), {"question": "What is photosynthesis?", "type": "rag"}, format='json')
+        response = self.client.get(reverse('metrics-prometheus'))
+        assert response.status_code == 200
+        body = response.content.decode()
+        assert '# TYPE rag_stage_latency_ms summary' in body
+        assert 'rag_stage_latency_ms{stage="total",quantile="0.95"}' in body
+
+        assert metrics_flusher.flush() > 0
+        assert SystemMetrics.objects.filter(metric_name='rag_stage_latency_p99', tags__stage='total').exists()
+
+    def test_ask_emits_trace_events_only_for_sampled_requests(self, settings, caplog):
+        caplog.set_level('DEBUG', logger='rag_tutor.trace')
+        settings.RAG_TRACE_SAMPLE_RATE = 0.0
+        response = self.client.post(
+            reverse('ask-question'), {"question": "What is gravity?", "type": "rag"},
+            format='json', HTTP_X_TRACE_ID='trace-abc'
+        )
+        assert response['X-Trace-Id'] == 'trace-abc'
+        assert not [record for record in caplog.records if record.name == 'rag_tutor.trace']
+
+        settings.RAG_TRACE_SAMPLE_RATE = 1.0
+        self.client.post(reverse('ask-question'), {"question": "What is gravity?", "type": "rag"}, format='json')
+        events = [record.getMessage() for record in caplog.records if record.name == 'rag_tutor.trace']
+        assert any(event.startswith('ask.request {') for event in events)
+
+    def test_local_backend_gives_meaningful_deterministic_embeddings(self, settings):
+        import numpy as np
+        from protocol.llm_client import LLMClient
+        settings.LLM_BACKEND = 'local'
+        client = LLMClient()
+        query = np.array(client.generate_embedding('How do plants make food from sunlight?'))
+        related = np.array(client.generate_embedding('Plants make their food using sunlight in photosynthesis.'))
+        unrelated = np.array(client.generate_embedding('The French Revolution began in 1789.'))
+        assert len(query) == settings.EMBEDDING_DIMENSION
+        assert query @ related > query @ unrelated
+        assert client.generate_embedding('How do plants make food from sunlight?') == query.tolist()
+
+        prompt = "Context from textbooks:\nChlorophyll absorbs light.\n\nStudent Question: What absorbs light?\n\nAnswer:"
+        answer = client.generate_chat_response(prompt)
+        assert 'Chlorophyll absorbs light.' in answer
+        assert ''.join(client.stream_chat_response(prompt)) == answer
+
+    def test_llm_client_routes_to_registered_provider_sync_and_async(self, settings):
+        import asyncio
+        from knowledge_base.models import EmbeddingModel
+        from protocol.llm_client import LLMClient, refresh_providers
+        settings.LLM_BACKEND = 'gemini'
+        settings.GEMINI_API_KEY = ''
+        settings.LLM_EMBED_BATCH_SIZE = 2
+        client = LLMClient()
+        texts = ['Rivers carve valleys.', 'Glaciers move slowly.', 'Volcanoes erupt lava.']
+        try:
+            # Without a key the Gemini provider degrades to zero vectors
+            assert not any(client.generate_embedding(texts[0]))
+
+            EmbeddingModel.objects.create(
+                name='offline', provider='local', model_id='hashing', vector_dimension=settings.EMBEDDING_DIMENSION
+            )
+            embeddings = [client.generate_embedding(text) for text in texts]
+            assert all(any(embedding) for embedding in embeddings)
+            assert client.generate_batch_embeddings(texts) == embeddings
+
+            async def gather():
+                return await asyncio.gather(*(client.agenerate_embedding(text) for text in texts))
+            assert asyncio.run(gather()) == embeddings
+
+            # A chat-only provider registered for embeddings is refused, not called until its circuit opens
+            EmbeddingModel.objects.create(
+                name='claude-embed', provider='claude', model_id='', vector_dimension=settings.EMBEDDING_DIMENSION
+            )
+            assert client.generate_embedding(texts[0]) == embeddings[0]
+        finally:
+            refresh_providers()
+
+    def test_chat_falls_back_to_hedge_provider_and_counts_it(self, settings):
+        from knowledge_base.models import EmbeddingModel, SystemMetrics
+        from context.instrumentation import hedge_stats, metrics_flusher, prometheus_text
+        from protocol.llm_client import LLMClient, LLMError, refresh_providers
+        settings.LLM_BACKEND = 'gemini'
+        settings.GEMINI_API_KEY = ''
+        client = LLMClient()
+        prompt = "Context from textbooks:\nMagma cools into igneous rock.\n\nStudent Question: How does igneous rock form?\n\nAnswer:"
+        try:
+            # An unconfigured provider is an error now, not a canned apology
+            with pytest.raises(LLMError):
+                client.generate_chat_response(prompt)
+
+            EmbeddingModel.objects.create(
+                name='offline-fallback', provider='local', model_id='', purpose='chat_fallback', vector_dimension=0
+            )
+            before = hedge_stats.snapshot()
+            tutor_before = hedge_stats.by_persona().get('helpful_tutor', dict.fromkeys(hedge_stats.OUTCOMES, 0))
+            answer = client.generate_chat_response(prompt, persona='helpful_tutor')
+            after = hedge_stats.snapshot()
+            assert 'Magma cools into igneous rock.' in answer
+            assert after['fallback'] == before['fallback'] + 1
+            assert after['hedge_won'] == before['hedge_won'] + 1
+            # Broken down by the persona whose deadline applied
+            assert hedge_stats.by_persona()['helpful_tutor']['fallback'] == tutor_before['fallback'] + 1
+            assert 'rag_llm_chat_total{persona="helpful_tutor",outcome="fallback"}' in prometheus_text()
+            metrics_flusher.flush()
+            assert SystemMetrics.objects.filter(metric_name='rag_llm_hedge_rate', tags__persona='helpful_tutor').exists()
+        finally:
+            refresh_providers()
+
+    def test_losing_hedged_request_is_cancelled_and_frees_its_slot(self, settings, monkeypatch):
+        import threading
+        import time
+        from protocol import llm_client
+
+        class SlowProvider:
+            def __init__(self):
+                self.pieces, self.closed = 0, threading.Event()
+
+            def stream_chat_response(self, *args):
+                try:
+                    for _ in range(100):
+                        time.sleep(0.1)
+                        self.pieces += 1
+                        yield 'slow '
+                finally:
+                    self.closed.set()
+
+        class FastProvider:
+            def stream_chat_response(self, *args):
+                yield 'fast answer'
+
+        slow = SlowProvider()
+        providers = {'chat': slow, 'chat_fallback': FastProvider()}
+        settings.LLM_HEDGE_ENABLED = True
+        settings.LLM_HEDGE_DEADLINES_MS = {'default': 20}
+        monkeypatch.setattr(llm_client, '_guards', {})
+        monkeypatch.setattr(llm_client, 'resolve_provider', lambda purpose: ('local', purpose))
+        monkeypatch.setattr(llm_client, 'get_provider_client', lambda provider, purpose: providers[purpose])
+
+        assert llm_client.LLMClient().generate_chat_response('Why is the sky blue?') == 'fast answer'
+        # The primary stops at its next piece instead of streaming all 100
+        assert slow.closed.wait(2)
+        assert slow.pieces == 1
+        for _ in range(100):
+            if llm_client.guard_states()[('local', 'chat')]['in_flight'] == 0:
+                break
+            time.sleep(0.01)
+        assert llm_client.guard_states()[('local', 'chat')]['in_flight'] == 0
+
+    def test_unknown_persona_is_answered_but_never_becomes_a_metric_series(self):
+        from context.instrumentation import stage_latencies
+        from protocol.llm_client import first_token_stage, hedge_deadline_ms
+        persona = 'x"} 1\nevil'
+        for query_type in ('rag', 'sql'):
+            response = self.client.post(
+                reverse('ask-question'), {"question": "What is an atom?", "type": query_type, "persona": persona}, format='json'
+            )
+            assert response.status_code == 200
+        assert not any(persona in stage for stage in stage_latencies.snapshot())
+        assert first_token_stage('socratic_tutor') == 'llm_first_token.socratic_tutor'
+        assert first_token_stage('persona-4711') == first_token_stage(None) == 'llm_first_token'
+        assert hedge_deadline_ms('persona-4711') == hedge_deadline_ms(None)
+
+    def test_prometheus_label_values_are_escaped(self):
+        from context.instrumentation import prometheus_labels
+        assert prometheus_labels(stage='retrieve', quantile=0.5) == '{stage="retrieve",quantile="0.5"}'
+        # A crafted value cannot close the label set and start a metric line of its own
+        assert prometheus_labels(queue='x"} 1\nfake_metric{a="\\') == '{queue="x\\"} 1\\nfake_metric{a=\\"\\\\"}'
+
+    def test_failing_embedding_provider_opens_circuit_and_returns_503(self, settings, monkeypatch):
+        from protocol import llm_client
+        from protocol.faiss_shards import get_faiss_driver
+        textbook = create_textbook('Chemistry', grade='10', content_text='Atoms.', processing_status='completed')
+        create_chunks(textbook, ['Atoms bond.'], [unit_vector(0)])
+        settings.RAG_INDEX_CHECK_INTERVAL = 0
+        get_faiss_driver().rebuild_index()
+
+        calls = []
+        def timing_out(client, text):
+            calls.append(text)
+            raise llm_client.LLMError('embedding request timed out')
+        settings.LLM_BACKEND = 'local'
+        settings.LLM_BREAKER_FAILURES = 2
+        monkeypatch.setattr(llm_client.LocalLLMClient, 'generate_embedding', timing_out)
+        monkeypatch.setattr(llm_client, '_guards', {})
+
+        for _ in range(2):
+            response = self.client.post(reverse('ask-question'), {"question": "What is an atom?", "type": "rag"}, format='json')
+            assert response.status_code == 500
+        response = self.client.post(reverse('ask-question'), {"question": "What is an atom?", "type": "rag"}, format='json')
+        assert response.status_code == 503
+        assert int(response['Retry-After']) >= 1
+        assert len(calls) == 2
+        assert 'rag_llm_circuit_open{provider="local",endpoint="embed"} 1' in self.client.get(reverse('metrics-prometheus')).content.decode()
+
+    def test_ingestion_embeds_in_resumable_chord_batches(self, settings):
+        from knowledge_base.models import TextbookContent, ContentChunk
+        from django.core.cache import cache
+        from knowledge_base.tasks import process_textbook_content, apply_index_updates
+        cache.delete('rag_tutor:index_writer:scheduled')
+        settings.LLM_BACKEND = 'local'
+        settings.CHUNK_SIZE = 60
+        settings.CHUNK_OVERLAP = 0
+        settings.INGEST_EMBED_BATCH_SIZE = 2
+        text = ' '.join(f"Sentence {i} is about cell biology and the nucleus." for i in range(10))
+        textbook = create_textbook('Biology', content_text=text)
+
+        process_textbook_content.delay(str(textbook.id))
+        textbook.refresh_from_db()
+        chunks = ContentChunk.objects.filter(textbook=textbook)
+        assert textbook.processing_status == 'completed' and textbook.processing_stage == 'done'
+        assert textbook.chunk_count == chunks.count() >= 5
+        assert textbook.embed_batches_total == textbook.embed_batches_done == (textbook.chunk_count + 1) // 2
+        assert not chunks.filter(embedding_status='pending').exists()
+
+        # A crash after the first batches: resuming keeps the chunks and embeds only what is missing
+        chunk_ids = set(chunks.values_list('id', flat=True))
+        unfinished = list(chunks.order_by('chunk_index').values_list('id', flat=True))[-3:]
+        ContentChunk.objects.filter(id__in=unfinished).update(embedding_vector=None, embedding_status='pending')
+        TextbookContent.objects.filter(id=textbook.id).update(
+            processing_stage='embed', processing_status='processing', embed_batches_done=1
+        )
+        process_textbook_content.delay(str(textbook.id))
+        textbook.refresh_from_db()
+        assert set(chunks.values_list('id', flat=True)) == chunk_ids
+        # Embedded and searchable once the index writer's coalesced run picks it up
+        assert textbook.processing_stage == 'index'
+        apply_index_updates()
+        textbook.refresh_from_db()
+        assert textbook.processing_stage == 'done'
+        assert textbook.embed_batches_total == textbook.embed_batches_done == 3
+        assert set(chunks.values_list('embedding_status', flat=True)) == {'indexed'}
+
+    def test_zero_embeddings_stay_pending_and_resume_ingestion_embeds_only_them(self, settings, embedded_texts):
+        from django.core.management import call_command
+        from knowledge_base.models import ContentChunk
+        from knowledge_base.tasks import process_textbook_content
+        from protocol.faiss_shards import get_faiss_driver
+        settings.CHUNK_SIZE = 60
+        settings.CHUNK_OVERLAP = 0
+        settings.INGEST_EMBED_BATCH_SIZE = 2
+        settings.RAG_INDEX_CHECK_INTERVAL = 0
+        text = ' '.join(f"Sentence {i} is about plate tectonics and volcanoes." for i in range(6))
+        textbook = create_textbook('Geology', subject='Geography', grade='8', content_text=text)
+        chunks = ContentChunk.objects.filter(textbook=textbook)
+
+        # Without an API key the Gemini client answers with all-zero dummy vectors
+        settings.LLM_BACKEND = 'gemini'
+        settings.GEMINI_API_KEY = ''
+        process_textbook_content.delay(str(textbook.id))
+        textbook.refresh_from_db()
+        assert textbook.processing_status == 'failed' and 'zero embedding' in textbook.processing_error
+        assert set(chunks.values_list('embedding_status', flat=True)) == {'pending'}
+        assert not chunks.filter(embedding_vector__isnull=False).exists()
+
+        # One usable vector stored by an earlier run is reused, not paid for again
+        reused = chunks.order_by('chunk_index').first()
+        ContentChunk.objects.filter(id=reused.id).update(embedding_vector=unit_vector(0), embedding_status='embedded')
+        settings.LLM_BACKEND = 'local'
+        call_command('resume_ingestion', '--inline')
+
+        textbook.refresh_from_db()
+        assert textbook.processing_status == 'completed'
+        assert len(embedded_texts) == chunks.count() - 1 and reused.chunk_text not in embedded_texts
+        assert not chunks.filter(embedding_status='pending').exists()
+        get_faiss_driver().rebuild_index()
+        assert get_faiss_driver().ntotal == chunks.count()
+        call_command('resume_ingestion', '--dry-run')
+
+    def test_tasks_route_to_their_queues_and_queue_depth_is_reported(self):
+        from rag_tutor.celery import app
+        route = lambda name: app.amqp.router.route({}, name)
+        assert route('knowledge_base.tasks.embed_chunk_batch')['queue'].name == 'ingestion_embed'
+        assert route('knowledge_base.tasks.chunk_textbook')['queue'].name == 'ingestion_extract'
+        assert route('api.tasks.send_webhook_async')['queue'].name == 'notifications'
+        assert route('context.rag_pipeline.initialize_rag_pipeline')['priority'] == 0
+
+        # send_task publishes even with eager execution, so the messages wait in the broker
+        for _ in range(3):
+            app.send_task('knowledge_base.tasks.embed_chunk_batch', args=['textbook', []])
+        app.send_task('api.tasks.send_webhook_async', args=['question_asked', {}])
+        try:
+            response = self.client.get(reverse('metrics-queues'))
+            assert response.status_code == 200
+            assert response.data['queues']['ingestion_embed'] == 3
+            assert response.data['queues']['notifications'] == 1
+            assert response.data['queues']['index_writer'] == 0
+            assert response.data['total'] == 4
+            text = self.client.get(reverse('metrics-prometheus')).content.decode()
+            assert 'rag_celery_queue_depth{queue="ingestion_embed"} 3' in text
+        finally:
+            with app.connection_for_write() as connection:
+                for queue in ('ingestion_embed', 'notifications'):
+                    connection.default_channel.queue_purge(queue)
+
+    def test_second_edition_reuses_embeddings_and_search_collapses_duplicates(self, settings, embedded_texts):
+        from django.core.cache import cache
+        from knowledge_base.models import ContentChunk
+        from knowledge_base.tasks import process_textbook_content, apply_index_updates
+        from protocol import llm_client
+        from protocol.faiss_shards import get_faiss_driver
+        cache.delete('rag_tutor:index_writer:scheduled')
+        settings.LLM_BACKEND = 'local'
+        settings.CHUNK_SIZE = 60
+        settings.CHUNK_OVERLAP = 0
+        settings.RAG_INDEX_CHECK_INTERVAL = 0
+        topics = ['volcanoes and magma', 'rivers and erosion', 'glaciers and ice ages', 'deserts and dunes',
+                  'oceans and tides', 'earthquakes and faults']
+        first = ' '.join(
+            f"Chapter {i} explains {topic} in detail. Students learn how {topic} shape the land over millions of years."
+            for i, topic in enumerate(topics)
+        )
+        second = first.replace('Chapter 5 explains', 'Chapter 5 describes')
+        editions = [
+            create_textbook(f'Earth Science, edition {n}', subject='Geography', grade='7', content_text=text)
+            for n, text in enumerate([first, second], start=1)
+        ]
+
+        process_textbook_content.delay(str(editions[0].id))
+        first_calls = len(embedded_texts)
+        process_textbook_content.delay(str(editions[1].id))
+        apply_index_updates()
+
+        chunks = ContentChunk.objects.filter(textbook=editions[1])
+        duplicates = chunks.filter(duplicate_of__textbook=editions[0])
+        assert first_calls == chunks.count() >= 3
+        assert duplicates.count() >= chunks.count() - 2
+        assert len(embedded_texts) - first_calls == chunks.count() - duplicates.count()
+        assert all(chunk.embedding_vector == chunk.duplicate_of.embedding_vector for chunk in duplicates)
+
+        driver = get_faiss_driver()
+        driver.rebuild_index()
+        assert driver.ntotal == 2 * chunks.count()
+        query = llm_client.LLMClient().generate_embedding('How do rivers and erosion shape the land?')
+        hits = driver.search(query, top_k=chunks.count())
+        groups = [hit['metadata'].get('canonical_id') or hit['id'] for hit in hits]
+        assert len(groups) == len(set(groups))
+        settings.RAG_COLLAPSE_DUPLICATES = False
+        hits = driver.search(query, top_k=chunks.count())
+        assert len({hit['metadata'].get('canonical_id') or hit['id'] for hit in hits}) < len(hits)
+
+    def test_search_widens_candidates_until_top_k_distinct_chunks_survive_collapsing(self, settings):
+        from knowledge_base.models import ContentChunk
+        from protocol.faiss_shards import get_faiss_driver
+        settings.RAG_COLLAPSE_DUPLICATES = True
+        # Three editions repeat every passage, so each hit has two near-duplicates behind it
+        embeddings = [[1.0, 0.1 * group] + [0.0] * 766 for group in range(8)]
+        editions = [
+            create_chunks(
+                create_textbook(f'Botany, edition {n}', processing_status='completed'),
+                [f'Leaves and roots, part {group}.' for group in range(8)], embeddings
+            )
+            for n in range(3)
+        ]
+        for later in editions[1:]:
+            for chunk, canonical in zip(later, editions[0]):
+                ContentChunk.objects.filter(id=chunk.id).update(duplicate_of=canonical)
+
+        driver = get_faiss_driver()
+        driver.rebuild_index()
+        hits = driver.search(unit_vector(0), top_k=5)
+        assert [hit['metadata'].get('canonical_id') or hit['id'] for hit in hits] == [str(chunk.id) for chunk in editions[0][:5]]
+
+    def test_textbook_filtered_search_only_queries_the_owning_shard(self, settings):
+        from protocol.faiss_driver import shard_for
+        from protocol.faiss_shards import ShardedFAISSDriver
+
+        class RecordingShard:
+            def __init__(self):
+                self.searches = 0
+
+            def search(self, *args):
+                self.searches += 1
+                return []
+
+        settings.FAISS_SHARD_BY = 'hash'
+        shards = [RecordingShard() for _ in range(4)]
+        driver = ShardedFAISSDriver(backend='local', shards=shards)
+        textbook_id = 'b7f1c3f2-5a0e-4c39-9d1e-0d6f0e2f8a11'
+        driver.search([0.0] * 768, top_k=5, filters={'textbook_id': textbook_id})
+        owner = shard_for(textbook_id, None, 4, 'hash')
+        assert [shard.searches for shard in shards] == [1 if n == owner else 0 for n in range(4)]
+        driver.search([0.0] * 768, top_k=5)
+        assert all(shard.searches >= 1 for shard in shards)
+
+    def test_snapshot_rollback_of_a_sharded_index_targets_one_shard(self, settings, tmp_path):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from protocol.faiss_shards import shard_snapshot_dir
+        from protocol.index_snapshots import SnapshotStore
+        settings.FAISS_SHARD_COUNT = 2
+        settings.FAISS_SHARD_DIR = str(tmp_path)
+        stores = [SnapshotStore(shard_snapshot_dir(n)) for n in range(2)]
+        written = [[store.write(lambda path: open(f'{path}/index.faiss', 'w').write(str(n)), {}) for n in range(2)]
+                   for store in stores]
+
+        with pytest.raises(CommandError, match='--shard'):
+            call_command('index_snapshots', '--rollback')
+        call_command('index_snapshots', '--rollback', '--shard', '1')
+        assert stores[1].current_version() == written[1][0]
+        assert stores[0].current_version() == written[0][1]
+
+    def test_snapshot_reload_checks_sizes_without_rehashing(self, tmp_path, monkeypatch):
+        from protocol import index_snapshots
+        store = index_snapshots.SnapshotStore(str(tmp_path))
+        older = store.write(lambda path: open(f'{path}/index.faiss', 'w').write('older index'), {})
+        newer = store.write(lambda path: open(f'{path}/index.faiss', 'w').write('newer index'), {})
+
+        hashed = []
+        original = index_snapshots._sha256
+        monkeypatch.setattr(index_snapshots, '_sha256', lambda path: hashed.append(path) or original(path))
+        assert store.loadable_version() == newer
+        assert hashed == []
+
+        # A truncated file is caught on load and the previous snapshot is used
+        with open(tmp_path / newer / 'index.faiss', 'w') as f:
+            f.write('torn')
+        assert store.loadable_version() == older
+        assert hashed == []
+
+    def test_snapshot_store_writes_promotes_and_prunes(self, tmp_path):
+        import json
+        from protocol.index_snapshots import SnapshotStore
+        store = SnapshotStore(str(tmp_path))
+        versions = [
+            store.write(lambda path, n=n: open(f'{path}/index.faiss', 'w').write(f'index {n}'), {'vector_count': n}, keep=2)
+            for n in range(3)
+        ]
+        # Each write is promoted, and only the newest two are kept
+        assert store.current_version() == versions[2]
+        assert store.versions() == versions[1:]
+        manifest = json.loads((tmp_path / versions[2] / 'manifest.json').read_text())
+        assert manifest['vector_count'] == 2 and set(manifest['files']) == {'index.faiss'}
+        assert not [name for name in tmp_path.iterdir() if name.name.startswith('.tmp-')]
+
+        store.promote(versions[1])
+        assert store.current_version() == versions[1]
+        assert (tmp_path / 'current' / 'index.faiss').read_text() == 'index 1'
+        # Pruning never deletes the current snapshot, even when it is not among the newest
+        store.prune(1)
+        assert store.versions() == versions[1:]
+        assert [snapshot['is_current'] for snapshot in store.list_snapshots()] == [True, False]
+
+    def test_corrupted_snapshot_fails_verification_and_is_not_rolled_back_to(self, snapshot_dir):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from protocol.index_snapshots import SnapshotStore
+        store = SnapshotStore(snapshot_dir)
+        older = store.write(lambda path: open(f'{path}/index.faiss', 'w').write('older index'), {})
+        newer = store.write(lambda path: open(f'{path}/index.faiss', 'w').write('newer index'), {})
+        index_file = f'{snapshot_dir}/{older}/index.faiss'
+
+        # Same size, different bytes: only the checksum catches it
+        with open(index_file, 'w') as f:
+            f.write('older INDEX')
+        assert not store.verify(older)
+        with pytest.raises(CommandError, match='failed verification'):
+            call_command('index_snapshots', '--verify', older)
+        with pytest.raises(CommandError, match='failed verification'):
+            call_command('index_snapshots', '--rollback')
+        assert store.current_version() == newer
+
+        with open(index_file, 'w') as f:
+            f.write('older index')
+        call_command('index_snapshots', '--rollback')
+        assert store.current_version() == older
+        call_command('index_snapshots', '--verify')
+
+    @pytest.mark.parametrize('index_type', ['sq8', 'sqfp16', 'pq'])
+    def test_quantized_index_reranks_exactly_and_survives_reload(self, settings, snapshot_dir, index_type):
+        import numpy as np
+        from protocol.cache_namespace import index_cache
+        from protocol.faiss_driver import FAISSDriver
+        settings.FAISS_INDEX_TYPE = index_type
+        settings.FAISS_TRAIN_MIN_VECTORS = 0
+        settings.FAISS_PQ_M = 16
+        embeddings = random_embeddings(300)
+        chunks = create_chunks(
+            create_textbook('Statistics', processing_status='completed'),
+            [f'Distributions, part {n}.' for n in range(300)], embeddings
+        )
+        queries = np.asarray(embeddings[:20]) + 0.05 * np.asarray(random_embeddings(20, seed=1))
+        expected = [str(chunks[n].id) for n in np.argmax(queries @ np.asarray(embeddings).T, axis=1)]
+
+        driver = FAISSDriver(snapshot_dir=snapshot_dir)
+        driver.rebuild_index()
+        assert driver._is_quantized()
+        assert driver.snapshots.read_manifest(driver.version)['quantization'] == index_type
+        index_cache.invalidate()
+        reloaded = FAISSDriver(snapshot_dir=snapshot_dir)
+        assert reloaded.version == driver.version and reloaded.vectors is not None
+
+        by_id = {str(chunk.id): embedding for chunk, embedding in zip(chunks, embeddings)}
+        for search in (driver.search, reloaded.search):
+            hits = [search(query.tolist(), top_k=1)[0] for query in queries]
+            assert [hit['id'] for hit in hits] == expected
+            # Scores come from the full-precision vectors, not the lossy codes
+            exact = [np.dot(query / np.linalg.norm(query), by_id[hit['id']]) for query, hit in zip(queries, hits)]
+            assert np.allclose([hit['score'] for hit in hits], exact, atol=1e-5)
+
+    def test_pca_index_persists_its_projection_and_reranks_exactly(self, settings, snapshot_dir):
+        import os
+        import numpy as np
+        from protocol.cache_namespace import index_cache
+        from protocol.faiss_driver import FAISSDriver, PCA_FILE
+        settings.FAISS_INDEX_TYPE = 'flat'
+        settings.FAISS_PCA_DIM = 64
+        settings.FAISS_TRAIN_MIN_VECTORS = 0
+        # Real embeddings concentrate in a few directions; spread these over 48 so 64 components keep them apart
+        basis = np.linalg.qr(np.random.default_rng(2).standard_normal((768, 48)))[0]
+        embeddings = np.asarray(random_embeddings(300, dimension=48)) @ basis.T
+        chunks = create_chunks(
+            create_textbook('Optics', processing_status='completed'),
+            [f'Lenses, part {n}.' for n in range(300)], embeddings.tolist()
+        )
+        queries = embeddings[:20] + 0.05 * np.asarray(random_embeddings(20, seed=1, dimension=48)) @ basis.T
+        expected = [str(chunks[n].id) for n in np.argmax(queries @ embeddings.T, axis=1)]
+
+        driver = FAISSDriver(snapshot_dir=snapshot_dir)
+        driver.rebuild_index()
+        assert driver.pca is not None and driver.index.d == 64
+        assert os.path.exists(os.path.join(driver.snapshots.path(driver.version), PCA_FILE))
+        index_cache.invalidate()
+        reloaded = FAISSDriver(snapshot_dir=snapshot_dir)
+        assert reloaded.pca is not None and reloaded.index.d == 64 and reloaded.vectors is not None
+
+        by_id = {str(chunk.id): embedding for chunk, embedding in zip(chunks, embeddings)}
+        for search in (driver.search, reloaded.search):
+            hits = [search(query.tolist(), top_k=1)[0] for query in queries]
+            assert [hit['id'] for hit in hits] == expected
+            # Scored against the unprojected 768-dimension vectors, not their 64-dimension projections
+            exact = [np.dot(query / np.linalg.norm(query), by_id[hit['id']]) for query, hit in zip(queries, hits)]
+            assert np.allclose([hit['score'] for hit in hits], exact, atol=1e-5)
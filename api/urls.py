@@ -25,11 +25,15 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('', include(router.urls)),
     path('test/', views.TestView.as_view(), name='test'),
+    path('health/live/', views.LivenessView.as_view(), name='health-live'),
+    path('health/ready/', views.ReadinessView.as_view(), name='health-ready'),
     path('upload-content/', views.UploadContentView.as_view(), name='upload-content'),
     path('ask/', views.AskQuestionView.as_view(), name='ask-question'),
     path('session-stats/', views.SessionStatsView.as_view(), name='session-stats'),
     path('topics/', views.TopicsView.as_view(), name='topics'),
     path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    path('metrics/prometheus/', views.PrometheusMetricsView.as_view(), name='metrics-prometheus'),
+    path('metrics/queues/', views.QueueMetricsView.as_view(), name='metrics-queues'),
     path('pipeline/', views.RAGPipelineView.as_view(), name='pipeline'),
     path('rebuild-faiss/', views.RebuildFAISSView.as_view(), name='rebuild-faiss'),
     
@@ -3,35 +3,60 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser, FormParser
-from django.db.models import Q, Count, Avg
+from django.db.models import Q, Count, Avg, F, Sum
+from django.db.models.functions import TruncDate
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse
+from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
 import json
 import logging
+import math
+import os
 import psutil
 import time
 
 from knowledge_base.models import (
     TextbookContent, Subject, Grade, ContentChunk, QueryLog, 
-    AuditLog, SystemMetrics
+    AuditLog, SystemMetrics, QueryRollup
 )
 from knowledge_base.serializers import (
     TextbookContentSerializer, SubjectSerializer, GradeSerializer, QueryLogSerializer,
     AuditLogSerializer, SystemMetricsSerializer,
     FeedbackSubmissionSerializer, QueryAnalyticsSerializer
 )
-from knowledge_base.tasks import process_textbook_content
+from knowledge_base.tasks import process_textbook_content, schedule_index_update
+from knowledge_base.corpus import corpus_stats, invalidate_corpus_stats
+from knowledge_base.analytics import floor_day, floor_hour, summarize_rollups
 from context.rag_pipeline import RAGPipeline
+from context.bootstrap import pipeline_bootstrap, PipelineUnavailable
 from context.sql_agent import SQLAgent
+from context.instrumentation import prometheus_labels, prometheus_text
+from rag_tutor.celery import queue_depths
+from rag_tutor.tracing import trace
+from protocol.llm_client import LLMUnavailable
 from protocol.webhook_adapter import WebhookAdapter
 from .tasks import send_webhook_async
 
 logger = logging.getLogger('rag_tutor')
 
+# RAG result fields with provider errors and per-stage internals; logged and exported as metrics,
+# but only returned to staff users or when DEBUG is on
+RAG_DIAGNOSTIC_FIELDS = ('generation_error', 'timings', 'sql')
+
+def model_unavailable_response(error: LLMUnavailable) -> Response:
+    """503 telling the client when the model provider will take calls again"""
+    retry_after = math.ceil(error.retry_after)
+    response = Response(
+        {'error': f'The AI model is temporarily unavailable: {str(error)}', 'retry_after': retry_after},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+    response['Retry-After'] = str(retry_after)
+    return response
+
 class TestView(APIView):
     """Simple test endpoint to verify system is working"""
     
@@ -43,13 +68,39 @@ class TestView(APIView):
             'user_authenticated': request.user and hasattr(request.user, 'is_authenticated') and request.user.is_authenticated
         })
 
+class LivenessView(APIView):
+    """Liveness probe; reports pipeline state without loading anything"""
+    
+    def get(self, request):
+        return Response({
+            'status': 'alive',
+            'pid': os.getpid(),
+            'timestamp': timezone.now().isoformat(),
+            'pipeline': pipeline_bootstrap.status()
+        })
+
+class ReadinessView(APIView):
+    """Readiness probe; loads the pipeline in this process if it is still cold"""
+    
+    def get(self, request):
+        ready = pipeline_bootstrap.warm()
+        return Response(
+            {
+                'status': 'ready' if ready else 'unavailable',
+                'pid': os.getpid(),
+                'timestamp': timezone.now().isoformat(),
+                'pipeline': pipeline_bootstrap.status()
+            },
+            status=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+
 @method_decorator(csrf_exempt, name='dispatch')
 class TextbookViewSet(viewsets.ModelViewSet):
     queryset = TextbookContent.objects.all()
     serializer_class = TextbookContentSerializer
     
     def get_queryset(self):
-        return TextbookContent.objects.all().order_by('-uploaded_at')
+        return TextbookContent.objects.select_related('subject', 'grade', 'uploaded_by').order_by('-uploaded_at')
     
     def list(self, request, *args, **kwargs):
         """Override list method to add debugging"""
@@ -62,7 +113,7 @@ class TextbookViewSet(viewsets.ModelViewSet):
         logger.info(f"TextbookViewSet.all_materials called - user: {request.user}")
         
         # Get all textbooks regardless of status
-        qs = TextbookContent.objects.all().order_by('-uploaded_at')
+        qs = self.get_queryset()
         
         # For authenticated users, filter by user
         if request.user and hasattr(request.user, 'is_authenticated') and request.user.is_authenticated:
@@ -89,17 +140,13 @@ class TextbookViewSet(viewsets.ModelViewSet):
             ContentChunk.objects.filter(textbook=instance).delete()
             
             # Delete the textbook
+            textbook_id = instance.id
             instance.delete()
+            invalidate_corpus_stats()
 
-            # --- NEW: Clear cache and rebuild FAISS index ---
-            from protocol.faiss_driver import FAISSDriver
-            from django.core.cache import cache
-            cache.clear()
-            logger.info('Cache cleared after deleting textbook')
-            faiss = FAISSDriver()
-            faiss.rebuild_index()
-            logger.info('FAISS index rebuilt after deleting textbook')
-            # --- END NEW ---
+            # The index writer drops its vectors, batched with any other pending changes
+            schedule_index_update(textbook_id)
+            logger.info(f'Queued index removal for textbook {textbook_id}')
             
             logger.info(f"Successfully deleted textbook: {instance.id}")
             return Response(
@@ -178,6 +225,7 @@ class UploadContentView(APIView):
                     uploaded_by=None,  # Allow anonymous uploads for demo
                     metadata=request.data.get('metadata', {})
                 )
+                invalidate_corpus_stats()
             except Exception as e:
                 logger.error(f"TextbookContent create error: {str(e)}")
                 return Response({'error': f'Failed to save content: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -292,16 +340,15 @@ class AskQuestionView(APIView):
         start_time = time.time()
         
         try:
-            # Debug logging
-            logger.info(f"Ask request data: {request.data}")
+            trace('ask.request', data=request.data)
             
             question = request.data.get('question')
             query_type = request.data.get('type', 'rag')  # 'rag' or 'sql'
             textbook_id = request.data.get('textbook_id')
             persona = request.data.get('persona', 'helpful_tutor')
+            context_window = request.data.get('context_window')
 
-            # Debug logging
-            logger.info(f"Parsed data: question='{question}', type='{query_type}', textbook_id='{textbook_id}', persona='{persona}'")
+            logger.debug(f"Parsed data: question='{question}', type='{query_type}', textbook_id='{textbook_id}', persona='{persona}'")
 
             # Improved error handling
             if not question or not question.strip():
@@ -315,40 +362,45 @@ class AskQuestionView(APIView):
                     {'error': 'Invalid query type. Use "rag" or "sql".'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            if context_window is not None:
+                try:
+                    context_window = int(context_window)
+                    if context_window < 0:
+                        raise ValueError
+                except (TypeError, ValueError):
+                    return Response(
+                        {'error': 'context_window must be a non-negative integer.'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
 
             if query_type == 'rag':
                 try:
                     rag_pipeline = RAGPipeline()
+                except PipelineUnavailable as e:
+                    return Response(
+                        {'error': f'The AI system is unavailable: {str(e)}'},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE
+                    )
                 except Exception as e:
-                    if 'initializing' in str(e).lower():
-                        return Response(
-                            {'error': 'The AI system is warming up. Please wait a few seconds and try again.'},
-                            status=status.HTTP_503_SERVICE_UNAVAILABLE
-                        )
                     return Response(
                         {'error': f'Internal error: {str(e)}'},
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR
                     )
-                result = rag_pipeline.query(
-                    question=question,
-                    user=request.user,
-                    textbook_id=textbook_id,
-                    persona=persona
-                )
-                
-                # Enhanced logging with additional context
-                query_log = QueryLog.objects.filter(
-                    query_text=question,
-                    user=request.user if request.user and getattr(request.user, 'is_authenticated', False) else None
-                ).order_by('-created_at').first()
-                
-                if query_log:
-                    query_log.persona_used = persona
-                    query_log.subject_filter = ''  # Use empty string instead of None
-                    query_log.grade_filter = ''    # Use empty string instead of None
-                    query_log.user_agent = request.META.get('HTTP_USER_AGENT', '')
-                    query_log.ip_address = self._get_client_ip(request)
-                    query_log.save()
+                try:
+                    result = rag_pipeline.query(
+                        question=question,
+                        user=request.user,
+                        textbook_id=textbook_id,
+                        persona=persona,
+                        neighbor_window=context_window,
+                        # Saved with the query log's insert rather than re-fetched and updated here
+                        log_fields={
+                            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+                            'ip_address': self._get_client_ip(request)
+                        }
+                    )
+                except LLMUnavailable as e:
+                    return model_unavailable_response(e)
                 
                 # Log audit event (only if user is authenticated)
                 if request.user and hasattr(request.user, 'is_authenticated') and request.user.is_authenticated:
@@ -362,7 +414,7 @@ class AskQuestionView(APIView):
                             'grade_filter': '',    # Use empty string instead of None
                             'response_time_ms': result['response_time_ms']
                         },
-                        related_query=query_log
+                        related_query_id=result['query_log_id']
                     )
                     
                     # Send webhook
@@ -371,7 +423,9 @@ class AskQuestionView(APIView):
                         'type': query_type,
                         'response_time_ms': result['response_time_ms']
                     })
-                
+
+                if not (settings.DEBUG or getattr(request.user, 'is_staff', False)):
+                    result = {key: value for key, value in result.items() if key not in RAG_DIAGNOSTIC_FIELDS}
                 return Response(result, status=status.HTTP_200_OK)
                 
             elif query_type == 'sql':
@@ -396,7 +450,7 @@ class AskQuestionView(APIView):
                         request, 'query_execution',
                         f"SQL query executed: {question[:50]}...",
                         {'query_type': 'sql', 'persona': persona},
-                        related_query=query_log
+                        related_query_id=query_log.id
                     )
                 
                 return Response(result, status=status.HTTP_200_OK)
@@ -422,7 +476,7 @@ class AskQuestionView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
-    def _log_audit_event(self, request, event_type, description, event_data, related_query=None):
+    def _log_audit_event(self, request, event_type, description, event_data, related_query_id=None):
         """Log audit event with system context"""
         try:
             session_key = getattr(request.session, 'session_key', '') or ''
@@ -434,7 +488,7 @@ class AskQuestionView(APIView):
                 ip_address=self._get_client_ip(request),
                 user_agent=request.META.get('HTTP_USER_AGENT', ''),
                 session_id=session_key,
-                related_query=related_query,
+                related_query_id=related_query_id,
                 execution_time_ms=event_data.get('response_time_ms'),
                 memory_usage_mb=psutil.Process().memory_info().rss / 1024 / 1024
             )
@@ -637,46 +691,29 @@ class AnalyticsView(APIView):
             days = int(request.query_params.get('days', 30))
             start_date = timezone.now() - timedelta(days=days)
             
-            # Query analytics
-            queries = QueryLog.objects.filter(created_at__gte=start_date)
-            total_queries = queries.count()
-            
-            # Average response time
-            avg_response_time = queries.aggregate(
-                avg_time=Avg('response_time_ms')
-            )['avg_time'] or 0
-            
-            # Average rating
-            # The original code had UserFeedback.objects.filter(query_log__created_at__gte=start_date)
-            # Since UserFeedback is removed, this will now return an empty queryset or raise an error.
-            # Assuming the intent was to remove this functionality or replace it with a placeholder.
-            # For now, we'll set avg_rating to 0.
-            avg_rating = 0
+            # Daily rollups covering the range; whole days, so the first one may start before start_date
+            rollups = QueryRollup.objects.filter(granularity='day', bucket_start__gte=floor_day(start_date))
+            summary = summarize_rollups(rollups)
+            total_queries = summary['query_count']
+            avg_response_time = summary['avg_response_time']
+            avg_rating = summary['avg_rating']
             
             # Top personas
-            top_personas = queries.values('persona_used').annotate(
-                count=Count('id')
+            top_personas = rollups.values(persona_used=F('persona')).annotate(
+                count=Sum('query_count')
             ).order_by('-count')[:5]
             
             # Top subjects
-            top_subjects = queries.values('subject_filter').annotate(
-                count=Count('id')
-            ).filter(subject_filter__isnull=False).exclude(
-                subject_filter=''
+            top_subjects = rollups.exclude(subject='').values(subject_filter=F('subject')).annotate(
+                count=Sum('query_count')
             ).order_by('-count')[:5]
             
             # Feedback distribution
-            # The original code had UserFeedback.objects.values('rating').annotate(count=Count('id')).order_by('rating')
-            # Since UserFeedback is removed, this will now return an empty queryset or raise an error.
-            # Assuming the intent was to remove this functionality or replace it with a placeholder.
-            # For now, we'll set feedback_distribution to an empty dict.
-            feedback_distribution = {}
+            feedback_distribution = summary['rating_distribution']
             
             # Daily queries
-            daily_queries = queries.extra(
-                select={'day': 'date(created_at)'}
-            ).values('day').annotate(
-                count=Count('id')
+            daily_queries = rollups.values(day=TruncDate('bucket_start')).annotate(
+                count=Sum('query_count')
             ).order_by('day')
             
             # System metrics
@@ -690,6 +727,7 @@ class AnalyticsView(APIView):
                 'top_subjects': list(top_subjects),
                 'feedback_distribution': feedback_distribution,
                 'daily_queries': list(daily_queries),
+                'latency_histogram': summary['latency_histogram'],
                 'system_metrics': system_metrics
             }
             
@@ -757,9 +795,10 @@ class MetricsView(APIView):
     def get(self, request):
         """Get system metrics and statistics"""
         try:
-            # Basic counts
-            total_textbooks = TextbookContent.objects.count()
-            total_chunks = ContentChunk.objects.count()
+            # Basic counts; corpus totals come from the maintained per-textbook counters
+            corpus = corpus_stats()
+            total_textbooks = corpus['total_textbooks']
+            total_chunks = corpus['total_chunks']
             total_queries = QueryLog.objects.count()
             total_feedbacks = 0
 
@@ -775,7 +814,9 @@ class MetricsView(APIView):
             )
 
             # Recent activity
-            recent_queries = QueryLog.objects.order_by('-created_at')[:10]
+            recent_queries = QueryLog.objects.select_related('user').prefetch_related(
+                'retrieved_chunks__textbook'
+            ).order_by('-created_at')[:10]
             recent_feedbacks = []
 
             # Average ratings
@@ -788,6 +829,8 @@ class MetricsView(APIView):
                 'total_feedbacks': total_feedbacks,
                 'avg_rating': round(avg_rating, 2),
                 'processing_stats': list(processing_stats),
+                'chunks_by_subject': corpus['by_subject'],
+                'chunks_by_grade': corpus['by_grade'],
                 'recent_queries': QueryLogSerializer(recent_queries, many=True).data,
                 'recent_feedbacks': []
             }
@@ -801,6 +844,31 @@ class MetricsView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class PrometheusMetricsView(APIView):
+    """Per-stage RAG latency percentiles of this worker process and Celery queue depths, for Prometheus to scrape"""
+    
+    def get(self, request):
+        text = prometheus_text()
+        try:
+            depths = queue_depths()
+            text += '# HELP rag_celery_queue_depth Tasks waiting in the Celery queue\n# TYPE rag_celery_queue_depth gauge\n'
+            text += ''.join(f'rag_celery_queue_depth{prometheus_labels(queue=queue)} {depth}\n' for queue, depth in depths.items())
+        except Exception as e:
+            # Process metrics stay scrapable while the broker is down
+            logger.warning(f"Queue depths unavailable: {str(e)}")
+        return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class QueueMetricsView(APIView):
+    """Tasks waiting in each Celery queue, to spot a starved queue or size its workers"""
+    
+    def get(self, request):
+        try:
+            depths = queue_depths()
+        except Exception as e:
+            logger.error(f"Failed to read queue depths: {str(e)}")
+            return Response({'error': 'Message broker unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'queues': depths, 'total': sum(depths.values())}, status=status.HTTP_200_OK)
+
 class RAGPipelineView(APIView):
     def get(self, request):
         """Get RAG pipeline status and configuration"""
@@ -840,6 +908,8 @@ class RAGPipelineView(APIView):
             
             return Response(result, status=status.HTTP_200_OK)
             
+        except LLMUnavailable as e:
+            return model_unavailable_response(e)
         except Exception as e:
             logger.error(f"Pipeline test failed: {str(e)}")
             return Response(
@@ -852,48 +922,19 @@ class SessionStatsView(APIView):
     
     def get(self, request):
         try:
-            # Calculate real stats from the database
-            from django.db.models import Avg, Count
-            from datetime import datetime, timedelta
-            
-            # Get session start time (last 24 hours for demo purposes)
-            # In production, you might want to track actual session start
-            session_start = datetime.now() - timedelta(hours=24)
-            
-            # Get queries from the session period
-            session_queries = QueryLog.objects.filter(
-                created_at__gte=session_start
-            )
-            
-            # If no session queries, try today's queries
-            if not session_queries.exists():
-                today = datetime.now().date()
-                session_queries = QueryLog.objects.filter(
-                    created_at__date=today
-                )
-            
-            # If still no queries, try all queries (for demo purposes)
-            if not session_queries.exists():
-                session_queries = QueryLog.objects.all()
-            
-            # Calculate stats
-            questions_asked = session_queries.count()
-            
-            # Average response time
-            avg_response_time = session_queries.aggregate(
-                avg_time=Avg('response_time_ms')
-            )['avg_time'] or 0
+            # Hourly rollups for the last 24 hours (a stand-in for tracking the actual session start)
+            session_start = timezone.now() - timedelta(hours=24)
+            rollups = QueryRollup.objects.filter(granularity='hour', bucket_start__gte=floor_hour(session_start))
+            summary = summarize_rollups(rollups)
             
-            # Average rating (from queries with ratings)
-            rated_queries = session_queries.filter(rating__isnull=False)
-            avg_rating = rated_queries.aggregate(
-                avg_rating=Avg('rating')
-            )['avg_rating'] or 0
+            # If no session queries, fall back to all time (for demo purposes)
+            if not summary['query_count']:
+                summary = summarize_rollups(QueryRollup.objects.filter(granularity='day'))
             
-            # Sources used (queries with retrieved chunks)
-            sources_used = session_queries.filter(
-                retrieved_chunks__isnull=False
-            ).distinct().count()
+            questions_asked = summary['query_count']
+            avg_response_time = summary['avg_response_time']
+            avg_rating = summary['avg_rating']
+            sources_used = summary['sourced_count']
             
             # Debug logging
             logger.info(f"Session stats calculated: questions={questions_asked}, avg_time={avg_response_time}, avg_rating={avg_rating}, sources={sources_used}")
@@ -1051,7 +1092,12 @@ class ManageDataView(APIView):
             if data_type == 'subject':
                 try:
                     subject = Subject.objects.get(id=item_id)
+                    # The delete cascades to the subject's textbooks, whose vectors must leave the index too
+                    textbook_ids = list(subject.textbookcontent_set.values_list('id', flat=True))
                     subject.delete()
+                    invalidate_corpus_stats()
+                    for textbook_id in textbook_ids:
+                        schedule_index_update(textbook_id)
                     return Response({'message': 'Subject deleted successfully'})
                 except Subject.DoesNotExist:
                     return Response(
@@ -1062,7 +1108,11 @@ class ManageDataView(APIView):
             elif data_type == 'grade':
                 try:
                     grade = Grade.objects.get(id=item_id)
+                    textbook_ids = list(grade.textbookcontent_set.values_list('id', flat=True))
                     grade.delete()
+                    invalidate_corpus_stats()
+                    for textbook_id in textbook_ids:
+                        schedule_index_update(textbook_id)
                     return Response({'message': 'Grade deleted successfully'})
                 except Grade.DoesNotExist:
                     return Response(
@@ -1105,14 +1155,14 @@ class RebuildFAISSView(APIView):
     def post(self, request):
         """Force rebuild FAISS index"""
         try:
-            from protocol.faiss_driver import FAISSDriver
-            from django.core.cache import cache
+            from protocol.faiss_shards import get_faiss_driver
+            from protocol.cache_namespace import index_cache
             
-            # Clear cache
-            cache.delete('faiss_driver')
+            # Drop the cached index copy
+            index_cache.invalidate()
             
             # Create new driver and force rebuild
-            faiss_driver = FAISSDriver()
+            faiss_driver = get_faiss_driver()
             faiss_driver.force_rebuild_index()
             
             return Response(
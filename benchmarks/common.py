@@ -0,0 +1,98 @@
+"""Shared helpers for the standalone benchmark scripts in this package"""
+import json
+import logging
+import os
+import statistics
+import time
+from typing import Any, Callable, Dict, Iterable, List, Sequence
+
+import numpy as np
+
+
+def setup_django(quiet: bool = True):
+    """Configure Django so benchmark scripts can import the project modules"""
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rag_tutor.settings')
+    django.setup()
+    if quiet:
+        # Per-request INFO logging would otherwise dominate the timings
+        logging.getLogger('rag_tutor').setLevel(logging.WARNING)
+
+
+def random_unit_vectors(count: int, dimension: int, seed: int = 0) -> np.ndarray:
+    """L2-normalised float32 vectors, the same shape FAISSDriver stores"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def clustered_unit_vectors(count: int, dimension: int, clusters: int = 64, spread: float = 1.0,
+                           seed: int = 0, topic_seed: int = 0) -> np.ndarray:
+    """Normalised vectors drawn around ``clusters`` topics; closer to real embeddings than pure noise.
+
+    Calls with the same ``topic_seed`` share topics, so queries land near the corpus.
+    """
+    rng = np.random.default_rng(seed)
+    centres = random_unit_vectors(clusters, dimension, seed=topic_seed + 1000)
+    vectors = centres[rng.integers(0, clusters, count)]
+    vectors = vectors + spread * rng.standard_normal((count, dimension)).astype(np.float32) / np.sqrt(dimension)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+def database_vectors(limit: int) -> np.ndarray:
+    """Normalised embeddings of up to ``limit`` stored chunks (needs a configured database)"""
+    from knowledge_base.models import ContentChunk
+
+    rows = ContentChunk.objects.filter(embedding_vector__isnull=False).values_list('embedding_vector', flat=True)[:limit]
+    vectors = np.array(list(rows), dtype=np.float32)
+    if not len(vectors):
+        raise SystemExit('No embedded chunks in the database')
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors
+
+
+def recall_at_k(found: Sequence[Sequence[int]], expected: Sequence[Sequence[int]]) -> float:
+    """Mean fraction of the exact top-k ids present in each returned top-k"""
+    hits = [len(set(f) & set(e)) / max(len(e), 1) for f, e in zip(found, expected)]
+    return round(float(np.mean(hits)), 4)
+
+
+def index_nbytes(index) -> int:
+    """Serialised size of a FAISS index, a close proxy for its resident memory"""
+    import faiss
+
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def time_calls(fn: Callable[[Any], Any], inputs: Iterable[Any], warmup: int = 5) -> Dict[str, float]:
+    """Latency percentiles in milliseconds of ``fn`` over ``inputs``"""
+    inputs = list(inputs)
+    for value in inputs[:warmup]:
+        fn(value)
+    samples = []
+    for value in inputs:
+        start = time.perf_counter()
+        fn(value)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'p50_ms': round(samples[len(samples) // 2], 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+    }
+
+
+def print_table(rows: List[Dict[str, Any]], columns: Sequence[str]):
+    widths = {column: max(len(column), *(len(str(row.get(column, ''))) for row in rows)) for column in columns}
+    print('  '.join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print('  '.join(str(row.get(column, '')).ljust(widths[column]) for column in columns))
+
+
+def write_json(path: str, payload: Dict[str, Any]):
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
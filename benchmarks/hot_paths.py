@@ -0,0 +1,208 @@
+"""Throughput, latency percentiles and peak RSS of the ingestion and retrieval hot paths.
+
+Covers ``EmbeddingManager.chunk_text``, ``FAISSDriver.add_embeddings``,
+``search`` and ``rebuild_index`` and a full ``RAGPipeline.query``. Runs
+offline against a throwaway SQLite database and index directory
+(``benchmarks.offline_settings``) with a seeded synthetic corpus and the
+local model backend (``LLM_BACKEND=local``), so no services or API keys
+are needed and two runs of the same commit see the same data.
+
+    python -m benchmarks.hot_paths --textbooks 16 --paragraphs 150 --json after.json
+    python -m benchmarks.hot_paths --compare before.json after.json --threshold 0.15
+
+Compare mode prints every metric side by side and exits with status 1 if
+any latency or peak RSS grew, or any throughput fell, by more than the
+threshold. Small corpora finish in milliseconds and are noisy; compare
+runs of the default size or larger, made on the same idle machine.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import time
+
+from benchmarks.common import print_table, setup_django, time_calls, write_json
+from benchmarks.synthetic import SyntheticCorpus
+
+CASES = ['chunk_text', 'add_embeddings', 'search', 'rebuild_index', 'rag_query']
+
+
+def peak_rss_mb() -> float:
+    """High-water mark of this process's resident memory so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+
+def per_second(count: int, timings) -> float:
+    return round(count / max(timings['mean_ms'], 1e-9) * 1000, 1)
+
+
+def run(args):
+    os.environ['DJANGO_SETTINGS_MODULE'] = args.settings
+    setup_django()
+    import faiss
+    import numpy as np
+    from django.conf import settings
+    from django.core.management import call_command
+    from context.embedding_manager import EmbeddingManager
+    from context.rag_pipeline import RAGPipeline
+    from knowledge_base.models import ContentChunk, Grade, Subject, TextbookContent
+    from protocol.faiss_driver import FAISSDriver
+    from protocol.llm_client import LLMClient
+
+    call_command('migrate', verbosity=0, interactive=False)
+    corpus = SyntheticCorpus(seed=args.seed)
+    client = LLMClient()
+    rows = []
+
+    # chunk_text: one call per textbook
+    manager = EmbeddingManager()
+    texts = [corpus.textbook(i, args.paragraphs) for i in range(args.textbooks)]
+    chunked = [manager.chunk_text(text, settings.CHUNK_SIZE, settings.CHUNK_OVERLAP) for text in texts]
+    timings = time_calls(lambda text: manager.chunk_text(text, settings.CHUNK_SIZE, settings.CHUNK_OVERLAP),
+                         texts, warmup=1)
+    chunk_count = sum(len(chunks) for chunks in chunked)
+    rows.append(dict(
+        timings, case='chunk_text', calls=len(texts),
+        mb_per_s=round(sum(len(text) for text in texts) / len(texts) / 2 ** 20 / timings['mean_ms'] * 1000, 2),
+        chunks_per_s=per_second(chunk_count / len(texts), timings),
+        peak_rss_mb=peak_rss_mb(),
+    ))
+
+    # add_embeddings: append each textbook's vectors and write a snapshot, as the index writer does
+    grade, _ = Grade.objects.get_or_create(level='8')
+    batches = []
+    for i, chunks in enumerate(chunked):
+        subject, _ = Subject.objects.get_or_create(name=corpus.subject(i))
+        textbook = TextbookContent.objects.create(
+            title=f'Synthetic {i}', subject=subject, grade=grade, file=f'synthetic/{i}.txt',
+            content_text=texts[i], is_processed=True, processing_status='completed', chunk_count=len(chunks)
+        )
+        embeddings = client.generate_batch_embeddings([chunk['text'] for chunk in chunks])
+        ContentChunk.objects.bulk_create([
+            ContentChunk(
+                textbook=textbook, chunk_text=chunk['text'], chunk_index=index,
+                start_char=chunk['start'], end_char=chunk['end'], embedding_vector=embedding
+            )
+            for index, (chunk, embedding) in enumerate(zip(chunks, embeddings))
+        ])
+        batches.append((str(textbook.id), embeddings))
+    driver = FAISSDriver()
+    timings = time_calls(lambda batch: driver.add_embeddings(*batch), batches, warmup=0)
+    rows.append(dict(
+        timings, case='add_embeddings', calls=len(batches),
+        vectors_per_s=per_second(chunk_count / len(batches), timings),
+        peak_rss_mb=peak_rss_mb(),
+    ))
+
+    # search: single queries against the whole corpus
+    questions = corpus.questions(args.queries)
+    query_embeddings = [client.generate_embedding(question) for question in questions]
+    timings = time_calls(lambda embedding: driver.search(embedding, top_k=args.top_k), query_embeddings)
+    rows.append(dict(
+        timings, case='search', calls=len(query_embeddings),
+        queries_per_s=per_second(1, timings),
+        peak_rss_mb=peak_rss_mb(),
+    ))
+
+    # rebuild_index: read every embedding back from the database and write a fresh snapshot
+    timings = time_calls(lambda _: driver.rebuild_index(), range(args.rebuilds), warmup=0)
+    rows.append(dict(
+        timings, case='rebuild_index', calls=args.rebuilds,
+        vectors_per_s=per_second(driver.ntotal, timings),
+        peak_rss_mb=peak_rss_mb(),
+    ))
+
+    # rag_query: the whole request path, with the local backend standing in for the model API
+    pipeline = RAGPipeline()
+    timings = time_calls(lambda question: pipeline.query(question, top_k=args.top_k), questions)
+    rows.append(dict(
+        timings, case='rag_query', calls=len(questions),
+        queries_per_s=per_second(1, timings),
+        peak_rss_mb=peak_rss_mb(),
+    ))
+
+    print_table(rows, ['case', 'calls', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb'])
+    if args.json:
+        write_json(args.json, {
+            'benchmark': 'hot_paths',
+            'args': {key: value for key, value in vars(args).items() if key != 'compare'},
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'faiss': faiss.__version__,
+                'numpy': np.__version__,
+                'vectors': driver.ntotal,
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'results': rows,
+        })
+    shutil.rmtree(getattr(settings, 'BENCHMARK_DIR', ''), ignore_errors=True)
+
+
+def lower_is_better(metric: str):
+    """True/False for metrics that are compared, None for counts and labels"""
+    if metric.endswith('_ms') or metric == 'peak_rss_mb':
+        return True
+    if metric.endswith('_per_s'):
+        return False
+    return None
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> int:
+    with open(baseline_path) as f:
+        baseline = {row['case']: row for row in json.load(f)['results']}
+    with open(current_path) as f:
+        current = {row['case']: row for row in json.load(f)['results']}
+
+    rows = []
+    regressions = 0
+    for case in CASES:
+        if case not in baseline or case not in current:
+            continue
+        for metric, before in baseline[case].items():
+            lower = lower_is_better(metric)
+            after = current[case].get(metric)
+            if lower is None or after is None or not before:
+                continue
+            change = (after - before) / before
+            worse = change > threshold if lower else change < -threshold
+            better = change < -threshold if lower else change > threshold
+            regressions += worse
+            rows.append({
+                'case': case, 'metric': metric, 'baseline': before, 'current': after,
+                'change': f"{change:+.1%}", 'verdict': 'REGRESSION' if worse else 'improved' if better else '',
+            })
+
+    print_table(rows, ['case', 'metric', 'baseline', 'current', 'change', 'verdict'])
+    print(f"\n{regressions} regression(s) beyond {threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--textbooks', type=int, default=16)
+    parser.add_argument('--paragraphs', type=int, default=150, help='Paragraphs per synthetic textbook')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--rebuilds', type=int, default=3)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--settings', default='benchmarks.offline_settings')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two --json result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Relative change counted as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold))
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
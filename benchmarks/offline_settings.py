@@ -0,0 +1,36 @@
+"""Self-contained settings for ``benchmarks.hot_paths``: no Postgres, Redis, broker or API keys.
+
+Everything the benchmark writes (SQLite database, index snapshots) goes
+to a fresh temporary directory, so runs never touch real data.
+"""
+import os
+import tempfile
+
+from rag_tutor.settings import *  # noqa: F401,F403
+
+BENCHMARK_DIR = tempfile.mkdtemp(prefix='rag_tutor_bench_')
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARK_DIR, 'bench.sqlite3'),
+    }
+}
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_BROKER_URL = 'memory://'
+CELERY_RESULT_BACKEND = 'cache+memory://'
+
+VECTOR_DB_PATH = os.path.join(BENCHMARK_DIR, 'vector_db')
+FAISS_INDEX_PATH = os.path.join(VECTOR_DB_PATH, 'faiss_index')
+FAISS_SNAPSHOT_DIR = os.path.join(VECTOR_DB_PATH, 'snapshots')
+FAISS_SHARD_DIR = os.path.join(VECTOR_DB_PATH, 'shards')
+FAISS_SHARD_COUNT = 1
+
+# Deterministic local embeddings and canned answers instead of the Gemini API
+LLM_BACKEND = 'local'
+
+# No background metric writes or trace payloads during timed runs
+RAG_METRICS_FLUSH_INTERVAL = 0
+RAG_TRACE_SAMPLE_RATE = 0.0
@@ -0,0 +1,98 @@
+"""Recall@k and latency of PCA-reduced FAISS indexes at decreasing dimensions.
+
+Vectors are projected the way FAISSDriver does it (normalise, PCA,
+re-normalise) and searched through ``search_reranked``, with and without
+exact re-ranking on the memory-mapped original vectors. Recall is measured
+against an exact flat index at the full embedding dimension. The synthetic
+clusters have isotropic noise, a worst case for PCA; ``--from-database``
+measures the stored embeddings instead, holding out some as queries.
+
+    python -m benchmarks.pca_dimensions --vectors 200000 --dims 768 384 256 128
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from benchmarks.common import (clustered_unit_vectors, database_vectors, index_nbytes, print_table, recall_at_k,
+                               setup_django, time_calls, write_json)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--dims', type=int, nargs='+', default=[768, 384, 256, 128])
+    parser.add_argument('--index-type', default='flat', help='flat, sqfp16, sq8 or pq after the projection')
+    parser.add_argument('--pq-m', type=int, default=32)
+    parser.add_argument('--rerank-factor', type=int, default=10)
+    parser.add_argument('--train-sample', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--from-database', action='store_true', help='Use stored chunk embeddings instead of synthetic ones')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH')
+    args = parser.parse_args()
+
+    setup_django()
+    from protocol.faiss_driver import new_quantized_index, project, search_reranked, train_pca
+
+    if args.from_database:
+        stored = database_vectors(args.vectors + args.queries)
+        vectors, queries = stored[args.queries:], stored[:args.queries]
+        args.dimension = vectors.shape[1]
+    else:
+        vectors = clustered_unit_vectors(args.vectors, args.dimension, seed=1)
+        queries = clustered_unit_vectors(args.queries, args.dimension, seed=2)
+    exact = faiss.IndexFlatIP(args.dimension)
+    exact.add(vectors)
+    _, expected = exact.search(queries, args.top_k)
+
+    workdir = tempfile.mkdtemp(prefix='faiss-pca-')
+    vectors_path = os.path.join(workdir, 'vectors.npy')
+    np.save(vectors_path, vectors)
+    mapped = np.load(vectors_path, mmap_mode='r')
+    sample = vectors[np.random.default_rng(0).choice(len(vectors), min(len(vectors), args.train_sample), replace=False)]
+
+    rows = []
+    for dim in args.dims:
+        start = time.perf_counter()
+        pca = train_pca(sample, dim) if dim < args.dimension else None
+        projected = project(pca, vectors)
+        if args.index_type == 'flat':
+            index = faiss.IndexFlatIP(projected.shape[1])
+        else:
+            index = new_quantized_index(args.index_type, projected.shape[1], args.pq_m)
+            if not index.is_trained:
+                index.train(project(pca, sample))
+        index.add(projected)
+        build_s = time.perf_counter() - start
+
+        lossless = pca is None and args.index_type == 'flat'
+        modes = [('exact', None)] if lossless else [('none', None), ('exact', mapped)]
+        for rerank, rerank_vectors in modes:
+            def search(query, index=index, rerank_vectors=rerank_vectors, pca=pca):
+                return search_reranked(index, rerank_vectors, query[None, :], args.top_k, args.rerank_factor, pca)[1]
+
+            timings = time_calls(search, queries)
+            found = [search(query).tolist() for query in queries]
+            rows.append(dict(
+                timings,
+                dims=dim,
+                rerank=rerank,
+                index_mb=round(index_nbytes(index) / 2 ** 20, 1),
+                build_s=round(build_s, 2),
+                recall=recall_at_k(found, expected.tolist()),
+            ))
+
+    print_table(rows, ['dims', 'rerank', 'index_mb', 'build_s', 'mean_ms', 'p95_ms', 'recall'])
+    shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        write_json(args.json, {'benchmark': 'pca_dimensions', 'args': vars(args), 'results': rows})
+
+
+if __name__ == '__main__':
+    main()
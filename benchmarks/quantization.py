@@ -0,0 +1,90 @@
+"""Memory, build time, latency and recall@k of the FAISS index types.
+
+Each type is built the way FAISSDriver builds it (train on a sample, add
+all vectors) and searched through ``search_reranked``, with and without
+exact re-ranking on a memory-mapped full-precision copy. Recall is
+measured against an exact flat index over the same vectors.
+
+    python -m benchmarks.quantization --vectors 200000 --types flat sqfp16 sq8 pq
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from benchmarks.common import (clustered_unit_vectors, index_nbytes, print_table, recall_at_k, setup_django,
+                               time_calls, write_json)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--types', nargs='+', default=['flat', 'sqfp16', 'sq8', 'pq'])
+    parser.add_argument('--pq-m', type=int, default=96)
+    parser.add_argument('--rerank-factor', type=int, default=10)
+    parser.add_argument('--train-sample', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH')
+    args = parser.parse_args()
+
+    setup_django()
+    from protocol.faiss_driver import new_quantized_index, search_reranked
+
+    vectors = clustered_unit_vectors(args.vectors, args.dimension, seed=1)
+    queries = clustered_unit_vectors(args.queries, args.dimension, seed=2)
+    exact = faiss.IndexFlatIP(args.dimension)
+    exact.add(vectors)
+    _, expected = exact.search(queries, args.top_k)
+
+    # The re-rank copy is read through a memory map, as from a snapshot
+    workdir = tempfile.mkdtemp(prefix='faiss-quant-')
+    vectors_path = os.path.join(workdir, 'vectors.npy')
+    np.save(vectors_path, vectors)
+    mapped = np.load(vectors_path, mmap_mode='r')
+
+    rows = []
+    for index_type in args.types:
+        start = time.perf_counter()
+        if index_type == 'flat':
+            index = faiss.IndexFlatIP(args.dimension)
+        else:
+            index = new_quantized_index(index_type, args.dimension, args.pq_m)
+            if not index.is_trained:
+                rng = np.random.default_rng(0)
+                sample = vectors[rng.choice(len(vectors), min(len(vectors), args.train_sample), replace=False)]
+                index.train(sample)
+        index.add(vectors)
+        build_s = time.perf_counter() - start
+
+        modes = [('exact', None)] if index_type == 'flat' else [('none', None), ('exact', mapped)]
+        for rerank, rerank_vectors in modes:
+            def search(query, index=index, rerank_vectors=rerank_vectors):
+                return search_reranked(index, rerank_vectors, query[None, :], args.top_k, args.rerank_factor)[1]
+
+            timings = time_calls(search, queries)
+            found = [search(query).tolist() for query in queries]
+            rows.append(dict(
+                timings,
+                type=index_type,
+                rerank=rerank,
+                index_mb=round(index_nbytes(index) / 2 ** 20, 1),
+                bytes_per_vector=index.sa_code_size(),
+                build_s=round(build_s, 2),
+                recall=recall_at_k(found, expected.tolist()),
+            ))
+
+    print_table(rows, ['type', 'rerank', 'index_mb', 'bytes_per_vector', 'build_s', 'mean_ms', 'p95_ms', 'recall'])
+    print(f"Re-rank vectors on disk (memory-mapped, not resident): {os.path.getsize(vectors_path) / 2 ** 20:.1f} MB")
+    shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        write_json(args.json, {'benchmark': 'quantization', 'args': vars(args), 'results': rows})
+
+
+if __name__ == '__main__':
+    main()
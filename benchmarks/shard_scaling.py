@@ -0,0 +1,96 @@
+"""Scatter-gather latency and per-shard memory of ShardedFAISSDriver as the shard count grows.
+
+Synthetic vectors are hash-partitioned into in-memory shards and searched
+through ``ShardedFAISSDriver.search`` with the local thread-pool backend,
+so the timings include the real scatter, merge and result shaping. Each
+merged top-k is checked against a single unsharded index.
+
+    python -m benchmarks.shard_scaling --vectors 200000 --shards 1 2 4 8
+"""
+import argparse
+import zlib
+
+import faiss
+import numpy as np
+
+from benchmarks.common import index_nbytes, print_table, random_unit_vectors, setup_django, time_calls, write_json
+
+
+class ArrayShard:
+    """In-memory stand-in for one shard's FAISSDriver, returning the same result shape"""
+
+    def __init__(self, vectors: np.ndarray, ids: np.ndarray):
+        self.index = faiss.IndexFlatIP(vectors.shape[1])
+        self.index.add(vectors)
+        self.ids = ids
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def search(self, query_embedding, top_k=5, filters=None, with_vectors=False, neighbor_window=0):
+        query = np.array([query_embedding], dtype=np.float32)
+        scores, positions = self.index.search(query, min(top_k, self.index.ntotal))
+        return [
+            {'id': int(self.ids[position]), 'score': float(score), 'metadata': {}}
+            for score, position in zip(scores[0], positions[0]) if position != -1
+        ]
+
+
+def build_shards(vectors: np.ndarray, shard_count: int):
+    owners = np.array([zlib.crc32(str(i).encode()) % shard_count for i in range(len(vectors))])
+    ids = np.arange(len(vectors))
+    return [ArrayShard(vectors[owners == n], ids[owners == n]) for n in range(shard_count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--omp-threads', type=int, help='FAISS OpenMP threads per search (default: FAISS default)')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH')
+    args = parser.parse_args()
+
+    setup_django()
+    from protocol.faiss_shards import ShardedFAISSDriver
+
+    if args.omp_threads:
+        faiss.omp_set_num_threads(args.omp_threads)
+
+    vectors = random_unit_vectors(args.vectors, args.dimension, seed=1)
+    queries = random_unit_vectors(args.queries, args.dimension, seed=2)
+    reference = faiss.IndexFlatIP(args.dimension)
+    reference.add(vectors)
+    _, expected = reference.search(queries, args.top_k)
+
+    rows = []
+    for shard_count in args.shards:
+        shards = build_shards(vectors, shard_count)
+        driver = ShardedFAISSDriver(shards=shards, backend='local')
+        query_lists = [query.tolist() for query in queries]
+
+        timings = time_calls(lambda query: driver.search(query, top_k=args.top_k), query_lists)
+        matches = sum(
+            set(hit['id'] for hit in driver.search(query, top_k=args.top_k)) == set(expected[i].tolist())
+            for i, query in enumerate(query_lists)
+        )
+        shard_bytes = [index_nbytes(shard.index) for shard in shards]
+        rows.append(dict(
+            timings,
+            shards=shard_count,
+            max_shard_vectors=max(shard.ntotal for shard in shards),
+            max_shard_mb=round(max(shard_bytes) / 2 ** 20, 1),
+            total_mb=round(sum(shard_bytes) / 2 ** 20, 1),
+            exact_topk=f"{matches}/{len(query_lists)}",
+        ))
+
+    print_table(rows, ['shards', 'max_shard_vectors', 'max_shard_mb', 'total_mb', 'mean_ms', 'p50_ms', 'p95_ms', 'exact_topk'])
+    if args.json:
+        write_json(args.json, {'benchmark': 'shard_scaling', 'args': vars(args), 'results': rows})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Deterministic synthetic corpus for offline benchmarks"""
+import random
+from typing import List
+
+SUBJECTS = ['Mathematics', 'Physics', 'Chemistry', 'Biology', 'History', 'Geography', 'Literature', 'Economics']
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'da', 'fe', 'gu', 'ha', 'jo', 'pi', 'ter', 'on', 'ix']
+COMMON_WORDS = ['the', 'of', 'and', 'a', 'is', 'in', 'to', 'that', 'which', 'with', 'from', 'by', 'as', 'are']
+
+
+def _vocabulary(rng: random.Random, size: int) -> List[str]:
+    return [''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+
+class SyntheticCorpus:
+    """Textbooks of generated prose, one topical vocabulary per subject.
+
+    The same seed always yields the same text, so timings and retrieval
+    results are comparable between runs and machines.
+    """
+
+    def __init__(self, seed: int = 0, words_per_subject: int = 400):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.vocabularies = {subject: _vocabulary(rng, words_per_subject) for subject in SUBJECTS}
+
+    def subject(self, index: int) -> str:
+        return SUBJECTS[index % len(SUBJECTS)]
+
+    def sentence(self, rng: random.Random, subject: str) -> str:
+        words = [
+            rng.choice(COMMON_WORDS) if rng.random() < 0.3 else rng.choice(self.vocabularies[subject])
+            for _ in range(rng.randint(8, 24))
+        ]
+        return ' '.join(words).capitalize() + '.'
+
+    def textbook(self, index: int, paragraphs: int = 100) -> str:
+        rng = random.Random(self.seed * 1000003 + index)
+        subject = self.subject(index)
+        return '\n\n'.join(
+            ' '.join(self.sentence(rng, subject) for _ in range(rng.randint(3, 8)))
+            for _ in range(paragraphs)
+        )
+
+    def questions(self, count: int) -> List[str]:
+        rng = random.Random(self.seed + 7)
+        return [
+            f"What is {' '.join(rng.sample(self.vocabularies[self.subject(i)], 3))}?"
+            for i in range(count)
+        ]
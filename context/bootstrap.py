@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger('rag_tutor')
+
+
+class PipelineUnavailable(Exception):
+    """Raised when the pipeline components could not be loaded in this process"""
+
+
+class PipelineBootstrap:
+    """Process-local readiness state machine for the RAG pipeline.
+
+    The Gemini client, FAISS index and re-ranker model are loaded once per
+    process, either lazily under a lock on first use or eagerly at startup
+    via ``warm()``.
+    Nothing here depends on the shared cache, so flushing Redis never makes
+    the question API unavailable. When the index on disk changes version the
+    replacement is loaded off to the side and swapped in, so requests keep
+    being served by the previous snapshot while the reload runs.
+    """
+
+    COLD = 'cold'
+    LOADING = 'loading'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = self.COLD
+        self.gemini_client = None
+        self.faiss_driver = None
+        self.loaded_at = None
+        self.load_time_ms = None
+        self.last_error = None
+        self._last_version_check = 0.0
+
+    def get(self) -> Tuple[Any, Any]:
+        """Return (gemini_client, faiss_driver), loading them on first use"""
+        if self.state != self.READY:
+            with self._lock:
+                if self.state != self.READY:
+                    self._load()
+        else:
+            self._reload_if_stale()
+        return self.gemini_client, self.faiss_driver
+
+    def warm(self) -> bool:
+        """Eagerly load the pipeline; never raises so it is safe at startup"""
+        try:
+            self.get()
+            return True
+        except PipelineUnavailable as e:
+            logger.error(f"RAG pipeline warm-up failed: {str(e)}")
+            return False
+
+    def status(self) -> Dict[str, Any]:
+        """Snapshot of the readiness state for health endpoints"""
+        driver = self.faiss_driver
+        return {
+            'state': self.state,
+            'index_version': getattr(driver, 'version', None),
+            'vector_count': driver.ntotal if driver is not None else 0,
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'load_time_ms': self.load_time_ms,
+            'last_error': self.last_error,
+        }
+
+    def _load(self, gemini_client: Optional[Any] = None):
+        """Build the components; caller must hold the lock"""
+        from protocol.llm_client import LLMClient
+        from protocol.faiss_shards import get_faiss_driver
+
+        # A reload leaves the state at READY so other threads keep serving
+        if self.state != self.READY:
+            self.state = self.LOADING
+        start_time = time.time()
+        try:
+            gemini_client = gemini_client or LLMClient()
+            faiss_driver = get_faiss_driver()
+            self._warm_reranker()
+        except Exception as e:
+            self.last_error = str(e)
+            if self.state == self.LOADING:
+                self.state = self.FAILED
+            logger.error(f"RAG pipeline load failed: {str(e)}", exc_info=True)
+            raise PipelineUnavailable(str(e)) from e
+
+        self.gemini_client = gemini_client
+        self.faiss_driver = faiss_driver
+        self.load_time_ms = int((time.time() - start_time) * 1000)
+        self.loaded_at = timezone.now()
+        self.last_error = None
+        self._last_version_check = time.monotonic()
+        self.state = self.READY
+        logger.info(
+            f"RAG pipeline ready in {self.load_time_ms}ms "
+            f"(index version {faiss_driver.version}, {faiss_driver.ntotal} vectors)"
+        )
+
+    def _warm_reranker(self):
+        """Load the re-ranker model now, not inside the first requests' scoring timeout"""
+        from context.reranker import get_reranker
+        reranker = get_reranker()
+        if reranker is None:
+            return
+        try:
+            reranker.warm()
+        except Exception as e:
+            # Searches still work in vector order; the first re-rank retries the load
+            logger.error(f"{reranker.name} re-ranker failed to load: {str(e)}")
+
+    def _reload_if_stale(self):
+        """Swap in a fresh index when a different snapshot has been promoted"""
+        now = time.monotonic()
+        if now - self._last_version_check < settings.RAG_INDEX_CHECK_INTERVAL:
+            return
+        self._last_version_check = now
+
+        driver = self.faiss_driver
+        if driver is None or not driver.is_stale():
+            return
+        # Only one thread reloads; the others keep using the current index
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self.faiss_driver.is_stale():
+                logger.info(f"FAISS snapshot {self.faiss_driver.disk_version()} promoted, reloading")
+                self._load(gemini_client=self.gemini_client)
+        except PipelineUnavailable:
+            # Keep serving the index that is already loaded
+            pass
+        finally:
+            self._lock.release()
+
+
+pipeline_bootstrap = PipelineBootstrap()
+
+
+def get_pipeline_components() -> Tuple[Any, Any]:
+    """Return the process-local (gemini_client, faiss_driver) pair"""
+    return pipeline_bootstrap.get()
@@ -1,8 +1,15 @@
-from typing import List, Dict, Any
+from collections import Counter
+from typing import List, Dict, Any, Optional
 from django.conf import settings
+import hashlib
+import numpy as np
 import tiktoken
 import re
 
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4  # LSH bands of 16 bits: signatures up to 3 bits apart share at least one
+SIMHASH_MIN_WORDS = 8  # Shorter texts have too few features for a stable signature
+
 class EmbeddingManager:
     def __init__(self):
         self.tokenizer = tiktoken.get_encoding("cl100k_base")
@@ -78,4 +85,35 @@ class EmbeddingManager:
             return text
         
         overlap_tokens = tokens[-overlap_size:]
-        return self.tokenizer.decode(overlap_tokens)
\ No newline at end of file
+        return self.tokenizer.decode(overlap_tokens)
+    
+    def simhash(self, text: str) -> Optional[int]:
+        """64-bit SimHash of the text's words and word pairs, or None if the text is too short.
+        
+        Each bit is the count-weighted vote of that bit over the feature
+        hashes, so texts differing in a few words get signatures a few bits
+        apart. Returned signed, as it is stored in a BigIntegerField.
+        """
+        words = re.findall(r'\w+', text.lower())
+        if len(words) < SIMHASH_MIN_WORDS:
+            return None
+        features = Counter(words)
+        features.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+        digests = b''.join(hashlib.blake2b(feature.encode(), digest_size=8).digest() for feature in features)
+        bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, SIMHASH_BITS // 8), axis=1)
+        weights = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+        votes = weights @ (bits.astype(np.float32) * 2 - 1)
+        signature = int.from_bytes(np.packbits(votes > 0).tobytes(), 'big')
+        return signature - (1 << SIMHASH_BITS) if signature >= 1 << (SIMHASH_BITS - 1) else signature
+    
+    @staticmethod
+    def simhash_bands(signature: int) -> List[int]:
+        """The signature split into SIMHASH_BANDS band values, the LSH table keys"""
+        width = SIMHASH_BITS // SIMHASH_BANDS
+        unsigned = signature % (1 << SIMHASH_BITS)
+        return [(unsigned >> (band * width)) & ((1 << width) - 1) for band in range(SIMHASH_BANDS)]
+    
+    @staticmethod
+    def simhash_distance(first: int, second: int) -> int:
+        """Number of differing bits between two signatures"""
+        return bin((first ^ second) % (1 << SIMHASH_BITS)).count('1')
@@ -0,0 +1,397 @@
+import atexit
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, connections
+
+from knowledge_base.models import SystemMetrics
+
+logger = logging.getLogger('rag_tutor')
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Log-linear buckets over whole microseconds: exact below 2**SUB_BITS, then
+# 2**(SUB_BITS - 1) buckets per power of two, i.e. within 1/64 (~1.6%) of the value
+SUB_BITS = 7
+HALF_SUB = 1 << (SUB_BITS - 1)
+MAX_MICROS = (1 << 32) - 1  # ~72 minutes; slower samples are clamped
+BUCKETS = (32 - SUB_BITS + 2) * HALF_SUB
+
+
+class StageTimer:
+    """Wall-clock time and SQL round trips spent in each named stage of one request.
+
+    Usage::
+
+        timer = StageTimer()
+        with timer.stage('retrieve'):
+            ...
+        timer.as_dict()       # {'retrieve_ms': 12.3, 'total_ms': 12.4}
+        timer.sql_as_dict()   # {'retrieve': 0, 'total': 0, 'total_ms': 0.0}
+
+    Queries are counted with a database execute wrapper installed for the
+    duration of each stage, so stages should not be nested.
+    """
+
+    def __init__(self, sql_budget: Optional[int] = None):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.queries: Dict[str, int] = {}
+        self.query_ms: Dict[str, float] = {}
+        self.sql_budget = sql_budget
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self._counter(name)):
+                yield
+        finally:
+            # Repeated stages (e.g. a retry without filters) accumulate
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def _counter(self, name: str):
+        def count_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                self.queries[name] = self.queries.get(name, 0) + 1
+                self.query_ms[name] = self.query_ms.get(name, 0.0) + (time.perf_counter() - start) * 1000
+        return count_query
+
+    @property
+    def query_count(self) -> int:
+        return sum(self.queries.values())
+
+    def as_dict(self) -> Dict[str, float]:
+        timings = {f"{name}_ms": round(ms, 2) for name, ms in self.stages.items()}
+        timings['total_ms'] = round((time.perf_counter() - self.started) * 1000, 2)
+        return timings
+
+    def sql_as_dict(self) -> Dict[str, float]:
+        """Queries per stage that ran any, plus the total count and time spent in the database"""
+        counts = dict(self.queries)
+        counts['total'] = self.query_count
+        counts['total_ms'] = round(sum(self.query_ms.values()), 2)
+        return counts
+
+    def log(self, label: str):
+        stage_latencies.record_all(self.stages, (time.perf_counter() - self.started) * 1000)
+        logger.info(f"{label} stage timings: {self.as_dict()}, SQL: {self.sql_as_dict()}")
+        if self.sql_budget is not None and self.query_count > self.sql_budget:
+            logger.warning(
+                f"{label} ran {self.query_count} SQL queries, over its budget of {self.sql_budget}: {self.queries}"
+            )
+
+
+def _bucket(micros: int) -> int:
+    if micros < 2 * HALF_SUB:
+        return micros
+    shift = micros.bit_length() - SUB_BITS
+    return (shift + 1) * HALF_SUB + (micros >> shift) - HALF_SUB
+
+
+def _bucket_middle(index: int) -> float:
+    """Midpoint of a bucket's value range, in microseconds"""
+    if index < 2 * HALF_SUB:
+        return float(index)
+    shift = index // HALF_SUB - 1
+    low = (index % HALF_SUB + HALF_SUB) << shift
+    return low + ((1 << shift) - 1) / 2
+
+
+class LatencyHistogram:
+    """HDR-style latency histogram: fixed log-linear buckets, ~1.6% precision from 1µs to an hour.
+
+    Recording is one list increment, so a histogram written by a single
+    thread needs no lock; readers work on ``copy()``/``merge()`` results.
+    """
+
+    def __init__(self):
+        self.counts: List[int] = [0] * BUCKETS
+        self.count = 0
+        self.sum_ms = 0.0
+
+    def record(self, ms: float):
+        micros = min(max(int(ms * 1000), 0), MAX_MICROS)
+        self.counts[_bucket(micros)] += 1
+        self.count += 1
+        self.sum_ms += ms
+
+    def merge(self, other: 'LatencyHistogram') -> 'LatencyHistogram':
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum_ms += other.sum_ms
+        return self
+
+    def copy(self) -> 'LatencyHistogram':
+        return LatencyHistogram().merge(self)
+
+    def since(self, earlier: 'LatencyHistogram') -> 'LatencyHistogram':
+        """Samples recorded after ``earlier`` was copied from this histogram"""
+        delta = LatencyHistogram()
+        delta.counts = [now - then for now, then in zip(self.counts, earlier.counts)]
+        delta.count = self.count - earlier.count
+        delta.sum_ms = self.sum_ms - earlier.sum_ms
+        return delta
+
+    def percentile(self, quantile: float) -> float:
+        """Latency in ms below which ``quantile`` of the samples fall"""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(quantile * self.count))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return _bucket_middle(index) / 1000
+        return MAX_MICROS / 1000
+
+
+class StageLatencies:
+    """Process-wide latency histograms per pipeline stage.
+
+    Each thread records into its own set of histograms, so the request
+    path never takes a lock; the lock only guards registering a thread's
+    first sample and readers merging all threads. Histograms of finished
+    threads are folded into a retired set so short-lived threads (the dev
+    server starts one per request) do not accumulate.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads: List[tuple] = []
+        self._retired: Dict[str, LatencyHistogram] = {}
+
+    def record_all(self, stages: Dict[str, float], total_ms: Optional[float]):
+        histograms = self._thread_histograms()
+        if total_ms is not None:
+            stages = dict(stages, total=total_ms)
+        for name, ms in stages.items():
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = LatencyHistogram()
+            histogram.record(ms)
+        metrics_flusher.ensure_started()
+
+    def record(self, name: str, ms: float):
+        """Record one sample of a single stage"""
+        self.record_all({name: ms}, None)
+
+    def percentile(self, name: str, quantile: float) -> Tuple[int, float]:
+        """(sample count, latency at ``quantile``) of one stage across all threads"""
+        merged = LatencyHistogram()
+        with self._lock:
+            for histograms in [self._retired] + [owned for _, owned in self._threads]:
+                histogram = histograms.get(name)
+                if histogram is not None:
+                    merged.merge(histogram)
+        return merged.count, merged.percentile(quantile)
+
+    def _thread_histograms(self) -> Dict[str, LatencyHistogram]:
+        histograms = getattr(self._local, 'histograms', None)
+        if histograms is None:
+            histograms = self._local.histograms = {}
+            with self._lock:
+                live = []
+                for thread, owned in self._threads:
+                    if thread.is_alive():
+                        live.append((thread, owned))
+                    else:
+                        self._fold(self._retired, owned)
+                live.append((threading.current_thread(), histograms))
+                self._threads = live
+        return histograms
+
+    def snapshot(self) -> Dict[str, LatencyHistogram]:
+        """Merged copy of every thread's histograms, by stage"""
+        with self._lock:
+            merged = {name: histogram.copy() for name, histogram in self._retired.items()}
+            for _, owned in self._threads:
+                self._fold(merged, dict(owned))
+        return merged
+
+    @staticmethod
+    def _fold(target: Dict[str, LatencyHistogram], histograms: Dict[str, LatencyHistogram]):
+        for name, histogram in histograms.items():
+            if name in target:
+                target[name].merge(histogram)
+            else:
+                target[name] = histogram.copy()
+
+
+stage_latencies = StageLatencies()
+
+
+class HedgeStats:
+    """Process-wide counts of LLM chat calls by persona and how they were answered.
+
+    ``requests`` counts every call; ``hedged`` those that fired a second
+    request because the first had no token by the deadline, ``fallback``
+    those that fired it because the first failed, ``hedge_won`` those the
+    second request answered and ``failed`` those no request answered.
+    Personas are the buckets whose first-token latencies set the hedge
+    deadline; calls without a known persona count under ``default``.
+    """
+
+    OUTCOMES = ('requests', 'hedged', 'fallback', 'hedge_won', 'failed')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    def count(self, persona: Optional[str], *outcomes: str):
+        with self._lock:
+            counts = self.counts.setdefault(persona or 'default', dict.fromkeys(self.OUTCOMES, 0))
+            for outcome in outcomes:
+                counts[outcome] += 1
+
+    def by_persona(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {persona: dict(counts) for persona, counts in self.counts.items()}
+
+    def snapshot(self) -> Dict[str, int]:
+        """Counts summed over personas"""
+        totals = dict.fromkeys(self.OUTCOMES, 0)
+        for counts in self.by_persona().values():
+            for outcome, count in counts.items():
+                totals[outcome] += count
+        return totals
+
+
+hedge_stats = HedgeStats()
+
+
+class MetricsFlusher:
+    """Background thread writing per-stage percentiles to ``SystemMetrics``.
+
+    Every ``RAG_METRICS_FLUSH_INTERVAL`` seconds it stores p50/p95/p99 and
+    the sample count of each stage over the interval just ended, tagged
+    with the process id. Started by the first recorded query in each
+    process (so never in a pre-fork master), and flushed once more on exit.
+    """
+
+    def __init__(self, latencies: StageLatencies, hedges: HedgeStats):
+        self.latencies = latencies
+        self.hedges = hedges
+        self.previous: Dict[str, LatencyHistogram] = {}
+        self.previous_hedges: Dict[str, Dict[str, int]] = {}
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self.pid == os.getpid() or settings.RAG_METRICS_FLUSH_INTERVAL <= 0:
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self._run, name='metrics-flusher', daemon=True).start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(settings.RAG_METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self) -> int:
+        """Write the interval's percentiles; returns the number of rows stored"""
+        with self._lock:
+            current = self.latencies.snapshot()
+            rows = []
+            for stage, histogram in current.items():
+                window = histogram.since(self.previous[stage]) if stage in self.previous else histogram
+                if not window.count:
+                    continue
+                tags = {'stage': stage, 'pid': os.getpid(), 'count': window.count}
+                rows.extend(
+                    SystemMetrics(
+                        metric_name=f"rag_stage_latency_p{round(quantile * 100)}",
+                        metric_value=round(window.percentile(quantile), 3),
+                        metric_unit='ms',
+                        tags=tags
+                    )
+                    for quantile in QUANTILES
+                )
+            hedges = self.hedges.by_persona()
+            for persona, counts in sorted(hedges.items()):
+                previous = self.previous_hedges.get(persona, {})
+                window = {outcome: count - previous.get(outcome, 0) for outcome, count in counts.items()}
+                if window['requests']:
+                    rows.append(SystemMetrics(
+                        metric_name='rag_llm_hedge_rate',
+                        metric_value=round((window['hedged'] + window['fallback']) / window['requests'], 4),
+                        metric_unit='ratio',
+                        tags=dict(window, persona=persona, pid=os.getpid())
+                    ))
+            try:
+                SystemMetrics.objects.bulk_create(rows)
+            except Exception as e:
+                logger.error(f"Failed to flush stage latency metrics: {str(e)}")
+                return 0
+            finally:
+                if threading.current_thread() is not threading.main_thread():
+                    connections.close_all()
+            self.previous = current
+            self.previous_hedges = hedges
+            return len(rows)
+
+
+metrics_flusher = MetricsFlusher(stage_latencies, hedge_stats)
+
+
+def prometheus_labels(**labels) -> str:
+    """Label set in Prometheus text format, with backslashes, quotes and newlines in values escaped"""
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for value in labels.values()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def prometheus_text() -> str:
+    """Stage latencies, LLM hedging counters and breaker/limiter state of this process in Prometheus text format"""
+    lines = [
+        '# HELP rag_stage_latency_ms RAG pipeline stage latency in milliseconds',
+        '# TYPE rag_stage_latency_ms summary',
+    ]
+    for stage, histogram in sorted(stage_latencies.snapshot().items()):
+        for quantile in QUANTILES:
+            lines.append(
+                f'rag_stage_latency_ms{prometheus_labels(stage=stage, quantile=quantile)} {histogram.percentile(quantile):.3f}'
+            )
+        lines.append(f'rag_stage_latency_ms_sum{prometheus_labels(stage=stage)} {histogram.sum_ms:.3f}')
+        lines.append(f'rag_stage_latency_ms_count{prometheus_labels(stage=stage)} {histogram.count}')
+    lines += [
+        '# HELP rag_llm_chat_total LLM chat calls by persona and outcome (requests, hedged, fallback, hedge_won, failed)',
+        '# TYPE rag_llm_chat_total counter',
+    ]
+    for persona, counts in sorted(hedge_stats.by_persona().items()):
+        for outcome, count in counts.items():
+            lines.append(f'rag_llm_chat_total{prometheus_labels(persona=persona, outcome=outcome)} {count}')
+
+    from protocol.llm_client import guard_states
+    states = sorted(guard_states().items())
+    lines += [
+        '# HELP rag_llm_circuit_open Whether the provider endpoint circuit breaker is refusing calls (1) or not (0)',
+        '# TYPE rag_llm_circuit_open gauge',
+    ]
+    for (provider, endpoint), state in states:
+        lines.append(
+            f'rag_llm_circuit_open{prometheus_labels(provider=provider, endpoint=endpoint)} {int(state["circuit"] == "open")}'
+        )
+    lines += [
+        '# HELP rag_llm_concurrency_limit Current AIMD concurrency limit of the provider endpoint',
+        '# TYPE rag_llm_concurrency_limit gauge',
+    ]
+    for (provider, endpoint), state in states:
+        lines.append(f'rag_llm_concurrency_limit{prometheus_labels(provider=provider, endpoint=endpoint)} {state["limit"]}')
+    return '\n'.join(lines) + '\n'
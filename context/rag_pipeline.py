@@ -1,26 +1,38 @@
 from typing import List, Dict, Any, Optional
 from django.conf import settings
+from django.db import IntegrityError
+from knowledge_base.corpus import chunk_count
 from knowledge_base.models import ContentChunk, QueryLog
-from protocol.gemini_client import GeminiClient
-from protocol.faiss_driver import FAISSDriver
+from protocol.faiss_driver import diversify
+from protocol.llm_client import LLMError, LLMUnavailable
 from .embedding_manager import EmbeddingManager
+from .bootstrap import get_pipeline_components, pipeline_bootstrap
+from .instrumentation import StageTimer
+from .reranker import get_reranker
+from rag_tutor.tracing import trace, tracing
 import logging
 import time
-from django.core.cache import cache
 from celery import shared_task
 
 logger = logging.getLogger('rag_tutor')
 
+
+def _stitch(text: str, following: str, probe: int = 32) -> str:
+    """Append ``following`` to ``text``, dropping the prefix it shares with the end of ``text``"""
+    head = following[:probe]
+    start = text.find(head, max(0, len(text) - len(following)))
+    while head and start != -1:
+        overlap = len(text) - start
+        if following.startswith(text[start:]):
+            return text + following[overlap:]
+        start = text.find(head, start + 1)
+    return f"{text} {following}"
+
+
 class RAGPipeline:
     def __init__(self):
-        # Try to get cached Gemini client and FAISS index
-        self.gemini_client = cache.get('gemini_client')
-        self.faiss_driver = cache.get('faiss_driver')
-        if not self.gemini_client or not self.faiss_driver:
-            # Trigger async initialization if not present
-            initialize_rag_pipeline.delay()
-            # Optionally, you can raise an error or use a fallback here
-            raise Exception('RAG pipeline is initializing, please try again shortly.')
+        # Process-local components, loaded on first use and unaffected by cache flushes
+        self.gemini_client, self.faiss_driver = get_pipeline_components()
         self.embedding_manager = EmbeddingManager()
     
     def query(self, 
@@ -28,122 +40,185 @@ class RAGPipeline:
               user=None, 
               textbook_id: Optional[str] = None,
               top_k: int = 5,
-              persona: str = "helpful_tutor") -> Dict[str, Any]:
-        """Execute RAG query pipeline"""
+              persona: str = "helpful_tutor",
+              neighbor_window: Optional[int] = None,
+              log_fields: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Execute RAG query pipeline.
+        
+        ``neighbor_window`` widens each retrieved chunk with that many
+        adjacent chunks either side (default ``RAG_NEIGHBOR_WINDOW``).
+        ``log_fields`` are extra QueryLog fields (user agent, IP address)
+        saved with the same insert as the query itself.
+        """
         
         start_time = time.time()
+        timer = StageTimer(sql_budget=settings.RAG_SQL_BUDGET)
+        log_fields = dict(log_fields or {}, persona_used=persona, top_k_results=top_k)
         
         try:
-            # Check if we have any content in the database
-            total_chunks = ContentChunk.objects.count()
-            if total_chunks == 0:
-                # No content available, provide a helpful response
-                end_time = time.time()
-                response_time_ms = int((end_time - start_time) * 1000)
-                
-                fallback_response = self._generate_fallback_response(question, persona)
-                
-                query_log = QueryLog.objects.create(
-                    user=user if user and getattr(user, 'is_authenticated', False) else None,
-                    query_text=question,
-                    query_type='rag',
-                    response_text=fallback_response,
-                    response_time_ms=response_time_ms
-                )
+            # Only an empty index needs the corpus size: no content yet, or an index still to be built
+            if self.faiss_driver.ntotal == 0:
+                with timer.stage('corpus'):
+                    total_chunks = chunk_count()
+                if total_chunks == 0:
+                    # No content available, provide a helpful response
+                    end_time = time.time()
+                    response_time_ms = int((end_time - start_time) * 1000)
+                    
+                    fallback_response = self._generate_fallback_response(question, persona)
+                    
+                    query_log = QueryLog.objects.create(
+                        user=user if user and getattr(user, 'is_authenticated', False) else None,
+                        query_text=question,
+                        query_type='rag',
+                        response_text=fallback_response,
+                        response_time_ms=response_time_ms,
+                        **log_fields
+                    )
+                    
+                    timer.log('RAG query')
+                    return {
+                        'answer': fallback_response,
+                        'response_time_ms': response_time_ms,
+                        'sources': [],
+                        'query_log_id': str(query_log.id),
+                        'context_chunks': 0
+                    }
                 
-                return {
-                    'answer': fallback_response,
-                    'response_time_ms': response_time_ms,
-                    'sources': [],
-                    'query_log_id': str(query_log.id),
-                    'context_chunks': 0
-                }
-            
-            # Check if FAISS index is empty but we have chunks
-            if self.faiss_driver.index.ntotal == 0 and total_chunks > 0:
                 logger.info("FAISS index is empty but chunks exist, rebuilding index...")
                 self.faiss_driver.rebuild_index()
-                # Refresh the driver from cache
-                self.faiss_driver = cache.get('faiss_driver')
             
             # Step 1: Generate query embedding
-            query_embedding = self.gemini_client.generate_embedding(question)
+            with timer.stage('embed'):
+                query_embedding = self.gemini_client.generate_embedding(question)
             
-            # Step 2: Retrieve relevant chunks
+            # Step 2: Retrieve a wide candidate set when a re-ranker or MMR will narrow it down
             filters = {}
             if textbook_id:
                 filters['textbook_id'] = textbook_id
-                logger.info(f"Searching with textbook filter: {textbook_id}")
+                logger.debug(f"Searching with textbook filter: {textbook_id}")
             
-            similar_chunks = self.faiss_driver.search(
-                query_embedding, 
-                top_k=top_k,
-                filters=filters
-            )
-            
-            # DEBUG: Log similarity scores
-            logger.info(f"Retrieved {len(similar_chunks)} chunks with scores: {[chunk['score'] for chunk in similar_chunks]}")
-            
-            # Step 3: Get chunk details from database
-            chunk_ids = [chunk['id'] for chunk in similar_chunks]
-            chunks = ContentChunk.objects.filter(id__in=chunk_ids).select_related('textbook')
+            reranker = get_reranker()
+            diverse = settings.RAG_MMR_LAMBDA < 1.0
+            if neighbor_window is None:
+                neighbor_window = settings.RAG_NEIGHBOR_WINDOW
+            neighbor_window = max(0, min(neighbor_window, settings.RAG_NEIGHBOR_WINDOW_MAX))
+            candidate_k = max(top_k, settings.RAG_RERANK_CANDIDATES) if reranker or diverse else top_k
             
-            # If no chunks found with textbook filter, try without filter
-            if textbook_id and not chunks.exists():
-                logger.info(f"No chunks found for textbook {textbook_id}, searching all content")
+            with timer.stage('retrieve'):
                 similar_chunks = self.faiss_driver.search(
                     query_embedding, 
-                    top_k=top_k,
-                    filters={}
+                    top_k=candidate_k,
+                    filters=filters,
+                    with_vectors=diverse,
+                    neighbor_window=neighbor_window
                 )
-                chunk_ids = [chunk['id'] for chunk in similar_chunks]
-                chunks = ContentChunk.objects.filter(id__in=chunk_ids).select_related('textbook')
-                logger.info(f"Retrieved {len(similar_chunks)} chunks without filter with scores: {[chunk['score'] for chunk in similar_chunks]}")
             
-            # DEBUG: Log chunk content
-            for chunk in chunks:
-                logger.info(f"Chunk {chunk.id}: {chunk.chunk_text[:200]}...")
+            if tracing():
+                trace('rag.retrieved', count=len(similar_chunks), scores=[chunk['score'] for chunk in similar_chunks])
+            
+            # Step 3: Hits carry their text from the index's chunk store; older snapshots read it from the database
+            with timer.stage('fetch'):
+                similar_chunks = self._attach_chunk_text(similar_chunks)
+            
+            # If no chunks found with textbook filter, try without filter
+            if textbook_id and not similar_chunks:
+                logger.debug(f"No chunks found for textbook {textbook_id}, searching all content")
+                with timer.stage('retrieve'):
+                    similar_chunks = self.faiss_driver.search(
+                        query_embedding, 
+                        top_k=candidate_k,
+                        filters={},
+                        with_vectors=diverse,
+                        neighbor_window=neighbor_window
+                    )
+                with timer.stage('fetch'):
+                    similar_chunks = self._attach_chunk_text(similar_chunks)
+                if tracing():
+                    trace('rag.retrieved_unfiltered', count=len(similar_chunks), scores=[chunk['score'] for chunk in similar_chunks])
+            
+            # Step 4: Re-rank the candidates, then drop overlapping ones, keeping top_k for the prompt
+            if reranker:
+                with timer.stage('rerank'):
+                    candidate_count = len(similar_chunks)
+                    similar_chunks = reranker.rerank(question, similar_chunks, candidate_count if diverse else top_k)
+                logger.debug(f"Re-ranked {candidate_count} candidates with {reranker.name}")
+            if diverse:
+                with timer.stage('diversify'):
+                    similar_chunks = diversify(
+                        similar_chunks, top_k, settings.RAG_MMR_LAMBDA, settings.RAG_DUPLICATE_THRESHOLD
+                    )
+                logger.debug(f"Selected {len(similar_chunks)} diverse chunks (lambda={settings.RAG_MMR_LAMBDA})")
+            similar_chunks = [
+                {key: value for key, value in hit.items() if key != 'vector'}
+                for hit in similar_chunks[:top_k]
+            ]
+            
+            # Widen each hit with its neighbouring chunks
+            passages = {}
+            if neighbor_window:
+                with timer.stage('expand'):
+                    passages = self._expand_passages(similar_chunks)
+                logger.debug(f"Expanded {len(passages)} chunks by up to {neighbor_window} neighbours each side")
             
-            # Step 4: Build context
-            context = self._build_context(chunks, similar_chunks)
+            if tracing():
+                trace('rag.chunks', chunks=[{'id': hit['id'], 'text': hit['text'][:200]} for hit in similar_chunks])
             
-            # DEBUG: Log context
-            logger.info(f"Built context with {len(chunks)} chunks, context length: {len(context)}")
+            # Step 5: Build context
+            with timer.stage('context'):
+                context = self._build_context(similar_chunks, passages)
             
-            # Step 5: Generate response
-            response = self._generate_response(question, context, persona, textbook_id)
+            logger.debug(f"Built context with {len(similar_chunks)} chunks, context length: {len(context)}")
             
-            # Step 6: Log query
+            # Step 6: Generate response
+            generation_error = None
+            with timer.stage('generate'):
+                try:
+                    response = self._generate_response(question, context, persona, textbook_id)
+                except LLMUnavailable:
+                    # Refused by a breaker or limiter: the caller gets a 503 with Retry-After
+                    raise
+                except LLMError as e:
+                    # Every provider failed; still return the sources, and say why there is no answer
+                    logger.error(f"Answer generation failed: {str(e)}")
+                    generation_error = str(e)
+                    response = "I'm sorry, I couldn't generate an answer right now. The sources below may still help."
+            
+            # Step 7: Log query
             end_time = time.time()
             response_time_ms = int((end_time - start_time) * 1000)
             
-            query_log = QueryLog.objects.create(
-                user=user if user and getattr(user, 'is_authenticated', False) else None,
-                query_text=question,
-                query_type='rag',
-                response_text=response,
-                response_time_ms=response_time_ms
-            )
-            if chunks.exists():
-                query_log.retrieved_chunks.set(chunks)
+            with timer.stage('log'):
+                query_log = QueryLog.objects.create(
+                    user=user if user and getattr(user, 'is_authenticated', False) else None,
+                    query_text=question,
+                    query_type='rag',
+                    response_text=response,
+                    response_time_ms=response_time_ms,
+                    context_chunks_count=len(similar_chunks),
+                    **log_fields
+                )
+                self._log_retrieved_chunks(query_log, [hit['id'] for hit in similar_chunks])
             
+            timer.log('RAG query')
             return {
                 'answer': response,
-                'context_chunks': len(chunks),
+                'context_chunks': len(similar_chunks),
                 'response_time_ms': response_time_ms,
                 'query_log_id': str(query_log.id),
+                'generation_error': generation_error,
+                'timings': timer.as_dict(),
+                'sql': timer.sql_as_dict(),
                 'sources': [
                     {
-                        'textbook_title': chunk.textbook.title,
-                        'subject': chunk.textbook.subject.name,
-                        'grade': chunk.textbook.grade.level,
-                        'chunk_index': chunk.chunk_index,
-                        'similarity_score': next(
-                            (sc['score'] for sc in similar_chunks if sc['id'] == chunk.id), 
-                            0.0
-                        )
+                        'textbook_title': hit['metadata'].get('title'),
+                        'subject': hit['metadata'].get('subject'),
+                        'grade': hit['metadata'].get('grade'),
+                        'chunk_index': hit['metadata'].get('chunk_index'),
+                        'similarity_score': hit['score'],
+                        'rerank_score': hit.get('rerank_score')
                     }
-                    for chunk in chunks
+                    for hit in similar_chunks
                 ]
             }
             
@@ -151,21 +226,99 @@ class RAGPipeline:
             logger.error(f"RAG query failed: {str(e)}")
             raise
     
-    def _build_context(self, chunks: List[ContentChunk], similarity_scores: List[Dict]) -> str:
-        """Build context from retrieved chunks"""
-        context_parts = []
+    def _log_retrieved_chunks(self, query_log: QueryLog, chunk_ids: List[str]):
+        """Link the retrieved chunks to the query log with one bulk insert"""
+        if not chunk_ids:
+            return
+        through = QueryLog.retrieved_chunks.through
+        rows = [through(querylog_id=query_log.id, contentchunk_id=chunk_id) for chunk_id in chunk_ids]
+        try:
+            # Autocommit, so a dangling chunk id fails this statement alone
+            through.objects.bulk_create(rows)
+        except IntegrityError:
+            # A chunk was deleted after the snapshot the index is serving was written
+            existing = {str(pk) for pk in ContentChunk.objects.filter(id__in=chunk_ids).values_list('id', flat=True)}
+            through.objects.bulk_create([row for row in rows if str(row.contentchunk_id) in existing])
+    
+    def _attach_chunk_text(self, hits: List[Dict]) -> List[Dict]:
+        """Fill in ``text`` and source metadata for hits the index returned without text.
         
-        for chunk in chunks:
-            # Find similarity score
-            score = next(
-                (sc['score'] for sc in similarity_scores if sc['id'] == chunk.id), 
-                0.0
+        Only snapshots written before the chunk text store existed need this
+        one query; hits whose chunk is no longer in the database are dropped.
+        """
+        missing = [hit['id'] for hit in hits if 'text' not in hit]
+        if not missing:
+            return hits
+        chunks = ContentChunk.objects.filter(id__in=missing).select_related(
+            'textbook', 'textbook__subject', 'textbook__grade'
+        )
+        chunks_by_id = {str(chunk.id): chunk for chunk in chunks}
+        
+        attached = []
+        for hit in hits:
+            if 'text' not in hit:
+                chunk = chunks_by_id.get(hit['id'])
+                if chunk is None:
+                    continue
+                hit = dict(hit, text=chunk.chunk_text, metadata=dict(
+                    hit['metadata'],
+                    title=chunk.textbook.title,
+                    subject=chunk.textbook.subject.name,
+                    grade=chunk.textbook.grade.level,
+                    chunk_index=chunk.chunk_index
+                ))
+            attached.append(hit)
+        return attached
+    
+    def _expand_passages(self, hits: List[Dict]) -> Dict[str, str]:
+        """Text of each hit joined with its ``neighbors``, keyed by hit id.
+        
+        Chunks already shown in a higher-ranked hit's passage are not repeated,
+        and the overlap between adjacent chunks is stitched out.
+        """
+        texts = {hit['id']: hit['text'] for hit in hits}
+        texts.update(
+            (neighbor['id'], neighbor['text'])
+            for hit in hits for neighbor in hit.get('neighbors', []) if 'text' in neighbor
+        )
+        missing = {neighbor['id'] for hit in hits for neighbor in hit.get('neighbors', []) if neighbor['id'] not in texts}
+        if missing:
+            texts.update(
+                (str(chunk_id), text)
+                for chunk_id, text in ContentChunk.objects.filter(id__in=missing).values_list('id', 'chunk_text')
             )
-            
+        
+        used = {hit['id'] for hit in hits}
+        passages = {}
+        for hit in hits:
+            text = ''
+            previous = None
+            for neighbor in hit.get('neighbors', []):
+                chunk_id = neighbor['id']
+                if chunk_id not in texts or (chunk_id in used and chunk_id != hit['id']):
+                    previous = None
+                    continue
+                used.add(chunk_id)
+                if previous is None or neighbor['chunk_index'] != previous + 1:
+                    text = f"{text} ... {texts[chunk_id]}" if text else texts[chunk_id]
+                else:
+                    text = _stitch(text, texts[chunk_id])
+                previous = neighbor['chunk_index']
+            if text:
+                passages[hit['id']] = text
+        return passages
+    
+    def _build_context(self, hits: List[Dict], passages: Optional[Dict[str, str]] = None) -> str:
+        """Build context from retrieved chunks, using their expanded passages when given"""
+        context_parts = []
+        passages = passages or {}
+        
+        for hit in hits:
+            metadata = hit['metadata']
             context_parts.append(f"""
-Source: {chunk.textbook.title} (Grade {chunk.textbook.grade.level}, {chunk.textbook.subject.name})
-Relevance: {score:.3f}
-Content: {chunk.chunk_text}
+Source: {metadata.get('title')} (Grade {metadata.get('grade')}, {metadata.get('subject')})
+Relevance: {hit['score']:.3f}
+Content: {passages.get(hit['id'], hit['text'])}
 ---
 """)
         
@@ -221,7 +374,7 @@ Please provide a comprehensive answer based on the context provided. If the cont
 
 Answer:"""
         
-        return self.gemini_client.generate_chat_response(prompt)
+        return self.gemini_client.generate_chat_response(prompt, persona=persona)
     
     def _generate_fallback_response(self, question: str, persona: str) -> str:
         """Generate a fallback response when no content is available"""
@@ -252,60 +405,12 @@ Please provide a helpful response explaining that no textbook content is current
 Answer:"""
         
         try:
-            return self.gemini_client.generate_chat_response(prompt)
+            return self.gemini_client.generate_chat_response(prompt, persona=persona)
         except Exception as e:
             logger.error(f"Fallback response generation failed: {str(e)}")
             return f"I'd be happy to help you with '{question}', but I don't have any textbook content to reference yet. Please upload some educational content using the upload form above, and I'll be able to provide more specific and helpful answers based on that material!"
 
-# Celery task to initialize and cache Gemini client and FAISS index
+# Celery task to warm the process-local pipeline in a worker
 @shared_task
 def initialize_rag_pipeline():
-    from protocol.gemini_client import GeminiClient
-    from protocol.faiss_driver import FAISSDriver
-    gemini_client = GeminiClient()
-    faiss_driver = FAISSDriver()
-    cache.set('gemini_client', gemini_client, timeout=None)
-    cache.set('faiss_driver', faiss_driver, timeout=None)
-
-# Management command to pre-warm the RAG pipeline
-# Place this at the end of the file
-from django.core.management.base import BaseCommand
-import time
-
-class Command(BaseCommand):
-    help = 'Pre-warm the RAG pipeline (Gemini and FAISS) so users never see the initializing error.'
-
-    def handle(self, *args, **options):
-        from django.core.cache import cache
-        from context.rag_pipeline import initialize_rag_pipeline
-        self.stdout.write('Triggering RAG pipeline initialization...')
-        initialize_rag_pipeline.delay()
-        timeout = 60  # seconds
-        interval = 2
-        waited = 0
-        while waited < timeout:
-            if cache.get('gemini_client') and cache.get('faiss_driver'):
-                self.stdout.write(self.style.SUCCESS('RAG pipeline is ready!'))
-                return
-            self.stdout.write('Waiting for RAG pipeline to initialize...')
-            time.sleep(interval)
-            waited += interval
-        self.stdout.write(self.style.ERROR('Timeout: RAG pipeline did not initialize in time.'))
-
-class RebuildFAISSCommand(BaseCommand):
-    help = 'Force rebuild the FAISS index to fix dimension mismatches.'
-
-    def handle(self, *args, **options):
-        from protocol.faiss_driver import FAISSDriver
-        from django.core.cache import cache
-        
-        self.stdout.write('Force rebuilding FAISS index...')
-        
-        # Clear cache
-        cache.delete('faiss_driver')
-        
-        # Create new driver and force rebuild
-        faiss_driver = FAISSDriver()
-        faiss_driver.force_rebuild_index()
-        
-        self.stdout.write(self.style.SUCCESS('FAISS index rebuilt successfully!'))
\ No newline at end of file
+    return pipeline_bootstrap.warm()
@@ -0,0 +1,186 @@
+import logging
+import math
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger('rag_tutor')
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    'a an and are as at be by for from how in is it of on or that the this to was what when where which who why with'.split()
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+def _rerank_executor() -> ThreadPoolExecutor:
+    """Shared pool so scoring never runs on (or starves) request threads"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.RAG_RERANK_WORKERS,
+                    thread_name_prefix='rerank'
+                )
+    return _executor
+
+
+class BaseReranker(ABC):
+    """Second retrieval stage: re-order a wide FAISS candidate set and keep the best few.
+
+    Candidates are search hits (``id``, ``score``, ``metadata``) with the
+    chunk ``text`` attached. Scoring runs in a worker thread pool under
+    ``RAG_RERANK_TIMEOUT_MS``; if it overruns, the vector-similarity order
+    is used so a slow scorer can never stall a request.
+    """
+
+    name = 'base'
+
+    def warm(self):
+        """Load whatever the scorer needs; called at pipeline load so it never counts against the timeout"""
+
+    @abstractmethod
+    def score(self, query: str, candidates: List[Dict[str, Any]]) -> List[float]:
+        """Relevance score per candidate, higher is better"""
+        pass
+
+    def rerank(self, query: str, candidates: List[Dict[str, Any]], top_n: int) -> List[Dict[str, Any]]:
+        if len(candidates) <= 1:
+            return candidates[:top_n]
+
+        try:
+            # Normally done by the pipeline bootstrap already; a no-op once loaded
+            self.warm()
+        except Exception as e:
+            logger.error(f"{self.name} re-ranker could not load, keeping vector order: {str(e)}")
+            return candidates[:top_n]
+
+        future = _rerank_executor().submit(self.score, query, candidates)
+        try:
+            scores = future.result(timeout=settings.RAG_RERANK_TIMEOUT_MS / 1000)
+        except FutureTimeoutError:
+            logger.warning(f"{self.name} re-ranker exceeded {settings.RAG_RERANK_TIMEOUT_MS}ms, keeping vector order")
+            return candidates[:top_n]
+        except Exception as e:
+            logger.error(f"{self.name} re-ranker failed, keeping vector order: {str(e)}")
+            return candidates[:top_n]
+
+        ranked = sorted(zip(scores, range(len(candidates))), key=lambda pair: -pair[0])
+        return [dict(candidates[i], rerank_score=round(float(s), 4)) for s, i in ranked[:top_n]]
+
+
+class FeatureReranker(BaseReranker):
+    """Cheap CPU scorer: vector similarity, BM25 term overlap and chunk position.
+
+    BM25 statistics come from the candidate set itself, which is enough to
+    reward chunks that contain the question's rarer terms. Earlier chunks
+    of a textbook get a slight boost since they tend to introduce topics.
+    """
+
+    name = 'features'
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        self.weights = weights or settings.RAG_RERANK_WEIGHTS
+
+    def score(self, query: str, candidates: List[Dict[str, Any]]) -> List[float]:
+        query_terms = set(tokenize(query))
+        documents = [tokenize(candidate.get('text', '')) for candidate in candidates]
+        bm25 = self._bm25(query_terms, documents)
+        top_bm25 = max(bm25) or 1.0
+
+        scores = []
+        for candidate, term_score in zip(candidates, bm25):
+            chunk_index = candidate.get('metadata', {}).get('chunk_index') or 0
+            scores.append(
+                self.weights.get('similarity', 0.0) * candidate.get('score', 0.0)
+                + self.weights.get('bm25', 0.0) * term_score / top_bm25
+                + self.weights.get('position', 0.0) / (1.0 + math.log1p(chunk_index))
+            )
+        return scores
+
+    def _bm25(self, query_terms, documents: List[List[str]]) -> List[float]:
+        if not query_terms:
+            return [0.0] * len(documents)
+        count = len(documents)
+        average_length = sum(len(doc) for doc in documents) / count or 1.0
+        document_frequency = Counter(term for doc in documents for term in set(doc) if term in query_terms)
+
+        scores = []
+        for doc in documents:
+            frequencies = Counter(doc)
+            total = 0.0
+            for term in query_terms:
+                tf = frequencies.get(term, 0)
+                if not tf:
+                    continue
+                df = document_frequency[term]
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                total += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * len(doc) / average_length))
+            scores.append(total)
+        return scores
+
+
+class CrossEncoderReranker(BaseReranker):
+    """Local cross-encoder (sentence-transformers) scoring each (question, chunk) pair on CPU"""
+
+    name = 'cross_encoder'
+    _models = {}
+    _models_lock = threading.Lock()
+
+    def __init__(self, model_name: Optional[str] = None):
+        from sentence_transformers import CrossEncoder  # Optional dependency
+
+        self.model_name = model_name or settings.RAG_CROSS_ENCODER_MODEL
+        self._model_class = CrossEncoder
+
+    def warm(self):
+        # Loaded once per process, outside the timed scoring call
+        if self.model_name in self._models:
+            return
+        with self._models_lock:
+            if self.model_name not in self._models:
+                start = time.perf_counter()
+                self._models[self.model_name] = self._model_class(self.model_name, device='cpu')
+                logger.info(f"Loaded cross-encoder {self.model_name} in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def score(self, query: str, candidates: List[Dict[str, Any]]) -> List[float]:
+        pairs = [(query, candidate.get('text', '')) for candidate in candidates]
+        return [float(s) for s in self._models[self.model_name].predict(pairs)]
+
+
+_reranker = None
+_reranker_kind = None
+
+
+def get_reranker() -> Optional[BaseReranker]:
+    """The configured re-ranker (RAG_RERANKER), or None when re-ranking is off"""
+    global _reranker, _reranker_kind
+    kind = settings.RAG_RERANKER
+    if kind == 'none':
+        return None
+    if _reranker is None or _reranker_kind != kind:
+        if kind == 'cross_encoder':
+            try:
+                _reranker = CrossEncoderReranker()
+            except ImportError:
+                logger.warning("sentence-transformers is not installed, using the feature re-ranker")
+                _reranker = FeatureReranker()
+        else:
+            _reranker = FeatureReranker()
+        _reranker_kind = kind
+    return _reranker
@@ -1,7 +1,7 @@
 from typing import Dict, Any, Optional
 from django.db import connection
 from django.conf import settings
-from protocol.gemini_client import GeminiClient
+from protocol.llm_client import LLMClient
 from knowledge_base.models import TextbookContent, Subject, Grade, ContentChunk
 import logging
 import re
@@ -10,7 +10,7 @@ logger = logging.getLogger('rag_tutor')
 
 class SQLAgent:
     def __init__(self):
-        self.gemini_client = GeminiClient()
+        self.gemini_client = LLMClient()
         self.schema_info = self._get_schema_info()
     
     def natural_language_to_sql(self, question: str) -> Dict[str, Any]:
@@ -28,10 +28,11 @@ class TextbookContentAdmin(admin.ModelAdmin):
 
 @admin.register(ContentChunk)
 class ContentChunkAdmin(admin.ModelAdmin):
-    list_display = ['textbook', 'chunk_index', 'start_char', 'end_char', 'created_at']
-    list_filter = ['textbook__subject', 'textbook__grade', 'created_at']
+    list_display = ['textbook', 'chunk_index', 'start_char', 'end_char', 'embedding_status', 'created_at']
+    list_filter = ['textbook__subject', 'textbook__grade', 'embedding_status', 'created_at']
     search_fields = ['chunk_text', 'textbook__title']
     readonly_fields = ['id', 'created_at']
+    raw_id_fields = ['duplicate_of']
     ordering = ['textbook', 'chunk_index']
     
     def get_queryset(self, request):
@@ -39,8 +40,8 @@ class ContentChunkAdmin(admin.ModelAdmin):
 
 @admin.register(EmbeddingModel)
 class EmbeddingModelAdmin(admin.ModelAdmin):
-    list_display = ['name', 'provider', 'model_id', 'vector_dimension', 'is_active', 'created_at']
-    list_filter = ['provider', 'is_active', 'created_at']
+    list_display = ['name', 'provider', 'model_id', 'purpose', 'vector_dimension', 'is_active', 'created_at']
+    list_filter = ['provider', 'purpose', 'is_active', 'created_at']
     search_fields = ['name', 'model_id']
     readonly_fields = ['created_at']
 
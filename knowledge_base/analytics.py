@@ -0,0 +1,167 @@
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, QuerySet, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from knowledge_base.models import QueryLog, QueryRollup
+
+logger = logging.getLogger('rag_tutor')
+
+DIMENSIONS = ('persona', 'subject', 'grade', 'query_type')
+COUNTERS = ('query_count', 'sourced_count', 'latency_count', 'latency_sum_ms', 'rating_count', 'rating_sum')
+RATINGS = range(1, 6)
+
+
+def floor_hour(moment: datetime) -> datetime:
+    return moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(moment: datetime) -> datetime:
+    return floor_hour(moment).replace(hour=0)
+
+
+def rollup_queries(now: datetime = None) -> Dict[str, int]:
+    """Fold query logs newer than the last hourly rollup into hourly and daily rows.
+
+    Every hour from the latest rolled-up one is recomputed from the log, so
+    runs are idempotent; the first run backfills the whole log a window of
+    ``ANALYTICS_ROLLUP_WINDOW_HOURS`` at a time. Going back one beat interval
+    plus ``ANALYTICS_ROLLUP_SETTLE_SECONDS`` picks up rows committed late.
+    """
+    now = now or timezone.now()
+    latest = QueryRollup.objects.filter(granularity='hour').aggregate(latest=Max('bucket_start'))['latest']
+    if latest is None:
+        latest = QueryLog.objects.aggregate(earliest=Min('created_at'))['earliest']
+        if latest is None:
+            return {'hours': 0, 'days': 0}
+    lookback = timedelta(seconds=settings.ANALYTICS_ROLLUP_INTERVAL + settings.ANALYTICS_ROLLUP_SETTLE_SECONDS)
+    start = floor_hour(min(latest, now - lookback))
+
+    hours = 0
+    window = timedelta(hours=settings.ANALYTICS_ROLLUP_WINDOW_HOURS)
+    window_start = start
+    while window_start < now:
+        window_end = min(window_start + window, now)
+        rows = _hourly_rollups(window_start, window_end)
+        with transaction.atomic():
+            QueryRollup.objects.filter(
+                granularity='hour', bucket_start__gte=window_start, bucket_start__lt=window_end
+            ).delete()
+            QueryRollup.objects.bulk_create(rows, batch_size=500)
+        hours += len(rows)
+        window_start = window_end
+
+    days = _rollup_days(floor_day(start), now)
+    logger.info(f"Query analytics rolled up from {start.isoformat()}: {hours} hourly and {days} daily rows")
+    return {'hours': hours, 'days': days}
+
+
+def _hourly_rollups(start: datetime, end: datetime) -> List[QueryRollup]:
+    bounds = settings.ANALYTICS_LATENCY_BUCKETS_MS
+    aggregates = {
+        'query_count': Count('id'),
+        'sourced_count': Count('id', filter=Q(context_chunks_count__gt=0)),
+        'latency_count': Count('response_time_ms'),
+        'latency_sum_ms': Sum('response_time_ms'),
+        'rating_count': Count('rating'),
+        'rating_sum': Sum('rating'),
+    }
+    lower = None
+    for i, bound in enumerate(bounds + [None]):
+        in_bucket = Q(response_time_ms__isnull=False)
+        if lower is not None:
+            in_bucket &= Q(response_time_ms__gt=lower)
+        if bound is not None:
+            in_bucket &= Q(response_time_ms__lte=bound)
+        aggregates[f'latency_{i}'] = Count('id', filter=in_bucket)
+        lower = bound
+    for rating in RATINGS:
+        aggregates[f'rating_{rating}'] = Count('id', filter=Q(rating=rating))
+
+    grouped = QueryLog.objects.filter(created_at__gte=start, created_at__lt=end).annotate(
+        bucket=TruncHour('created_at', tzinfo=dt_timezone.utc)
+    ).values('bucket', 'persona_used', 'subject_filter', 'grade_filter', 'query_type').annotate(
+        **aggregates
+    ).order_by()
+
+    return [
+        QueryRollup(
+            granularity='hour',
+            bucket_start=row['bucket'],
+            persona=row['persona_used'],
+            subject=row['subject_filter'] or '',
+            grade=row['grade_filter'] or '',
+            query_type=row['query_type'],
+            latency_histogram=[row[f'latency_{i}'] for i in range(len(bounds) + 1)],
+            rating_histogram=[row[f'rating_{rating}'] for rating in RATINGS],
+            **{counter: row[counter] or 0 for counter in COUNTERS}
+        )
+        for row in grouped
+    ]
+
+
+def _rollup_days(start: datetime, end: datetime) -> int:
+    """Rebuild the daily rows of [start, end) by summing their hourly rows"""
+    days = {}
+    hourly = QueryRollup.objects.filter(granularity='hour', bucket_start__gte=start, bucket_start__lt=end)
+    for row in hourly.iterator():
+        key = (floor_day(row.bucket_start),) + tuple(getattr(row, dimension) for dimension in DIMENSIONS)
+        day = days.get(key)
+        if day is None:
+            days[key] = QueryRollup(
+                granularity='day',
+                bucket_start=key[0],
+                latency_histogram=list(row.latency_histogram),
+                rating_histogram=list(row.rating_histogram),
+                **{dimension: getattr(row, dimension) for dimension in DIMENSIONS + COUNTERS}
+            )
+        else:
+            _merge(day, row)
+
+    with transaction.atomic():
+        QueryRollup.objects.filter(granularity='day', bucket_start__gte=start, bucket_start__lt=end).delete()
+        QueryRollup.objects.bulk_create(days.values(), batch_size=500)
+    return len(days)
+
+
+def _merge(target: QueryRollup, row: QueryRollup):
+    for counter in COUNTERS:
+        setattr(target, counter, getattr(target, counter) + getattr(row, counter))
+    target.latency_histogram = _add(target.latency_histogram, row.latency_histogram)
+    target.rating_histogram = _add(target.rating_histogram, row.rating_histogram)
+
+
+def _add(left: List[int], right: List[int]) -> List[int]:
+    # Rows rolled up before a change to ANALYTICS_LATENCY_BUCKETS_MS may be shorter
+    size = max(len(left), len(right))
+    return [
+        (left[i] if i < len(left) else 0) + (right[i] if i < len(right) else 0)
+        for i in range(size)
+    ]
+
+
+def summarize_rollups(rollups: QuerySet) -> Dict[str, Any]:
+    """Totals, averages and histograms over a set of rollup rows"""
+    totals = rollups.aggregate(**{counter: Sum(counter) for counter in COUNTERS})
+    totals = {counter: value or 0 for counter, value in totals.items()}
+
+    latency_histogram, rating_histogram = [], []
+    for latency, ratings in rollups.values_list('latency_histogram', 'rating_histogram').order_by():
+        latency_histogram = _add(latency_histogram, latency)
+        rating_histogram = _add(rating_histogram, ratings)
+
+    return dict(
+        totals,
+        avg_response_time=totals['latency_sum_ms'] / totals['latency_count'] if totals['latency_count'] else 0,
+        avg_rating=totals['rating_sum'] / totals['rating_count'] if totals['rating_count'] else 0,
+        latency_histogram={
+            'bounds_ms': settings.ANALYTICS_LATENCY_BUCKETS_MS,
+            'counts': latency_histogram or [0] * (len(settings.ANALYTICS_LATENCY_BUCKETS_MS) + 1)
+        },
+        rating_distribution={rating: count for rating, count in zip(RATINGS, rating_histogram) if count}
+    )
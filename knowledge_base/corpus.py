@@ -0,0 +1,48 @@
+from typing import Any, Dict
+
+from django.db.models import Count, Sum
+
+from knowledge_base.models import TextbookContent
+from protocol.cache_namespace import index_cache
+
+
+def corpus_stats() -> Dict[str, Any]:
+    """Textbook and chunk totals, overall and by subject and grade.
+
+    Summed from the ``TextbookContent.chunk_count`` counters, so it costs two
+    grouped queries over textbooks rather than a scan of the chunk table.
+    Cached until the index namespace is bumped (every ingestion, re-index
+    and textbook deletion does) or ``invalidate_corpus_stats`` is called.
+    """
+    stats = index_cache.get('corpus_stats')
+    if stats is None:
+        by_subject = [
+            {'subject': row['subject__name'], 'textbooks': row['textbooks'], 'chunks': row['chunks'] or 0}
+            for row in TextbookContent.objects.values('subject__name').annotate(
+                textbooks=Count('id'), chunks=Sum('chunk_count')
+            ).order_by('subject__name')
+        ]
+        by_grade = [
+            {'grade': row['grade__level'], 'textbooks': row['textbooks'], 'chunks': row['chunks'] or 0}
+            for row in TextbookContent.objects.values('grade__level').annotate(
+                textbooks=Count('id'), chunks=Sum('chunk_count')
+            ).order_by('grade__level')
+        ]
+        stats = {
+            'total_textbooks': sum(row['textbooks'] for row in by_subject),
+            'total_chunks': sum(row['chunks'] for row in by_subject),
+            'by_subject': by_subject,
+            'by_grade': by_grade,
+        }
+        index_cache.set('corpus_stats', stats)
+    return stats
+
+
+def chunk_count() -> int:
+    """Number of embedded content chunks in the corpus"""
+    return corpus_stats()['total_chunks']
+
+
+def invalidate_corpus_stats():
+    """Drop the cached stats after textbooks are added, processed or deleted"""
+    index_cache.delete('corpus_stats')
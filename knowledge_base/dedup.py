@@ -0,0 +1,86 @@
+import logging
+from collections import defaultdict
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import transaction
+
+from context.embedding_manager import SIMHASH_BANDS, EmbeddingManager
+from knowledge_base.models import ContentChunk, SimHashBand
+
+logger = logging.getLogger('rag_tutor')
+
+# Band values per query, well under SQLite's bound-parameter limit
+LOOKUP_BATCH = 500
+
+
+def link_near_duplicates(textbook_id, chunks: List[ContentChunk]) -> int:
+    """Link new chunks to near-identical embedded chunks of other textbooks and reuse their vectors.
+
+    Candidates come from the SimHash LSH table (``SimHashBand``); one within
+    ``INGEST_SIMHASH_MAX_DISTANCE`` bits becomes the chunk's ``duplicate_of``
+    and its embedding is copied, so the chunk skips the embedding API.
+    Chunks without a near-duplicate become canonical and enter the table.
+    Returns the number of duplicates found.
+    """
+    signed = [chunk for chunk in chunks if chunk.simhash is not None]
+    if not signed:
+        return 0
+    bands = {chunk.id: EmbeddingManager.simhash_bands(chunk.simhash) for chunk in signed}
+
+    duplicates = {}
+    if settings.INGEST_DEDUP_ENABLED:
+        candidates = _lookup(textbook_id, bands)
+        for chunk in signed:
+            best = None
+            for band, value in enumerate(bands[chunk.id]):
+                for candidate_id, candidate_simhash in candidates.get((band, value), ()):
+                    distance = EmbeddingManager.simhash_distance(chunk.simhash, candidate_simhash)
+                    if distance <= settings.INGEST_SIMHASH_MAX_DISTANCE and (best is None or distance < best[0]):
+                        best = (distance, candidate_id)
+            if best:
+                duplicates[chunk.id] = best[1]
+
+    vectors = {}
+    canonical_ids = list(set(duplicates.values()))
+    for start in range(0, len(canonical_ids), LOOKUP_BATCH):
+        vectors.update(ContentChunk.objects.filter(
+            id__in=canonical_ids[start:start + LOOKUP_BATCH]
+        ).values_list('id', 'embedding_vector'))
+
+    linked = []
+    for chunk in signed:
+        canonical_id = duplicates.get(chunk.id)
+        if canonical_id and vectors.get(canonical_id):
+            chunk.duplicate_of_id = canonical_id
+            chunk.embedding_vector = vectors[canonical_id]
+            chunk.embedding_status = 'embedded'
+            linked.append(chunk)
+    linked_ids = {chunk.id for chunk in linked}
+    with transaction.atomic():
+        ContentChunk.objects.bulk_update(linked, ['duplicate_of', 'embedding_vector', 'embedding_status'], batch_size=500)
+        SimHashBand.objects.bulk_create([
+            SimHashBand(chunk_id=chunk.id, band=band, value=value)
+            for chunk in signed if chunk.id not in linked_ids
+            for band, value in enumerate(bands[chunk.id])
+        ], batch_size=1000)
+
+    if linked:
+        logger.info(f"Textbook {textbook_id}: {len(linked)} of {len(chunks)} chunks are near-duplicates, embeddings reused")
+    return len(linked)
+
+
+def _lookup(textbook_id, bands: Dict[object, List[int]]) -> Dict[tuple, List[tuple]]:
+    """(band, value) -> [(chunk_id, simhash)] of embedded canonical chunks of other textbooks"""
+    candidates = defaultdict(list)
+    for band in range(SIMHASH_BANDS):
+        values = sorted({chunk_bands[band] for chunk_bands in bands.values()})
+        for start in range(0, len(values), LOOKUP_BATCH):
+            rows = SimHashBand.objects.filter(
+                band=band,
+                value__in=values[start:start + LOOKUP_BATCH],
+                chunk__embedding_status__in=['embedded', 'indexed']
+            ).exclude(chunk__textbook_id=textbook_id).values_list('value', 'chunk_id', 'chunk__simhash')
+            for value, chunk_id, simhash in rows:
+                candidates[(band, value)].append((chunk_id, simhash))
+    return candidates
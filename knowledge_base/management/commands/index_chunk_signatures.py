@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from context.embedding_manager import EmbeddingManager
+from knowledge_base.models import ContentChunk, SimHashBand
+import logging
+
+logger = logging.getLogger('rag_tutor')
+
+class Command(BaseCommand):
+    help = 'Compute SimHash signatures for chunks stored without one and add them to the near-duplicate LSH table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        embedding_manager = EmbeddingManager()
+        chunks = ContentChunk.objects.filter(simhash__isnull=True, duplicate_of__isnull=True).only('id', 'chunk_text')
+        signed = 0
+        last_id = None
+        while True:
+            # Keyset pages: rows too short to sign keep simhash NULL and must not be read again
+            page = chunks.order_by('id')
+            if last_id is not None:
+                page = page.filter(id__gt=last_id)
+            page = list(page[:options['batch_size']])
+            if not page:
+                break
+            last_id = page[-1].id
+            for chunk in page:
+                chunk.simhash = embedding_manager.simhash(chunk.chunk_text)
+            signed += self._save([chunk for chunk in page if chunk.simhash is not None])
+
+        logger.info(f"Indexed SimHash signatures of {signed} chunks")
+        self.stdout.write(self.style.SUCCESS(f'Indexed SimHash signatures of {signed} chunks'))
+
+    def _save(self, chunks) -> int:
+        # Existing chunks become canonical: later uploads that repeat them reuse their embeddings
+        with transaction.atomic():
+            ContentChunk.objects.bulk_update(chunks, ['simhash'])
+            SimHashBand.objects.bulk_create([
+                SimHashBand(chunk_id=chunk.id, band=band, value=value)
+                for chunk in chunks
+                for band, value in enumerate(EmbeddingManager.simhash_bands(chunk.simhash))
+            ], batch_size=1000)
+        return len(chunks)
@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from protocol.cache_namespace import index_cache
+from protocol.faiss_shards import shard_snapshot_dir
+from protocol.index_snapshots import SnapshotStore
+import logging
+
+logger = logging.getLogger('rag_tutor')
+
+class Command(BaseCommand):
+    help = 'List, verify, roll back or prune FAISS index snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rollback', metavar='VERSION', nargs='?', const='previous',
+                            help='Promote VERSION (default: the snapshot before the current one)')
+        parser.add_argument('--verify', metavar='VERSION', nargs='?', const='current',
+                            help='Verify checksums of VERSION (default: current)')
+        parser.add_argument('--prune', metavar='KEEP', type=int,
+                            help='Delete all but the newest KEEP snapshots')
+        parser.add_argument('--shard', type=int,
+                            help='With FAISS_SHARD_COUNT > 1, act on this shard only (default: every shard; '
+                                 'required for --rollback)')
+
+    def handle(self, *args, **options):
+        stores = self._stores(options['shard'])
+
+        if options['rollback']:
+            if len(stores) > 1:
+                # Each shard has its own history, so "previous" on one shard says nothing about the others
+                raise CommandError('The index is sharded; pass --shard to choose the shard to roll back')
+            self._rollback(*stores[0], options['rollback'])
+        elif options['verify']:
+            for shard, store in stores:
+                version = store.current_version() if options['verify'] == 'current' else options['verify']
+                if not version:
+                    raise CommandError(f'No snapshot has been promoted yet{_of(shard)}')
+                if store.verify(version):
+                    self.stdout.write(self.style.SUCCESS(f'Snapshot {version}{_of(shard)} verified'))
+                else:
+                    raise CommandError(f'Snapshot {version}{_of(shard)} failed verification')
+        elif options['prune'] is not None:
+            for shard, store in stores:
+                store.prune(options['prune'])
+                self.stdout.write(self.style.SUCCESS(f'Kept the newest {options["prune"]} snapshots{_of(shard)}'))
+        else:
+            for shard, store in stores:
+                self._list(shard, store)
+
+    def _stores(self, shard):
+        """(shard, SnapshotStore) pairs: the unsharded index (shard None), the given shard or every shard"""
+        if settings.FAISS_SHARD_COUNT <= 1:
+            if shard is not None:
+                raise CommandError('--shard needs FAISS_SHARD_COUNT > 1')
+            return [(None, SnapshotStore(settings.FAISS_SNAPSHOT_DIR))]
+        if shard is not None and not 0 <= shard < settings.FAISS_SHARD_COUNT:
+            raise CommandError(f'Shard must be between 0 and {settings.FAISS_SHARD_COUNT - 1}')
+        shards = [shard] if shard is not None else range(settings.FAISS_SHARD_COUNT)
+        return [(n, SnapshotStore(shard_snapshot_dir(n))) for n in shards]
+
+    def _list(self, shard, store):
+        if shard is not None:
+            self.stdout.write(f'Shard {shard}:')
+        snapshots = store.list_snapshots()
+        if not snapshots:
+            self.stdout.write(self.style.WARNING('No FAISS snapshots found'))
+            return
+        for manifest in snapshots:
+            marker = '*' if manifest['is_current'] else ' '
+            self.stdout.write(
+                f"{marker} {manifest['version']}  vectors={manifest.get('vector_count')}  "
+                f"dim={manifest.get('dimension')}  model={manifest.get('embedding_model')}  "
+                f"created={manifest.get('created_at')}"
+            )
+
+    def _rollback(self, shard, store, version):
+        if version == 'previous':
+            versions = store.versions()
+            current = store.current_version()
+            older = [v for v in versions if current is None or v < current]
+            if not older:
+                raise CommandError(f'There is no earlier snapshot{_of(shard)} to roll back to')
+            version = older[-1]
+
+        if not store.verify(version):
+            raise CommandError(f'Snapshot {version}{_of(shard)} failed verification; not promoting it')
+
+        with store.write_lock():
+            store.promote(version)
+        # Processes notice the new current link and hot-reload it
+        index_cache.invalidate()
+        logger.info(f'Rolled back FAISS index{_of(shard)} to snapshot {version}')
+        self.stdout.write(self.style.SUCCESS(f'Rolled back FAISS index{_of(shard)} to snapshot {version}'))
+
+
+def _of(shard) -> str:
+    return f' of shard {shard}' if shard is not None else ''
@@ -1,7 +1,8 @@
-from django.core.management.base import BaseCommand
-from protocol.faiss_driver import FAISSDriver
-from knowledge_base.models import ContentChunk
-from django.core.cache import cache
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from protocol.faiss_shards import get_faiss_driver
+from knowledge_base.corpus import chunk_count as corpus_chunk_count
+from protocol.cache_namespace import index_cache
 import logging
 
 logger = logging.getLogger('rag_tutor')
@@ -9,16 +10,23 @@ logger = logging.getLogger('rag_tutor')
 class Command(BaseCommand):
     help = 'Rebuild FAISS index from database content'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, metavar='N',
+                            help='Only rebuild shard N (requires FAISS_SHARD_COUNT > 1)')
+
     def handle(self, *args, **options):
-        self.stdout.write('Rebuilding FAISS index...')
+        shard_id = options['shard']
+        if shard_id is not None and not 0 <= shard_id < settings.FAISS_SHARD_COUNT:
+            raise CommandError(f'--shard must be between 0 and {settings.FAISS_SHARD_COUNT - 1}')
+        self.stdout.write('Rebuilding FAISS index...' if shard_id is None else f'Rebuilding FAISS shard {shard_id}...')
         
         try:
-            # Clear cache
-            cache.clear()
-            self.stdout.write('Cache cleared')
+            # Invalidate the cached index only
+            index_cache.invalidate()
+            self.stdout.write('Index cache invalidated')
             
-            # Get chunk count
-            chunk_count = ContentChunk.objects.filter(embedding_vector__isnull=False).count()
+            # Get chunk count (fresh: the invalidation above also dropped the cached stats)
+            chunk_count = corpus_chunk_count()
             self.stdout.write(f'Found {chunk_count} chunks with embeddings')
             
             if chunk_count == 0:
@@ -26,11 +34,17 @@ class Command(BaseCommand):
                 return
             
             # Rebuild index
-            faiss = FAISSDriver()
+            faiss = get_faiss_driver()
+            if shard_id is not None:
+                faiss.rebuild_index(shard_id=shard_id)
+                self.stdout.write(self.style.SUCCESS(
+                    f'FAISS shard {shard_id} rebuilt with {faiss.shard(shard_id).ntotal} vectors'
+                ))
+                return
             faiss.rebuild_index()
             
             # Verify
-            final_count = faiss.index.ntotal
+            final_count = faiss.ntotal
             self.stdout.write(f'FAISS index rebuilt with {final_count} vectors')
             
             if final_count == chunk_count:
@@ -0,0 +1,66 @@
+from datetime import timedelta
+from celery import current_app
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q
+from django.utils import timezone
+from knowledge_base.models import TextbookContent
+from knowledge_base.tasks import process_textbook_content, schedule_index_update
+import logging
+
+logger = logging.getLogger('rag_tutor')
+
+class Command(BaseCommand):
+    help = 'Finish partially processed textbooks, embedding only chunks that are still pending'
+
+    def add_arguments(self, parser):
+        parser.add_argument('textbook_ids', nargs='*', metavar='TEXTBOOK_ID',
+                            help='Textbooks to resume (default: every failed, stalled or incomplete one)')
+        parser.add_argument('--stale-minutes', type=int, default=30,
+                            help='Treat textbooks still "processing" without progress for this long as stalled')
+        parser.add_argument('--inline', action='store_true',
+                            help='Run the pipeline in this process instead of queueing it for the workers')
+        parser.add_argument('--dry-run', action='store_true', help='Only list what would be resumed')
+
+    def handle(self, *args, **options):
+        textbooks = TextbookContent.objects.annotate(
+            pending_chunks=Count('chunks', filter=Q(chunks__embedding_status='pending')),
+            stored_chunks=Count('chunks', filter=~Q(chunks__embedding_status='pending')),
+        ).order_by('uploaded_at')
+
+        if options['textbook_ids']:
+            textbooks = list(textbooks.filter(id__in=options['textbook_ids']))
+            if len(textbooks) != len(set(options['textbook_ids'])):
+                raise CommandError('Some of the given textbooks do not exist')
+        else:
+            stalled_before = timezone.now() - timedelta(minutes=options['stale_minutes'])
+            stalled = Q(processing_updated_at__isnull=True) | Q(processing_updated_at__lt=stalled_before)
+            textbooks = list(textbooks.filter(
+                Q(processing_status='failed')
+                | Q(processing_status='processing') & stalled
+                | Q(processing_status='completed', pending_chunks__gt=0)
+                | Q(processing_status='completed', processing_stage='index') & stalled
+            ))
+
+        if not textbooks:
+            self.stdout.write(self.style.SUCCESS('Nothing to resume'))
+            return
+
+        if options['inline']:
+            current_app.conf.task_always_eager = True
+        for textbook in textbooks:
+            self.stdout.write(
+                f"{textbook.id}  {textbook.title}  status={textbook.processing_status}  "
+                f"stage={textbook.processing_stage or '-'}  pending={textbook.pending_chunks}  "
+                f"reused={textbook.stored_chunks}"
+            )
+            if options['dry_run']:
+                continue
+            if textbook.processing_status == 'completed' and not textbook.pending_chunks:
+                # Embedded already; only the index writer never picked it up
+                schedule_index_update(textbook.id)
+            else:
+                process_textbook_content.delay(str(textbook.id))
+            logger.info(f"Resumed ingestion of textbook {textbook.id} ({textbook.pending_chunks} chunks pending)")
+
+        verb = 'Would resume' if options['dry_run'] else 'Resumed'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(textbooks)} textbooks'))
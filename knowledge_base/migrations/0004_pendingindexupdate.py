@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0003_querylog_rating_querylog_rating_comment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingIndexUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('textbook_id', models.UUIDField(unique=True)),
+                ('requested_at', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['requested_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:02
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_chunk_counts(apps, schema_editor):
+    TextbookContent = apps.get_model('knowledge_base', 'TextbookContent')
+    textbooks = TextbookContent.objects.annotate(
+        embedded=Count('chunks', filter=Q(chunks__embedding_vector__isnull=False))
+    )
+    updated = []
+    for textbook in textbooks.iterator():
+        textbook.chunk_count = textbook.embedded
+        updated.append(textbook)
+    TextbookContent.objects.bulk_update(updated, ['chunk_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0004_pendingindexupdate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textbookcontent',
+            name='chunk_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_chunk_counts, migrations.RunPython.noop),
+    ]
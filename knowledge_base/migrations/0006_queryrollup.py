@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0005_textbookcontent_chunk_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='querylog',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='QueryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=4)),
+                ('bucket_start', models.DateTimeField()),
+                ('persona', models.CharField(max_length=50)),
+                ('subject', models.CharField(blank=True, max_length=100)),
+                ('grade', models.CharField(blank=True, max_length=10)),
+                ('query_type', models.CharField(max_length=20)),
+                ('query_count', models.IntegerField(default=0)),
+                ('sourced_count', models.IntegerField(default=0)),
+                ('latency_count', models.IntegerField(default=0)),
+                ('latency_sum_ms', models.BigIntegerField(default=0)),
+                ('latency_histogram', models.JSONField(default=list)),
+                ('rating_count', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('rating_histogram', models.JSONField(default=list)),
+            ],
+            options={
+                'ordering': ['-bucket_start'],
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket_start', 'persona', 'subject', 'grade', 'query_type'), name='unique_query_rollup_bucket')],
+            },
+        ),
+    ]
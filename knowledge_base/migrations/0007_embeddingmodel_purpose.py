@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0006_queryrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='embeddingmodel',
+            name='purpose',
+            field=models.CharField(choices=[('embedding', 'Embedding'), ('chat', 'Chat')], default='embedding', max_length=20),
+        ),
+    ]
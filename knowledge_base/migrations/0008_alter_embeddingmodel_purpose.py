@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0007_embeddingmodel_purpose'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='embeddingmodel',
+            name='purpose',
+            field=models.CharField(choices=[('embedding', 'Embedding'), ('chat', 'Chat'), ('chat_fallback', 'Chat fallback (hedged requests)')], default='embedding', max_length=20),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0008_alter_embeddingmodel_purpose'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textbookcontent',
+            name='embed_batches_done',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='textbookcontent',
+            name='embed_batches_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='textbookcontent',
+            name='processing_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='textbookcontent',
+            name='processing_stage',
+            field=models.CharField(blank=True, choices=[('', 'Not started'), ('extract', 'Extracting'), ('chunk', 'Chunking'), ('embed', 'Embedding'), ('index', 'Indexing'), ('done', 'Done')], default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='textbookcontent',
+            name='processing_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
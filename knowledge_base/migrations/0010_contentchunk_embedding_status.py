@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:06
+
+from django.db import migrations, models
+
+
+def backfill_embedding_status(apps, schema_editor):
+    # Stored vectors of completed textbooks are what the index was built from
+    ContentChunk = apps.get_model('knowledge_base', 'ContentChunk')
+    stored = ContentChunk.objects.filter(embedding_vector__isnull=False)
+    stored.filter(textbook__processing_status='completed').update(embedding_status='indexed')
+    stored.exclude(textbook__processing_status='completed').update(embedding_status='embedded')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0009_textbookcontent_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contentchunk',
+            name='embedding_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('embedded', 'Embedded'), ('indexed', 'Indexed')], db_index=True, default='pending', max_length=20),
+        ),
+        migrations.RunPython(backfill_embedding_status, migrations.RunPython.noop),
+    ]
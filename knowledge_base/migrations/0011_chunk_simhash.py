@@ -0,0 +1,36 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_base', '0010_contentchunk_embedding_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contentchunk',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='knowledge_base.contentchunk'),
+        ),
+        migrations.AddField(
+            model_name='contentchunk',
+            name='simhash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='SimHashBand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('band', models.PositiveSmallIntegerField()),
+                ('value', models.IntegerField()),
+                ('chunk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simhash_bands', to='knowledge_base.contentchunk')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['band', 'value'], name='knowledge_b_band_423e8d_idx')],
+            },
+        ),
+    ]
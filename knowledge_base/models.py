@@ -59,6 +59,25 @@ class TextbookContent(models.Model):
         ],
         default='pending'
     )
+    chunk_count = models.IntegerField(default=0)  # Embedded chunks, set when processing completes
+    # Ingestion progress, updated by each stage of the knowledge_base.tasks pipeline
+    processing_stage = models.CharField(
+        max_length=20,
+        choices=[
+            ('', 'Not started'),
+            ('extract', 'Extracting'),
+            ('chunk', 'Chunking'),
+            ('embed', 'Embedding'),
+            ('index', 'Indexing'),
+            ('done', 'Done'),
+        ],
+        blank=True,
+        default=''
+    )
+    embed_batches_total = models.IntegerField(default=0)
+    embed_batches_done = models.IntegerField(default=0)
+    processing_error = models.TextField(blank=True, default='')
+    processing_updated_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
         ordering = ['-uploaded_at']
@@ -74,6 +93,21 @@ class ContentChunk(models.Model):
     start_char = models.IntegerField()
     end_char = models.IntegerField()
     embedding_vector = models.JSONField(null=True, blank=True)
+    # pending: no usable vector yet; embedded: vector stored; indexed: vector in the FAISS index
+    embedding_status = models.CharField(
+        max_length=20,
+        choices=[
+            ('pending', 'Pending'),
+            ('embedded', 'Embedded'),
+            ('indexed', 'Indexed'),
+        ],
+        default='pending',
+        db_index=True
+    )
+    # 64-bit SimHash of the text (signed, as stored); None for chunks too short to sign
+    simhash = models.BigIntegerField(null=True, blank=True)
+    # Earlier chunk this one nearly repeats (e.g. another edition); its embedding was reused
+    duplicate_of = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='duplicates')
     metadata = models.JSONField(default=dict)
     created_at = models.DateTimeField(auto_now_add=True)
     
@@ -84,10 +118,48 @@ class ContentChunk(models.Model):
     def __str__(self):
         return f"Chunk {self.chunk_index} of {self.textbook.title}"
 
+class SimHashBand(models.Model):
+    """LSH table over chunk SimHash signatures: one row per band of each canonical chunk.
+
+    Signatures within a few bits of each other share at least one band
+    value exactly, so an indexed (band, value) lookup finds the candidates.
+    """
+    chunk = models.ForeignKey(ContentChunk, on_delete=models.CASCADE, related_name='simhash_bands')
+    band = models.PositiveSmallIntegerField()
+    value = models.IntegerField()
+    
+    class Meta:
+        indexes = [models.Index(fields=['band', 'value'])]
+    
+    def __str__(self):
+        return f"Band {self.band}={self.value} of chunk {self.chunk_id}"
+
+class PendingIndexUpdate(models.Model):
+    """Textbook whose vectors must be re-synced by the single index writer"""
+    # No foreign key: a deleted textbook still needs its vectors removed
+    textbook_id = models.UUIDField(unique=True)
+    requested_at = models.DateTimeField()
+    
+    class Meta:
+        ordering = ['requested_at']
+    
+    def __str__(self):
+        return f"Index update for {self.textbook_id} requested at {self.requested_at}"
+
 class EmbeddingModel(models.Model):
     name = models.CharField(max_length=100, unique=True)
-    provider = models.CharField(max_length=50)  # openai, huggingface, etc.
+    provider = models.CharField(max_length=50)  # gemini, claude or local (protocol.llm_client.PROVIDERS)
     model_id = models.CharField(max_length=200)
+    # The active row of each purpose picks the provider LLMClient sends that kind of call to
+    purpose = models.CharField(
+        max_length=20,
+        choices=[
+            ('embedding', 'Embedding'),
+            ('chat', 'Chat'),
+            ('chat_fallback', 'Chat fallback (hedged requests)'),
+        ],
+        default='embedding'
+    )
     vector_dimension = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
@@ -111,7 +183,7 @@ class QueryLog(models.Model):
     response_text = models.TextField()
     retrieved_chunks = models.ManyToManyField(ContentChunk, blank=True)
     response_time_ms = models.IntegerField(null=True, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)  # Range-scanned by the analytics rollup
     persona_used = models.CharField(max_length=50, default='helpful_tutor')
     subject_filter = models.CharField(max_length=100, blank=True)
     grade_filter = models.CharField(max_length=10, blank=True)
@@ -170,4 +242,38 @@ class SystemMetrics(models.Model):
         ordering = ['-timestamp']
     
     def __str__(self):
-        return f"{self.metric_name}: {self.metric_value} {self.metric_unit}"
\ No newline at end of file
+        return f"{self.metric_name}: {self.metric_value} {self.metric_unit}"
+
+
+class QueryRollup(models.Model):
+    """Query counts, latency and ratings pre-aggregated per hour or day and dimension.
+
+    Maintained from ``QueryLog`` by the ``rollup_query_analytics`` beat task
+    so analytics views never scan the raw log.
+    """
+    granularity = models.CharField(max_length=4, choices=[('hour', 'Hourly'), ('day', 'Daily')])
+    bucket_start = models.DateTimeField()
+    persona = models.CharField(max_length=50)
+    subject = models.CharField(max_length=100, blank=True)
+    grade = models.CharField(max_length=10, blank=True)
+    query_type = models.CharField(max_length=20)
+    query_count = models.IntegerField(default=0)
+    sourced_count = models.IntegerField(default=0)  # Queries answered from retrieved chunks
+    latency_count = models.IntegerField(default=0)  # Queries with a recorded response time
+    latency_sum_ms = models.BigIntegerField(default=0)
+    latency_histogram = models.JSONField(default=list)  # Counts per ANALYTICS_LATENCY_BUCKETS_MS bound, plus overflow
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    rating_histogram = models.JSONField(default=list)  # Counts of ratings 1-5
+    
+    class Meta:
+        ordering = ['-bucket_start']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket_start', 'persona', 'subject', 'grade', 'query_type'],
+                name='unique_query_rollup_bucket'
+            )
+        ]
+    
+    def __str__(self):
+        return f"{self.query_count} {self.query_type} queries in {self.granularity} from {self.bucket_start}"
@@ -29,18 +29,16 @@ class TextbookContentSerializer(serializers.ModelSerializer):
     subject = SubjectSerializer(read_only=True)
     grade = GradeSerializer(read_only=True)
     uploaded_by = serializers.CharField(source='uploaded_by.username', read_only=True)
-    chunks_count = serializers.SerializerMethodField()
+    chunks_count = serializers.IntegerField(source='chunk_count', read_only=True)
     
     class Meta:
         model = TextbookContent
         fields = [
             'id', 'title', 'subject', 'grade', 'file', 'content_text',
             'metadata', 'uploaded_by', 'uploaded_at', 'is_processed',
-            'processing_status', 'chunks_count'
+            'processing_status', 'chunks_count', 'processing_stage',
+            'embed_batches_total', 'embed_batches_done', 'processing_error', 'processing_updated_at'
         ]
-    
-    def get_chunks_count(self, obj):
-        return obj.chunks.count()
 
 class QueryLogSerializer(serializers.ModelSerializer):
     user = serializers.SerializerMethodField()
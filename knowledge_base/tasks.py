@@ -1,32 +1,90 @@
-from celery import shared_task
+from celery import Task, chain, chord, shared_task
 from django.conf import settings
-from knowledge_base.models import TextbookContent, ContentChunk
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from knowledge_base.models import TextbookContent, ContentChunk, PendingIndexUpdate
+from knowledge_base.corpus import invalidate_corpus_stats
+from knowledge_base.dedup import link_near_duplicates
+from knowledge_base.analytics import rollup_queries
 from context.embedding_manager import EmbeddingManager
-from protocol.gemini_client import GeminiClient
-from protocol.faiss_driver import FAISSDriver
+from protocol.llm_client import LLMClient, LLMUnavailable
+from protocol.faiss_driver import FAISSDriver, usable_embedding
+from protocol.faiss_shards import get_faiss_driver, shard_snapshot_dir
+from protocol.cache_namespace import index_cache
 import logging
 
 logger = logging.getLogger('rag_tutor')
 
+class IngestionTask(Task):
+    """Base for the ingestion stages: a stage that fails for good marks its textbook failed.
+
+    ``on_failure`` only runs once retries are exhausted, so a batch waiting
+    out an open circuit leaves the textbook in ``processing``. Every stage
+    is idempotent, so messages are acknowledged only after the task ran and
+    a stage lost with its worker is delivered again.
+    """
+    acks_late = True
+    reject_on_worker_lost = True
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        textbook_id = args[0] if args else kwargs.get('textbook_id')
+        logger.error(f"Ingestion task {self.name} failed for textbook {textbook_id}: {str(exc)}")
+        TextbookContent.objects.filter(id=textbook_id).update(
+            processing_status='failed',
+            processing_error=f"{self.name.rsplit('.', 1)[-1]}: {exc}"[:2000],
+            processing_updated_at=timezone.now()
+        )
+
+
+def set_progress(textbook_id, **fields):
+    """Record ingestion progress on the textbook row without touching its other fields"""
+    TextbookContent.objects.filter(id=textbook_id).update(processing_updated_at=timezone.now(), **fields)
+
+
 @shared_task
-def process_textbook_content(textbook_id):
-    """Process uploaded textbook content by chunking, embedding, and indexing"""
-    try:
-        logger.info(f"Starting processing for textbook {textbook_id}")
-        textbook = TextbookContent.objects.get(id=textbook_id)
-        textbook.processing_status = 'processing'
-        textbook.save()
+def process_textbook_content(textbook_id, rechunk=False):
+    """Ingest a textbook: extract -> chunk -> chord of embedding batches -> index merge.
+
+    Each stage is its own task, so embedding batches spread over every
+    worker. Running it again is idempotent: existing chunks are kept and
+    only chunks still ``pending`` are embedded, so a retry after a crash
+    repeats no finished embedding calls. ``rechunk=True`` discards the
+    chunks and starts over, for when the text itself changed.
+    """
+    logger.info(f"Starting processing for textbook {textbook_id}{' (rechunk)' if rechunk else ''}")
+    set_progress(textbook_id, processing_status='processing', processing_error='')
+    pipeline = chain(
+        extract_textbook_text.si(textbook_id, rechunk),
+        chunk_textbook.si(textbook_id),
+    )
+    return pipeline.apply_async().id
+
+
+@shared_task(base=IngestionTask)
+def extract_textbook_text(textbook_id, rechunk=False):
+    """Stage 1: check the extracted text; with ``rechunk`` clear earlier results"""
+    textbook = TextbookContent.objects.get(id=textbook_id)
+    if not textbook.content_text.strip():
+        raise ValueError("No text extracted from the uploaded file.")
 
-        # Clean up any existing chunks for this textbook (idempotency)
+    if rechunk:
         ContentChunk.objects.filter(textbook=textbook).delete()
+        set_progress(textbook_id, is_processed=False, chunk_count=0)
+    set_progress(textbook_id, processing_stage='extract')
+    return len(textbook.content_text)
 
-        # Initialize helpers
-        embedding_manager = EmbeddingManager()
-        gemini_client = GeminiClient()
-        faiss_driver = FAISSDriver()
 
-        # Chunk the content
-        logger.info(f"Chunking content for textbook {textbook_id}")
+@shared_task(bind=True, base=IngestionTask)
+def chunk_textbook(self, textbook_id):
+    """Stage 2: split the text into chunks (once), then fan the pending ones out as a chord of batches"""
+    textbook = TextbookContent.objects.select_related('subject', 'grade').get(id=textbook_id)
+    set_progress(textbook_id, processing_stage='chunk')
+
+    resumed = ContentChunk.objects.filter(textbook=textbook).exists()
+    if not resumed:
+        embedding_manager = EmbeddingManager()
         chunks_data = embedding_manager.chunk_text(
             textbook.content_text,
             chunk_size=settings.CHUNK_SIZE,
@@ -34,64 +92,185 @@ def process_textbook_content(textbook_id):
         )
         if not chunks_data:
             raise ValueError("No chunks generated from content text.")
+        # All or nothing, so an existing chunk set is always complete and deduplicated
+        with transaction.atomic():
+            chunks = ContentChunk.objects.bulk_create([
+                ContentChunk(
+                    textbook=textbook,
+                    chunk_text=chunk_data['text'],
+                    chunk_index=i,
+                    start_char=chunk_data['start'],
+                    end_char=chunk_data['end'],
+                    simhash=embedding_manager.simhash(chunk_data['text']),
+                    metadata={
+                        'token_count': chunk_data['token_count'],
+                        'textbook_title': textbook.title,
+                        'subject': textbook.subject.name,
+                        'grade': textbook.grade.level
+                    }
+                )
+                for i, chunk_data in enumerate(chunks_data)
+            ], batch_size=1000)
+            # Chunks repeating another textbook's (e.g. an earlier edition) reuse its embeddings
+            duplicates = link_near_duplicates(textbook_id, chunks)
+        logger.info(f"Created {len(chunks_data)} chunks for textbook {textbook_id} ({duplicates} near-duplicates)")
+
+    # Chunks embedded before a crash or failure are not sent again
+    pending = [
+        str(chunk_id) for chunk_id in ContentChunk.objects.filter(
+            textbook=textbook, embedding_status='pending'
+        ).order_by('chunk_index').values_list('id', flat=True)
+    ]
+    size = settings.INGEST_EMBED_BATCH_SIZE
+    batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+    done = textbook.embed_batches_done if resumed else 0
+    set_progress(textbook_id, processing_stage='embed', embed_batches_total=done + len(batches),
+                 embed_batches_done=done)
+    logger.info(f"Embedding {len(pending)} pending chunks of textbook {textbook_id} in {len(batches)} batches")
+
+    merge = merge_textbook_index.si(textbook_id)
+    if not batches:
+        return self.replace(merge)
+    return self.replace(chord([embed_chunk_batch.si(textbook_id, batch) for batch in batches], merge))
+
 
-        # Create ContentChunk objects
-        chunks = []
-        for i, chunk_data in enumerate(chunks_data):
-            chunk = ContentChunk.objects.create(
-                textbook=textbook,
-                chunk_text=chunk_data['text'],
-                chunk_index=i,
-                start_char=chunk_data['start'],
-                end_char=chunk_data['end'],
-                metadata={
-                    'token_count': chunk_data['token_count'],
-                    'textbook_title': textbook.title,
-                    'subject': textbook.subject.name,
-                    'grade': textbook.grade.level
-                }
-            )
-            chunks.append(chunk)
-        logger.info(f"Created {len(chunks)} chunks for textbook {textbook_id}")
-
-        # Generate embeddings for all chunks
-        logger.info(f"Generating embeddings for {len(chunks)} chunks")
-        chunk_texts = [chunk.chunk_text for chunk in chunks]
-        embeddings = gemini_client.generate_batch_embeddings(chunk_texts)
-        if len(embeddings) != len(chunks):
-            raise ValueError(f"Mismatch between embeddings ({len(embeddings)}) and chunks ({len(chunks)})")
-
-        # Store embeddings in chunks and add to FAISS
-        logger.info(f"Storing embeddings and adding to FAISS index")
-        for chunk, embedding in zip(chunks, embeddings):
+@shared_task(base=IngestionTask, autoretry_for=(LLMUnavailable,), retry_backoff=True,
+             retry_backoff_max=300, max_retries=8)
+def embed_chunk_batch(textbook_id, chunk_ids):
+    """Stage 3 (chord header): embed one batch of pending chunks and checkpoint the vectors.
+
+    Retried with backoff while the provider is unavailable (open circuit,
+    no free slot). Usable vectors are stored and their chunks marked
+    ``embedded`` even if others in the batch came back empty or zero;
+    those stay ``pending`` and fail the batch, so nothing unusable is
+    stored and a resume only re-embeds them.
+    """
+    chunks = list(ContentChunk.objects.filter(id__in=chunk_ids, embedding_status='pending').only('id', 'chunk_text'))
+    if not chunks:
+        set_progress(textbook_id, embed_batches_done=F('embed_batches_done') + 1)
+        return 0
+
+    embeddings = LLMClient().generate_batch_embeddings([chunk.chunk_text for chunk in chunks])
+    if len(embeddings) != len(chunks):
+        raise ValueError(f"Mismatch between embeddings ({len(embeddings)}) and chunks ({len(chunks)})")
+    embedded = []
+    for chunk, embedding in zip(chunks, embeddings):
+        if usable_embedding(embedding, settings.EMBEDDING_DIMENSION):
             chunk.embedding_vector = embedding
-            chunk.save()
-        faiss_driver.add_embeddings(str(textbook_id), embeddings)
-
-        # Update textbook status
-        textbook.is_processed = True
-        textbook.processing_status = 'completed'
-        textbook.save()
-        logger.info(f"Successfully processed textbook {textbook_id} with {len(chunks)} chunks")
-
-        # --- NEW: Clear cache and rebuild FAISS index ---
-        from django.core.cache import cache
-        cache.clear()
-        logger.info('Cache cleared after processing textbook')
-        faiss_driver.rebuild_index()
-        logger.info('FAISS index rebuilt after processing textbook')
-        # --- END NEW ---
-
-    except TextbookContent.DoesNotExist:
-        logger.error(f"Textbook {textbook_id} not found")
+            chunk.embedding_status = 'embedded'
+            embedded.append(chunk)
+
+    with transaction.atomic():
+        ContentChunk.objects.bulk_update(embedded, ['embedding_vector', 'embedding_status'], batch_size=500)
+        if len(embedded) == len(chunks):
+            set_progress(textbook_id, embed_batches_done=F('embed_batches_done') + 1)
+    if len(embedded) < len(chunks):
+        raise ValueError(
+            f"{len(chunks) - len(embedded)} of {len(chunks)} chunks got an empty or zero embedding "
+            f"(is the embedding provider configured?); they stay pending"
+        )
+    return len(embedded)
+
+
+@shared_task(base=IngestionTask)
+def merge_textbook_index(textbook_id):
+    """Stage 4 (chord body): mark the textbook processed and hand it to the index writer"""
+    chunks = ContentChunk.objects.filter(textbook_id=textbook_id)
+    missing = chunks.filter(embedding_status='pending').count()
+    if missing:
+        raise ValueError(f"{missing} chunks are still pending after all batches finished")
+
+    chunk_count = chunks.count()
+    set_progress(textbook_id, processing_stage='index', processing_status='completed', is_processed=True,
+                 chunk_count=chunk_count)
+    invalidate_corpus_stats()
+    logger.info(f"Successfully processed textbook {textbook_id} with {chunk_count} chunks")
+
+    # The single index writer adds the vectors, batched with any other pending changes
+    schedule_index_update(textbook_id)
+    return chunk_count
+
+
+def schedule_index_update(textbook_id):
+    """Queue a textbook for the index writer; repeated requests coalesce into one batch"""
+    PendingIndexUpdate.objects.update_or_create(
+        textbook_id=textbook_id,
+        defaults={'requested_at': timezone.now()}
+    )
+    # At most one writer run is scheduled per coalescing window
+    if cache.add('rag_tutor:index_writer:scheduled', True, timeout=settings.INDEX_UPDATE_COALESCE_SECONDS):
+        apply_index_updates.apply_async(countdown=settings.INDEX_UPDATE_COALESCE_SECONDS)
+
+
+@shared_task
+def apply_index_updates():
+    """Apply all pending textbook index updates as a single snapshot write.
+
+    Routed to the dedicated ``index_writer`` queue, which runs with
+    concurrency 1; the snapshot write lock also serialises it against
+    rebuilds started from the web process or management commands.
+    """
+    pending = list(PendingIndexUpdate.objects.order_by('requested_at')[:settings.INDEX_UPDATE_BATCH_SIZE])
+    if not pending:
+        return {'textbooks': 0}
+
+    faiss_driver = get_faiss_driver()
+    result = faiss_driver.apply_textbook_updates([update.textbook_id for update in pending])
+    index_cache.invalidate()
+    TextbookContent.objects.filter(
+        id__in=[update.textbook_id for update in pending], processing_stage='index'
+    ).update(processing_stage='done', processing_updated_at=timezone.now())
+
+    # Rows re-requested while the batch was running keep their newer timestamp and stay queued
+    for update in pending:
+        PendingIndexUpdate.objects.filter(
+            textbook_id=update.textbook_id,
+            requested_at__lte=update.requested_at
+        ).delete()
+
+    if PendingIndexUpdate.objects.exists():
+        apply_index_updates.apply_async(countdown=settings.INDEX_UPDATE_COALESCE_SECONDS)
+
+    logger.info(f"Index writer applied {len(pending)} textbook updates: {result}")
+    return dict(result, textbooks=len(pending))
+
+
+@shared_task
+def rollup_query_analytics():
+    """Periodic (beat) fold of new query logs into the analytics rollups"""
+    # A backfill can outlast the beat interval; overlapping runs would only redo the same work
+    if not cache.add('rag_tutor:analytics_rollup:running', True, timeout=settings.ANALYTICS_ROLLUP_INTERVAL * 4):
+        logger.info("Analytics rollup already running, skipping this run")
+        return {'skipped': True}
+    try:
+        return rollup_queries()
     except Exception as e:
-        logger.error(f"Error processing textbook {textbook_id}: {str(e)}", exc_info=True)
-        # Update status to failed
-        try:
-            textbook = TextbookContent.objects.get(id=textbook_id)
-            textbook.processing_status = 'failed'
-            textbook.save()
-        except Exception:
-            pass
+        logger.error(f"Analytics rollup failed: {str(e)}")
         raise
+    finally:
+        cache.delete('rag_tutor:analytics_rollup:running')
+
+
+# Shard drivers held by this worker process, reloaded when a new snapshot is promoted
+_shard_drivers = {}
+
+
+@shared_task
+def search_shard(shard_id, query_embedding, top_k, filters, with_vectors=False, neighbor_window=0):
+    """Search one FAISS shard for ShardedFAISSDriver's ``celery`` backend.
 
+    Sent to the ``faiss_shard_<n>`` queue so each shard worker only loads
+    its own partition of the index.
+    """
+    driver = _shard_drivers.get(shard_id)
+    if driver is None or driver.is_stale():
+        driver = FAISSDriver(snapshot_dir=shard_snapshot_dir(shard_id), shard_id=shard_id)
+        _shard_drivers[shard_id] = driver
+    results = driver.search(
+        query_embedding, top_k=top_k, filters=filters, with_vectors=with_vectors, neighbor_window=neighbor_window
+    )
+    for result in results:
+        if 'vector' in result:
+            # JSON result backend
+            result['vector'] = result['vector'].tolist()
+    return results
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('rag_tutor')
+
+KEY_PREFIX = 'rag_tutor'
+_UNSET = object()
+
+
+class CacheNamespace:
+    """Versioned group of cache keys that can be invalidated as a unit.
+
+    Every key embeds the namespace's current version, so invalidating bumps
+    the version instead of flushing the cache, and other namespaces keep
+    their hit rate. Entries from older versions are never read again; with
+    ``track_keys`` the keys written under a version are recorded and deleted
+    when it is invalidated, otherwise they only go once their timeout
+    expires (never, with ``timeout=None``).
+    """
+
+    def __init__(self, name: str, timeout: Optional[int] = None, track_keys: bool = False):
+        self.name = name
+        self.timeout = timeout
+        self.track_keys = track_keys
+
+    @property
+    def version_key(self) -> str:
+        return f"{KEY_PREFIX}:{self.name}:version"
+
+    def version(self) -> int:
+        """Current version, initialised on first use"""
+        version = cache.get(self.version_key)
+        if version is None:
+            # Seed from the clock so a lost version key cannot resurrect old entries
+            cache.add(self.version_key, int(time.time() * 1000), timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def make_key(self, key: str, version: Optional[int] = None) -> str:
+        return f"{KEY_PREFIX}:{self.name}:v{self.version() if version is None else version}:{key}"
+
+    def _registry_key(self, version: int) -> str:
+        return f"{KEY_PREFIX}:{self.name}:v{version}:_keys"
+
+    def _track(self, keys: List[str], timeout: Any):
+        """Record keys written under the current version; a lost race only leaves a key to its timeout"""
+        registry_key = self._registry_key(self.version())
+        known = set(cache.get(registry_key) or ())
+        if not known.issuperset(keys):
+            cache.set(registry_key, sorted(known.union(keys)), timeout=timeout)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return cache.get(self.make_key(key), default)
+
+    def set(self, key: str, value: Any, timeout: Any = _UNSET):
+        timeout = self.timeout if timeout is _UNSET else timeout
+        if self.track_keys:
+            self._track([key], timeout)
+        cache.set(self.make_key(key), value, timeout=timeout)
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """Values of the keys that are present, in one cache round trip"""
+        prefix = self.make_key('')
+        found = cache.get_many([prefix + key for key in keys])
+        return {key[len(prefix):]: value for key, value in found.items()}
+
+    def set_many(self, values: Dict[str, Any], timeout: Any = _UNSET):
+        timeout = self.timeout if timeout is _UNSET else timeout
+        if self.track_keys:
+            self._track(list(values), timeout)
+        prefix = self.make_key('')
+        cache.set_many({prefix + key: value for key, value in values.items()}, timeout=timeout)
+
+    def delete(self, key: str):
+        cache.delete(self.make_key(key))
+
+    def invalidate(self) -> int:
+        """Bump the version so every key in this namespace misses, and drop the old version's tracked keys"""
+        previous = cache.get(self.version_key)
+        try:
+            version = cache.incr(self.version_key)
+        except ValueError:
+            # Version key missing; seeding a fresh one is an invalidation too
+            version = self.version()
+        if self.track_keys and previous is not None:
+            registry_key = self._registry_key(previous)
+            stale = [self.make_key(key, previous) for key in cache.get(registry_key) or ()]
+            cache.delete_many(stale + [registry_key])
+        logger.info(f"Cache namespace '{self.name}' invalidated (now v{version})")
+        return version
+
+
+def text_digest(text: str) -> str:
+    """Stable short key for arbitrary text"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# The FAISS index copy shared between processes; bumped whenever content changes. Each version holds
+# a whole pickled index, so it is deleted on invalidation and expires even if that is missed
+index_cache = CacheNamespace('index', timeout=settings.RAG_INDEX_CACHE_TTL, track_keys=True)
+# Embeddings are keyed by model and text, so content churn never invalidates them
+embedding_cache = CacheNamespace('embeddings', timeout=settings.EMBEDDING_CACHE_TIMEOUT)
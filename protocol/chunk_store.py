@@ -0,0 +1,79 @@
+import os
+from typing import List, Optional
+
+import numpy as np
+
+TEXT_FILE = 'chunks.bin'
+OFFSETS_FILE = 'chunk_offsets.npy'
+
+
+class ChunkTextStore:
+    """Chunk texts by FAISS position: one UTF-8 blob plus an offsets array.
+
+    Opened from a snapshot both files are memory-mapped, so a lookup reads
+    only the bytes of the chunks asked for and the store costs no resident
+    memory. Appended texts are held in memory and removals only drop their
+    spans until ``write`` saves a compacted blob with the next snapshot.
+    """
+
+    def __init__(self, blob: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None):
+        self.blob = blob if blob is not None else np.zeros(0, dtype=np.uint8)
+        offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        # Row i spans [starts[i], ends[i]); offsets past the blob address the pending bytes
+        self.starts = offsets[:-1]
+        self.ends = offsets[1:]
+        self.pending = bytearray()
+
+    @classmethod
+    def open(cls, directory: str) -> Optional['ChunkTextStore']:
+        """Memory-map the store saved in a snapshot directory, or None if it has none"""
+        text_path = os.path.join(directory, TEXT_FILE)
+        offsets_path = os.path.join(directory, OFFSETS_FILE)
+        if not (os.path.exists(text_path) and os.path.exists(offsets_path)):
+            return None
+        # np.memmap cannot map an empty file
+        blob = np.memmap(text_path, dtype=np.uint8, mode='r') if os.path.getsize(text_path) else None
+        return cls(blob, np.load(offsets_path, mmap_mode='r'))
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def get(self, position: int) -> str:
+        return self._bytes(position).decode('utf-8')
+
+    def append(self, texts: List[str]):
+        encoded = [text.encode('utf-8') for text in texts]
+        lengths = np.array([len(data) for data in encoded], dtype=np.int64)
+        ends = len(self.blob) + len(self.pending) + np.cumsum(lengths)
+        self.pending.extend(b''.join(encoded))
+        self.starts = np.concatenate([self.starts, ends - lengths])
+        self.ends = np.concatenate([self.ends, ends])
+
+    def remove(self, positions: List[int]):
+        self.starts = np.delete(self.starts, positions)
+        self.ends = np.delete(self.ends, positions)
+
+    def write(self, directory: str):
+        """Save a compacted blob and offsets into a snapshot directory"""
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        with open(os.path.join(directory, TEXT_FILE), 'wb') as f:
+            if len(self) and self.starts[0] == 0 and np.array_equal(self.starts[1:], self.ends[:-1]):
+                # Nothing removed since the last save: copy the blob and pending bytes as they are
+                total = int(self.ends[-1])
+                f.write(memoryview(self.blob[:total]))
+                f.write(self.pending[:max(0, total - len(self.blob))])
+                offsets[:-1] = self.starts
+                offsets[-1] = total
+            else:
+                for position in range(len(self)):
+                    data = self._bytes(position)
+                    f.write(data)
+                    offsets[position + 1] = offsets[position] + len(data)
+        np.save(os.path.join(directory, OFFSETS_FILE), offsets)
+
+    def _bytes(self, position: int) -> bytes:
+        start, end = int(self.starts[position]), int(self.ends[position])
+        base = len(self.blob)
+        if start >= base:
+            return bytes(self.pending[start - base:end - base])
+        return self.blob[start:end].tobytes()
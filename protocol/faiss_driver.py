@@ -3,123 +3,373 @@ import numpy as np
 import os
 import json
 import pickle
-from typing import List, Dict, Any, Optional
+import zlib
+from typing import List, Dict, Any, Optional, Tuple
 from django.conf import settings
 from knowledge_base.models import ContentChunk, TextbookContent
 import logging
-from django.core.cache import cache
 from celery import shared_task
+from protocol.cache_namespace import index_cache
+from protocol.chunk_store import ChunkTextStore
+from protocol.index_snapshots import SnapshotStore
+from rag_tutor.tracing import trace, tracing
 
 logger = logging.getLogger('rag_tutor')
 
+# Compressed index types; 'flat' keeps exact float32 vectors in the index
+QUANTIZED_INDEX_TYPES = ('sq8', 'sqfp16', 'pq')
+VECTORS_FILE = 'vectors.npy'
+PCA_FILE = 'pca.bin'
+
+
+def shard_for(textbook_id: str, subject: Optional[str], shard_count: int, shard_by: str = 'hash') -> int:
+    """Shard that owns a textbook's chunks.
+
+    A textbook's chunks always land on one shard, so updating or deleting a
+    textbook only rewrites that shard. ``subject`` partitioning keeps each
+    subject on one shard so subject-filtered searches touch a single shard.
+    """
+    if shard_count <= 1:
+        return 0
+    key = subject if shard_by == 'subject' and subject else str(textbook_id)
+    return zlib.crc32(key.encode('utf-8')) % shard_count
+
+
+def duplicate_group(hit: Dict[str, Any]) -> str:
+    """Chunk id shared by a hit and its near-duplicates (the canonical chunk's), for collapsing results"""
+    return hit['metadata'].get('canonical_id') or hit['id']
+
+
+def usable_embedding(embedding: Optional[List[float]], dimension: int) -> bool:
+    """False for missing, wrong-sized, non-finite or all-zero vectors (the fallback dummy embeddings)"""
+    if not embedding or len(embedding) != dimension:
+        return False
+    array = np.asarray(embedding, dtype=np.float32)
+    return bool(np.isfinite(array).all() and array.any())
+
+
+def new_quantized_index(index_type: str, dimension: int, pq_m: int = 96):
+    """Empty inner-product index of a quantized type (untrained for sq8 and pq)"""
+    if index_type == 'sq8':
+        return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    if index_type == 'sqfp16':
+        return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    if index_type == 'pq':
+        if dimension % pq_m != 0:
+            # e.g. a PCA-reduced dimension; use the largest sub-quantizer count that divides it
+            divisor = max(m for m in range(1, pq_m + 1) if dimension % m == 0)
+            logger.warning(f"FAISS_PQ_M={pq_m} does not divide dimension {dimension}, using {divisor}")
+            pq_m = divisor
+        return faiss.IndexPQ(dimension, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown FAISS_INDEX_TYPE '{index_type}'")
+
+
+def train_pca(vectors: np.ndarray, output_dimension: int):
+    """PCA projection from the embedding dimension down to ``output_dimension``"""
+    pca = faiss.PCAMatrix(vectors.shape[1], output_dimension)
+    pca.train(np.ascontiguousarray(vectors, dtype=np.float32))
+    return pca
+
+
+def project(pca, vectors: np.ndarray) -> np.ndarray:
+    """Apply PCA to normalised vectors and re-normalise, so inner product stays cosine similarity"""
+    if pca is None:
+        return vectors
+    projected = pca.apply(np.ascontiguousarray(vectors, dtype=np.float32))
+    faiss.normalize_L2(projected)
+    return projected
+
+
+def search_reranked(index, vectors: Optional[np.ndarray], query_array: np.ndarray, k: int,
+                    rerank_factor: int = 10, pca=None):
+    """Top-k (scores, positions) for one normalised query.
+    
+    The index is searched in its own space (PCA-projected when ``pca`` is
+    set). With ``vectors`` (original full-precision embeddings, row per
+    position) it is over-fetched by ``rerank_factor`` and the candidates
+    are re-scored exactly against the original query, so quantization and
+    projection error only affect which rows are considered.
+    """
+    index_query = project(pca, query_array)
+    if vectors is None:
+        scores, indices = index.search(index_query, k)
+        return scores[0], indices[0]
+    
+    candidate_k = min(k * rerank_factor, index.ntotal)
+    _, indices = index.search(index_query, candidate_k)
+    # Sorted positions keep reads from a memory-mapped file sequential
+    positions = np.sort(indices[0][indices[0] != -1])
+    exact_scores = np.asarray(vectors[positions], dtype=np.float32) @ query_array[0]
+    order = np.argsort(-exact_scores)[:k]
+    return exact_scores[order], positions[order]
+
+
+def mmr_select(vectors: np.ndarray, relevance: np.ndarray, k: int, mmr_lambda: float = 0.7,
+               duplicate_threshold: float = 1.0) -> List[int]:
+    """Indices of ``k`` rows chosen by maximal marginal relevance.
+    
+    Each step picks the row maximising ``lambda * relevance - (1 - lambda) *
+    max similarity to the rows already picked``. Rows at least
+    ``duplicate_threshold`` similar to a picked row are skipped while any
+    other row is left, so near-duplicates only fill otherwise empty slots.
+    """
+    count = len(vectors)
+    k = min(k, count)
+    if k == 0:
+        return []
+    
+    # Relevance on the same 0..1 scale as cosine similarity, whatever scorer produced it
+    relevance = np.asarray(relevance, dtype=np.float32)
+    spread = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones_like(relevance)
+    similarity = vectors @ vectors.T
+    
+    selected = []
+    available = np.ones(count, dtype=bool)
+    max_similarity = np.zeros(count, dtype=np.float32)
+    for _ in range(k):
+        if selected:
+            scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        distinct = available & (max_similarity < duplicate_threshold)
+        if selected and distinct.any():
+            scores[~distinct] = -np.inf
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        available[pick] = False
+        max_similarity = np.maximum(max_similarity, similarity[pick])
+    return selected
+
+
+def diversify(hits: List[Dict[str, Any]], top_k: int, mmr_lambda: float, duplicate_threshold: float) -> List[Dict[str, Any]]:
+    """Pick ``top_k`` search hits (returned ``with_vectors``) by MMR over their stored vectors"""
+    if len(hits) <= 1 or any(hit.get('vector') is None for hit in hits):
+        return hits[:top_k]
+    vectors = np.array([hit['vector'] for hit in hits], dtype=np.float32)
+    relevance = [hit.get('rerank_score', hit['score']) for hit in hits]
+    return [hits[i] for i in mmr_select(vectors, relevance, top_k, mmr_lambda, duplicate_threshold)]
+
+
 class FAISSDriver:
-    def __init__(self):
-        # Try to get from cache
-        cached = cache.get('faiss_driver')
-        if cached:
+    def __init__(self, snapshot_dir: Optional[str] = None, shard_id: Optional[int] = None):
+        self.index_path = settings.FAISS_INDEX_PATH  # Legacy single-file index, read if no snapshot exists
+        self.snapshots = SnapshotStore(snapshot_dir or settings.FAISS_SNAPSHOT_DIR)
+        self.shard_id = shard_id  # None for the unsharded index
+        self.cache_key = 'faiss_driver' if shard_id is None else f'faiss_driver:shard{shard_id}'
+        
+        # Try to get from cache, ignoring copies of an older index version
+        cached = index_cache.get(self.cache_key)
+        if cached and getattr(cached, 'source_version', None) == self.disk_version():
             self.index_path = cached.index_path
             self.dimension = cached.dimension
             self.index = cached.index
             self.id_mapping = cached.id_mapping
             self.metadata = cached.metadata
+            self.version = cached.version
+            self.source_version = cached.source_version
+            self.pca = self._open_pca(self.version)
+            self.vectors = self._open_vectors(self.version) if self._needs_full_vectors() else None
+            self.texts = self._open_texts(self.version)
+            self._index_chunk_positions()
             return
-        self.index_path = settings.FAISS_INDEX_PATH
-        self.dimension = 768  # Gemini embedding dimension
+        self.dimension = settings.EMBEDDING_DIMENSION  # Dimension of stored and query embeddings
         self.index = None
+        self.pca = None       # PCA projection applied before the index, if trained
         self.id_mapping = {}  # Maps FAISS index to chunk IDs
         self.metadata = {}    # Stores metadata for each chunk
+        self.chunk_positions = {}  # (textbook_id, chunk_index) -> position, for neighbour lookups
+        self.version = '0'    # Snapshot version held in memory
+        self.vectors = None   # Full-precision vectors for re-ranking a quantized index
+        self.texts = ChunkTextStore()  # Chunk text by position, so search results need no SQL
         
         # Ensure directory exists
         os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
         
         # Load existing index or create new one
+        self.source_version = self.disk_version()
         self._load_or_create_index()
         # Cache self for future use
-        cache.set('faiss_driver', self, timeout=None)
+        index_cache.set(self.cache_key, self)
+    
+    def __getstate__(self):
+        # The full-precision vectors, PCA matrix and neighbour table are rebuilt on restore, never copied into the cache
+        state = self.__dict__.copy()
+        state['vectors'] = None
+        state['pca'] = None
+        state['texts'] = None
+        state['chunk_positions'] = {}
+        return state
+    
+    @property
+    def ntotal(self) -> int:
+        """Number of vectors in the loaded index"""
+        return self.index.ntotal if self.index is not None else 0
+    
+    def disk_version(self) -> str:
+        """Snapshot version currently promoted on disk ('0' if none has been saved)"""
+        return self.snapshots.current_version() or '0'
+    
+    def is_stale(self) -> bool:
+        """True once another process has promoted a different snapshot"""
+        return self.disk_version() != self.source_version
     
     def _load_or_create_index(self):
-        """Load existing FAISS index or create a new one"""
+        """Load the newest valid snapshot, the legacy index, or create a new one"""
         try:
-            if os.path.exists(f"{self.index_path}.faiss"):
-                self.index = faiss.read_index(f"{self.index_path}.faiss")
+            version = self.snapshots.loadable_version()
+            if version:
+                snapshot_path = self.snapshots.path(version)
+                index_file = os.path.join(snapshot_path, 'index.faiss')
+                metadata_file = os.path.join(snapshot_path, 'metadata.pkl')
+            elif self.shard_id is None and os.path.exists(f"{self.index_path}.faiss"):
+                index_file = f"{self.index_path}.faiss"
+                metadata_file = f"{self.index_path}.metadata"
+            else:
+                index_file = None
+            
+            if index_file:
+                self.index = faiss.read_index(index_file)
+                self.pca = self._open_pca(version)
                 
                 # Check if the loaded index has the correct dimension
-                if self.index.d != self.dimension:
-                    logger.warning(f"FAISS index dimension mismatch: expected {self.dimension}, got {self.index.d}. Rebuilding index.")
+                input_dimension = self.pca.d_in if self.pca is not None else self.index.d
+                if input_dimension != self.dimension:
+                    logger.warning(f"FAISS index dimension mismatch: expected {self.dimension}, got {input_dimension}. Rebuilding index.")
                     self.index = faiss.IndexFlatIP(self.dimension)
+                    self.pca = None
                     self.id_mapping = {}
                     self.metadata = {}
+                    self.vectors = None
+                    self.texts = ChunkTextStore()
                     logger.info("Created new FAISS index with correct dimension")
                 else:
                     # Load metadata
-                    with open(f"{self.index_path}.metadata", 'rb') as f:
+                    with open(metadata_file, 'rb') as f:
                         data = pickle.load(f)
                         self.id_mapping = data['id_mapping']
                         self.metadata = data['metadata']
+                    self.version = version or 'legacy'
+                    self.vectors = self._open_vectors(version) if self._needs_full_vectors() else None
+                    self.texts = self._open_texts(version)
                     
-                    logger.info(f"Loaded FAISS index with {self.index.ntotal} vectors")
+                    logger.info(f"Loaded FAISS index {self.version} with {self.index.ntotal} vectors")
             else:
                 self.index = faiss.IndexFlatIP(self.dimension)  # Inner product for cosine similarity
+                self.pca = None
                 self.id_mapping = {}
                 self.metadata = {}
+                self.vectors = None
+                self.texts = ChunkTextStore()
                 logger.info("Created new FAISS index")
                 
         except Exception as e:
             logger.error(f"Error loading FAISS index: {str(e)}")
             # Create new index on failure
             self.index = faiss.IndexFlatIP(self.dimension)
+            self.pca = None
             self.id_mapping = {}
             self.metadata = {}
+            self.vectors = None
+            self.texts = ChunkTextStore()
+        self._index_chunk_positions()
     
     def add_embeddings(self, textbook_id: str, embeddings: List[List[float]]):
         """Add embeddings to FAISS index"""
         try:
-            # Get chunks for this textbook
-            chunks = ContentChunk.objects.filter(textbook_id=textbook_id).order_by('chunk_index')
-            
-            if len(chunks) != len(embeddings):
-                raise ValueError(f"Mismatch between chunks ({len(chunks)}) and embeddings ({len(embeddings)})")
-            
-            # Convert embeddings to numpy array
-            embeddings_array = np.array(embeddings, dtype=np.float32)
-            
-            # Normalize vectors for cosine similarity
-            faiss.normalize_L2(embeddings_array)
-            
-            # Add to index
-            start_idx = self.index.ntotal
-            self.index.add(embeddings_array)
+            with self.snapshots.write_lock():
+                self._refresh_if_stale()
+                
+                # Get chunks for this textbook
+                chunks = list(
+                    ContentChunk.objects.filter(textbook_id=textbook_id)
+                    .select_related('textbook', 'textbook__subject', 'textbook__grade')
+                    .order_by('chunk_index')
+                )
+                
+                if len(chunks) != len(embeddings):
+                    raise ValueError(f"Mismatch between chunks ({len(chunks)}) and embeddings ({len(embeddings)})")
+                
+                pairs = [(chunk, embedding) for chunk, embedding in zip(chunks, embeddings)
+                         if usable_embedding(embedding, self.dimension)]
+                if len(pairs) < len(chunks):
+                    logger.warning(f"Not indexing {len(chunks) - len(pairs)} empty or zero embeddings of textbook {textbook_id}")
+                self._append_chunks([chunk for chunk, _ in pairs], [embedding for _, embedding in pairs])
+                
+                # Save index
+                self._save_index()
+            self._record_indexed([chunk for chunk, _ in pairs], [])
             
-            # Update mappings
-            for i, chunk in enumerate(chunks):
-                faiss_idx = start_idx + i
-                self.id_mapping[faiss_idx] = str(chunk.id)
-                self.metadata[faiss_idx] = {
-                    'chunk_id': str(chunk.id),
-                    'textbook_id': str(chunk.textbook_id),
-                    'subject': chunk.textbook.subject.name,
-                    'grade': chunk.textbook.grade.level,
-                    'chunk_index': chunk.chunk_index,
-                    'title': chunk.textbook.title
-                }
+            logger.info(f"Added {len(pairs)} embeddings to FAISS index")
             
-            # Save index
-            self._save_index()
+        except Exception as e:
+            logger.error(f"Error adding embeddings to FAISS: {str(e)}")
+            raise
+    
+    def apply_textbook_updates(self, textbook_ids: List[str]) -> Dict[str, int]:
+        """Re-sync the vectors of several textbooks with the database as one snapshot write.
+        
+        Existing vectors of each textbook are dropped and its current embedded
+        chunks re-added, so the same call covers uploads, reprocessing and
+        deletions. The write lock is held from reading the latest snapshot
+        until the new one is promoted, so concurrent writers cannot clobber
+        each other's vectors.
+        """
+        textbook_ids = {str(textbook_id) for textbook_id in textbook_ids}
+        try:
+            with self.snapshots.write_lock():
+                self._refresh_if_stale()
+                
+                stale_positions = [
+                    position for position, meta in self.metadata.items()
+                    if meta.get('textbook_id') in textbook_ids
+                ]
+                self._remove_positions(stale_positions)
+                
+                chunks = list(
+                    ContentChunk.objects.filter(
+                        textbook_id__in=textbook_ids,
+                        textbook__processing_status='completed',
+                        embedding_vector__isnull=False
+                    ).select_related('textbook', 'textbook__subject', 'textbook__grade')
+                    .order_by('textbook_id', 'chunk_index')
+                )
+                # A shard drops vectors of textbooks that moved away but only re-adds its own
+                chunks, unusable = self._split_usable([chunk for chunk in chunks if self._owns(chunk)])
+                self._append_chunks(chunks, [chunk.embedding_vector for chunk in chunks])
+                
+                # Nothing to write when none of these textbooks touch this index
+                if stale_positions or chunks:
+                    self._save_index()
+            self._record_indexed(chunks, unusable)
             
-            logger.info(f"Added {len(embeddings)} embeddings to FAISS index")
+            logger.info(
+                f"Applied index updates for {len(textbook_ids)} textbooks: "
+                f"removed {len(stale_positions)}, added {len(chunks)} vectors"
+            )
+            return {'removed': len(stale_positions), 'added': len(chunks)}
             
         except Exception as e:
-            logger.error(f"Error adding embeddings to FAISS: {str(e)}")
+            logger.error(f"Error applying FAISS index updates: {str(e)}")
             raise
     
     def search(self, 
                query_embedding: List[float], 
                top_k: int = 5,
-               filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
-        """Search for similar embeddings"""
+               filters: Optional[Dict[str, Any]] = None,
+               with_vectors: bool = False,
+               neighbor_window: int = 0) -> List[Dict[str, Any]]:
+        """Search for similar embeddings.
+        
+        Hits carry the chunk ``text`` when the snapshot has a text store.
+        ``with_vectors`` adds each hit's normalised stored vector and
+        ``neighbor_window`` the chunks up to that many positions either side
+        of it in its textbook (``neighbors``, in reading order).
+        """
         try:
             if self.index.ntotal == 0:
-                logger.info("FAISS index is empty, returning no results")
+                logger.debug("FAISS index is empty, returning no results")
                 return []
             
             # Check query embedding dimension
@@ -131,32 +381,28 @@ class FAISSDriver:
             query_array = np.array([query_embedding], dtype=np.float32)
             faiss.normalize_L2(query_array)
             
-            # Search
-            scores, indices = self.index.search(query_array, min(top_k * 2, self.index.ntotal))
-            
-            logger.info(f"FAISS search returned {len(scores[0])} results with scores: {scores[0].tolist()}")
-            
-            results = []
-            for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-                if idx == -1:  # Invalid index
-                    continue
-                
-                metadata = self.metadata.get(idx, {})
-                
-                # Apply filters
-                if filters and not self._matches_filters(metadata, filters):
-                    continue
-                
-                results.append({
-                    'id': self.id_mapping.get(idx),
-                    'score': float(score),
-                    'metadata': metadata
-                })
-                
-                if len(results) >= top_k:
+            # Search; filter misses and collapsed duplicates are dropped, so widen until top_k survive
+            k = min(top_k * 2, self.index.ntotal)
+            while True:
+                scores, indices = self._candidates(query_array, k)
+
+                if tracing():
+                    trace('faiss.candidates', count=len(scores), scores=scores.tolist())
+
+                results, positions = self._select(scores, indices, top_k, filters)
+                if len(results) >= top_k or k >= self.index.ntotal or not (filters or settings.RAG_COLLAPSE_DUPLICATES):
                     break
+                k = min(k * 2, self.index.ntotal)
             
-            logger.info(f"After filtering, returning {len(results)} results with scores: {[r['score'] for r in results]}")
+            if with_vectors and results:
+                for result, vector in zip(results, self._stored_vectors(positions)):
+                    result['vector'] = vector
+            if neighbor_window > 0:
+                for result in results:
+                    result['neighbors'] = self.neighbors(result['metadata'], neighbor_window)
+            
+            if tracing():
+                trace('faiss.results', count=len(results), scores=[r['score'] for r in results])
             return results
             
         except Exception as e:
@@ -166,6 +412,79 @@ class FAISSDriver:
             logger.error(f"FAISS search traceback: {traceback.format_exc()}")
             raise
     
+    def _select(self, scores, indices, top_k: int, filters: Optional[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """The first ``top_k`` candidates that pass the filters, one per duplicate group, and their positions"""
+        results = []
+        positions = []
+        seen_groups = set()
+        for score, idx in zip(scores, indices):
+            if idx == -1:  # Invalid index
+                continue
+            
+            metadata = self.metadata.get(idx, {})
+            
+            # Apply filters
+            if filters and not self._matches_filters(metadata, filters):
+                continue
+            
+            result = {
+                'id': self.id_mapping.get(idx),
+                'score': float(score),
+                'metadata': metadata
+            }
+            # Near-duplicates of a better hit (the same passage in another edition) add nothing
+            if settings.RAG_COLLAPSE_DUPLICATES:
+                group = duplicate_group(result)
+                if group in seen_groups:
+                    continue
+                seen_groups.add(group)
+            if self.texts is not None:
+                result['text'] = self.texts.get(idx)
+            results.append(result)
+            positions.append(int(idx))
+            
+            if len(results) >= top_k:
+                break
+        return results, positions
+    
+    def _candidates(self, query_array: np.ndarray, k: int):
+        """Top-k (scores, positions), re-ranked exactly when the index is compressed"""
+        return search_reranked(self.index, self.vectors, query_array, k, settings.FAISS_RERANK_FACTOR, self.pca)
+    
+    def neighbors(self, metadata: Dict[str, Any], window: int) -> List[Dict[str, Any]]:
+        """Indexed chunks within ``window`` of a chunk in the same textbook, itself included.
+        
+        Each is ``{'id', 'chunk_index'}`` plus ``text`` when the snapshot has a text store.
+        """
+        textbook_id = metadata.get('textbook_id')
+        chunk_index = metadata.get('chunk_index')
+        if textbook_id is None or chunk_index is None:
+            return []
+        found = []
+        for neighbor_index in range(chunk_index - window, chunk_index + window + 1):
+            position = self.chunk_positions.get((textbook_id, neighbor_index))
+            if position is None or position not in self.id_mapping:
+                continue
+            neighbor = {'id': self.id_mapping[position], 'chunk_index': neighbor_index}
+            if self.texts is not None:
+                neighbor['text'] = self.texts.get(position)
+            found.append(neighbor)
+        return found
+    
+    def _index_chunk_positions(self):
+        """Rebuild the (textbook_id, chunk_index) -> position table from the metadata"""
+        self.chunk_positions = {
+            (meta['textbook_id'], meta['chunk_index']): position
+            for position, meta in self.metadata.items()
+            if 'textbook_id' in meta and meta.get('chunk_index') is not None
+        }
+    
+    def _stored_vectors(self, positions: List[int]) -> np.ndarray:
+        """Normalised vectors at ``positions``, full precision when the index is compressed"""
+        if self.vectors is not None:
+            return np.asarray(self.vectors[positions], dtype=np.float32)
+        return self.index.reconstruct_batch(np.array(positions, dtype=np.int64))
+    
     def _matches_filters(self, metadata: Dict[str, Any], filters: Dict[str, Any]) -> bool:
         """Check if metadata matches filters"""
         for key, value in filters.items():
@@ -182,65 +501,268 @@ class FAISSDriver:
         return True
     
     def _save_index(self):
-        """Save FAISS index and metadata"""
-        try:
-            faiss.write_index(self.index, f"{self.index_path}.faiss")
-            
-            with open(f"{self.index_path}.metadata", 'wb') as f:
+        """Write the index and metadata as a new snapshot and promote it"""
+        self._compress_if_configured()
+        self._ensure_texts()
+        
+        def write_files(directory: str):
+            faiss.write_index(self.index, os.path.join(directory, 'index.faiss'))
+            with open(os.path.join(directory, 'metadata.pkl'), 'wb') as f:
                 pickle.dump({
                     'id_mapping': self.id_mapping,
                     'metadata': self.metadata
                 }, f)
+            if self.vectors is not None:
+                np.save(os.path.join(directory, VECTORS_FILE), np.asarray(self.vectors, dtype=np.float32))
+            if self.pca is not None:
+                faiss.write_VectorTransform(self.pca, os.path.join(directory, PCA_FILE))
+            self.texts.write(directory)
+        
+        try:
+            self.version = self.snapshots.write(
+                write_files,
+                {
+                    'vector_count': int(self.index.ntotal),
+                    'dimension': self.dimension,
+                    'index_dimension': int(self.index.d),
+                    'index_type': type(self.index).__name__,
+                    'quantization': settings.FAISS_INDEX_TYPE if self._is_quantized() else 'flat',
+                    'index_bytes': int(self.index.sa_code_size() * self.index.ntotal),
+                    'embedding_model': settings.EMBEDDING_MODEL,
+                    'shard_id': self.shard_id,
+                    'shard_count': settings.FAISS_SHARD_COUNT if self.shard_id is not None else 1,
+                    'shard_by': settings.FAISS_SHARD_BY if self.shard_id is not None else None,
+                },
+                keep=settings.FAISS_SNAPSHOT_RETENTION
+            )
+            self.source_version = self.version
+            if self.vectors is not None:
+                # Swap the in-memory copy for a memory map of the file just written
+                self.vectors = self._open_vectors(self.version)
+            self.texts = self._open_texts(self.version)
             
         except Exception as e:
             logger.error(f"Error saving FAISS index: {str(e)}")
             raise
     
+    def _is_quantized(self) -> bool:
+        return not isinstance(self.index, faiss.IndexFlat)
+    
+    def _needs_full_vectors(self) -> bool:
+        """Whether the index holds lossy vectors that search re-ranks from ``vectors``"""
+        return self._is_quantized() or self.pca is not None
+    
+    def _open_pca(self, version: Optional[str]):
+        path = os.path.join(self.snapshots.path(version), PCA_FILE) if version else None
+        if not path or not os.path.exists(path):
+            return None
+        return faiss.read_VectorTransform(path)
+    
+    def _open_vectors(self, version: Optional[str]) -> Optional[np.ndarray]:
+        """Memory-map a snapshot's full-precision vectors; only the re-ranked rows are read"""
+        path = os.path.join(self.snapshots.path(version), VECTORS_FILE) if version else None
+        if not path or not os.path.exists(path):
+            logger.warning(f"Snapshot {version} has no full-precision vectors, searching without re-ranking")
+            return None
+        return np.load(path, mmap_mode='r')
+    
+    def _open_texts(self, version: Optional[str]) -> Optional[ChunkTextStore]:
+        """Memory-map a snapshot's chunk texts; None for snapshots written without them"""
+        if not version or version == 'legacy':
+            return None
+        texts = ChunkTextStore.open(self.snapshots.path(version))
+        if texts is None:
+            logger.warning(f"Snapshot {version} has no chunk text store, chunk text will be read from the database")
+        return texts
+    
+    def _ensure_texts(self):
+        """Backfill the text store from the database when the loaded snapshot had none"""
+        if self.texts is not None and len(self.texts) == self.index.ntotal:
+            return
+        chunk_ids = [self.id_mapping.get(position) for position in range(self.index.ntotal)]
+        texts = {}
+        for start in range(0, len(chunk_ids), 1000):
+            batch = [chunk_id for chunk_id in chunk_ids[start:start + 1000] if chunk_id]
+            texts.update(
+                (str(chunk_id), text)
+                for chunk_id, text in ContentChunk.objects.filter(id__in=batch).values_list('id', 'chunk_text')
+            )
+        self.texts = ChunkTextStore()
+        self.texts.append([texts.get(chunk_id, '') for chunk_id in chunk_ids])
+        logger.info(f"Built chunk text store for {len(self.texts)} chunks from the database")
+    
+    def _compress_if_configured(self):
+        """Apply the configured PCA projection and quantization once there is enough training data.
+        
+        Small corpora stay flat at full dimension: they are cheap to hold
+        exactly and too small to train a projection or codebook on. The index
+        is re-encoded from the original vectors, which are kept for re-ranking.
+        """
+        total = self.index.ntotal
+        pca_dim = settings.FAISS_PCA_DIM
+        index_type = settings.FAISS_INDEX_TYPE
+        
+        quantize_min = 0 if index_type == 'sqfp16' else settings.FAISS_TRAIN_MIN_VECTORS
+        if index_type == 'pq':
+            # k-means needs at least one training point per centroid (256 for 8-bit codes)
+            quantize_min = max(quantize_min, 256)
+        add_pca = 0 < pca_dim < self.dimension and self.pca is None and total >= max(settings.FAISS_TRAIN_MIN_VECTORS, pca_dim)
+        add_quantizer = index_type in QUANTIZED_INDEX_TYPES and not self._is_quantized() and total >= quantize_min
+        if total == 0 or not (add_pca or add_quantizer):
+            return
+        
+        # Without PCA or quantization the flat index itself holds the original vectors
+        originals = np.asarray(self.vectors) if self.vectors is not None else self.index.reconstruct_n(0, total)
+        if add_pca:
+            self.pca = train_pca(self._training_sample(originals), pca_dim)
+        projected = project(self.pca, originals)
+        
+        if index_type in QUANTIZED_INDEX_TYPES and total >= quantize_min:
+            index = new_quantized_index(index_type, projected.shape[1], settings.FAISS_PQ_M)
+            if not index.is_trained:
+                index.train(self._training_sample(projected))
+        else:
+            index = faiss.IndexFlatIP(projected.shape[1])
+        index.add(projected)
+        
+        self.index = index
+        self.vectors = originals
+        logger.info(
+            f"Compressed FAISS index: {self.dimension} -> {index.d} dims, "
+            f"{type(index).__name__} at {index.sa_code_size()} bytes per vector, {total} vectors"
+        )
+    
+    def _training_sample(self, vectors: np.ndarray) -> np.ndarray:
+        if len(vectors) <= settings.FAISS_TRAIN_SAMPLE:
+            return vectors
+        rows = np.random.default_rng(0).choice(len(vectors), settings.FAISS_TRAIN_SAMPLE, replace=False)
+        return vectors[np.sort(rows)]
+    
+    def _refresh_if_stale(self):
+        """Reload the promoted snapshot before modifying it; caller holds the write lock"""
+        if self.is_stale():
+            self.source_version = self.disk_version()
+            self._load_or_create_index()
+    
+    def _owns(self, chunk: ContentChunk) -> bool:
+        """Whether this index holds the chunk (always true when unsharded)"""
+        if self.shard_id is None:
+            return True
+        return shard_for(
+            chunk.textbook_id,
+            chunk.textbook.subject.name,
+            settings.FAISS_SHARD_COUNT,
+            settings.FAISS_SHARD_BY
+        ) == self.shard_id
+    
+    def _chunk_metadata(self, chunk: ContentChunk) -> Dict[str, Any]:
+        metadata = {
+            'chunk_id': str(chunk.id),
+            'textbook_id': str(chunk.textbook_id),
+            'subject': chunk.textbook.subject.name,
+            'grade': chunk.textbook.grade.level,
+            'chunk_index': chunk.chunk_index,
+            'title': chunk.textbook.title
+        }
+        if chunk.duplicate_of_id:
+            metadata['canonical_id'] = str(chunk.duplicate_of_id)
+        return metadata
+    
+    def _append_chunks(self, chunks: List[ContentChunk], embeddings: List[List[float]]):
+        """Add normalised vectors and their mappings at the end of the index"""
+        if not chunks:
+            return
+        
+        # Convert embeddings to numpy array and normalize for cosine similarity
+        embeddings_array = np.array(embeddings, dtype=np.float32)
+        faiss.normalize_L2(embeddings_array)
+        
+        start_idx = self.index.ntotal
+        self.index.add(project(self.pca, embeddings_array))
+        if self.vectors is not None:
+            self.vectors = np.concatenate([np.asarray(self.vectors), embeddings_array])
+        if self.texts is not None:
+            self.texts.append([chunk.chunk_text for chunk in chunks])
+        
+        for i, chunk in enumerate(chunks):
+            self.id_mapping[start_idx + i] = str(chunk.id)
+            self.metadata[start_idx + i] = self._chunk_metadata(chunk)
+            self.chunk_positions[(str(chunk.textbook_id), chunk.chunk_index)] = start_idx + i
+    
+    def _remove_positions(self, positions: List[int]):
+        """Remove vectors by position and compact the mappings to match"""
+        if not positions:
+            return
+        removed = set(positions)
+        total = self.index.ntotal
+        self.index.remove_ids(np.array(sorted(removed), dtype=np.int64))
+        if self.vectors is not None:
+            self.vectors = np.delete(np.asarray(self.vectors), sorted(removed), axis=0)
+        if self.texts is not None:
+            self.texts.remove(sorted(removed))
+        
+        # FAISS compacts the remaining vectors in order, so renumber the mappings the same way
+        kept = [position for position in range(total) if position not in removed]
+        self.id_mapping = {new: self.id_mapping[old] for new, old in enumerate(kept) if old in self.id_mapping}
+        self.metadata = {new: self.metadata[old] for new, old in enumerate(kept) if old in self.metadata}
+        self._index_chunk_positions()
+    
+    def _build_from_database(self):
+        """Replace the in-memory index with every usable stored vector; returns (indexed, unusable) chunks"""
+        # Built flat and re-compressed (retraining PCA and the codebook) when saved
+        self.index = faiss.IndexFlatIP(self.dimension)
+        self.pca = None
+        self.id_mapping = {}
+        self.metadata = {}
+        self.chunk_positions = {}
+        self.vectors = None
+        self.texts = ChunkTextStore()
+        
+        # Get all chunks with embeddings
+        chunks = list(
+            ContentChunk.objects.filter(
+                embedding_vector__isnull=False
+            ).select_related('textbook', 'textbook__subject', 'textbook__grade')
+        )
+        chunks, unusable = self._split_usable([chunk for chunk in chunks if self._owns(chunk)])
+        self._append_chunks(chunks, [chunk.embedding_vector for chunk in chunks])
+        return chunks, unusable
+    
+    def _split_usable(self, chunks: List[ContentChunk]):
+        """Chunks whose stored vector may enter the index, and those whose vector may not"""
+        usable, unusable = [], []
+        for chunk in chunks:
+            (usable if usable_embedding(chunk.embedding_vector, self.dimension) else unusable).append(chunk)
+        return usable, unusable
+    
+    def _record_indexed(self, indexed: List[ContentChunk], unusable: List[ContentChunk]):
+        """Mark chunks indexed once their snapshot is promoted; send unusable vectors back to pending"""
+        indexed_ids = [chunk.id for chunk in indexed if chunk.embedding_status != 'indexed']
+        for start in range(0, len(indexed_ids), 1000):
+            ContentChunk.objects.filter(id__in=indexed_ids[start:start + 1000]).update(embedding_status='indexed')
+        if unusable:
+            # Left in place they would be counted as embedded; pending makes resume_ingestion re-embed them
+            logger.warning(f"Not indexing {len(unusable)} chunks with empty or zero embeddings; marked pending")
+            unusable_ids = [chunk.id for chunk in unusable]
+            for start in range(0, len(unusable_ids), 1000):
+                ContentChunk.objects.filter(id__in=unusable_ids[start:start + 1000]).update(
+                    embedding_status='pending', embedding_vector=None
+                )
+    
     def rebuild_index(self):
         """Rebuild FAISS index from database"""
         try:
-            # Create new index
-            self.index = faiss.IndexFlatIP(self.dimension)
-            self.id_mapping = {}
-            self.metadata = {}
-            
-            # Get all chunks with embeddings
-            chunks = ContentChunk.objects.filter(
-                embedding_vector__isnull=False
-            ).select_related('textbook', 'textbook__subject', 'textbook__grade')
-            
-            if not chunks.exists():
-                logger.info("No chunks with embeddings found")
-                return
-            
-            # Collect embeddings
-            embeddings = []
-            for chunk in chunks:
-                embeddings.append(chunk.embedding_vector)
-            
-            # Convert to numpy array
-            embeddings_array = np.array(embeddings, dtype=np.float32)
-            faiss.normalize_L2(embeddings_array)
-            
-            # Add to index
-            self.index.add(embeddings_array)
-            
-            # Update mappings
-            for i, chunk in enumerate(chunks):
-                self.id_mapping[i] = str(chunk.id)
-                self.metadata[i] = {
-                    'chunk_id': str(chunk.id),
-                    'textbook_id': str(chunk.textbook_id),
-                    'subject': chunk.textbook.subject.name,
-                    'grade': chunk.textbook.grade.level,
-                    'chunk_index': chunk.chunk_index,
-                    'title': chunk.textbook.title
-                }
-            
-            # Save index
-            self._save_index()
+            with self.snapshots.write_lock():
+                chunks, unusable = self._build_from_database()
+                vector_count = len(chunks)
+                if vector_count == 0:
+                    logger.info("No chunks with embeddings found")
+                
+                # Save index
+                self._save_index()
+            self._record_indexed(chunks, unusable)
             
-            logger.info(f"Rebuilt FAISS index with {len(embeddings)} vectors")
+            logger.info(f"Rebuilt FAISS index with {vector_count} vectors")
             
         except Exception as e:
             logger.error(f"Error rebuilding FAISS index: {str(e)}")
@@ -248,9 +770,8 @@ class FAISSDriver:
     
     def remove_textbook(self, textbook_id: str):
         """Remove all chunks for a textbook from the index"""
-        # Note: FAISS doesn't support efficient removal, so we rebuild
-        logger.info(f"Removing textbook {textbook_id} requires index rebuild")
-        self.rebuild_index()
+        # Its chunks are already gone from the database, so re-syncing drops its vectors
+        self.apply_textbook_updates([textbook_id])
 
     def force_rebuild_index(self):
         """Force rebuild FAISS index from database and clear cache"""
@@ -258,54 +779,23 @@ class FAISSDriver:
             logger.info("Force rebuilding FAISS index...")
             
             # Clear cache
-            cache.delete('faiss_driver')
+            index_cache.delete(self.cache_key)
             
-            # Create new index
-            self.index = faiss.IndexFlatIP(self.dimension)
-            self.id_mapping = {}
-            self.metadata = {}
-            
-            # Get all chunks with embeddings
-            chunks = ContentChunk.objects.filter(
-                embedding_vector__isnull=False
-            ).select_related('textbook', 'textbook__subject', 'textbook__grade')
-            
-            if not chunks.exists():
-                logger.info("No chunks with embeddings found")
-                return
-            
-            # Collect embeddings
-            embeddings = []
-            for chunk in chunks:
-                embeddings.append(chunk.embedding_vector)
-            
-            # Convert to numpy array
-            embeddings_array = np.array(embeddings, dtype=np.float32)
-            faiss.normalize_L2(embeddings_array)
-            
-            # Add to index
-            self.index.add(embeddings_array)
-            
-            # Update mappings
-            for i, chunk in enumerate(chunks):
-                self.id_mapping[i] = str(chunk.id)
-                self.metadata[i] = {
-                    'chunk_id': str(chunk.id),
-                    'textbook_id': str(chunk.textbook_id),
-                    'subject': chunk.textbook.subject.name,
-                    'grade': chunk.textbook.grade.level,
-                    'chunk_index': chunk.chunk_index,
-                    'title': chunk.textbook.title
-                }
-            
-            # Save index
-            self._save_index()
+            with self.snapshots.write_lock():
+                chunks, unusable = self._build_from_database()
+                vector_count = len(chunks)
+                if vector_count == 0:
+                    logger.info("No chunks with embeddings found")
+                
+                # Save index
+                self._save_index()
+            self._record_indexed(chunks, unusable)
             
             # Update cache
-            cache.set('faiss_driver', self, timeout=None)
+            index_cache.set(self.cache_key, self)
             
-            logger.info(f"Force rebuilt FAISS index with {len(embeddings)} vectors")
+            logger.info(f"Force rebuilt FAISS index with {vector_count} vectors")
             
         except Exception as e:
             logger.error(f"Error force rebuilding FAISS index: {str(e)}")
-            raise
\ No newline at end of file
+            raise
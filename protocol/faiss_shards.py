@@ -0,0 +1,225 @@
+import heapq
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+from protocol.faiss_driver import FAISSDriver, duplicate_group, shard_for
+from protocol.index_snapshots import SnapshotError, SnapshotStore
+
+logger = logging.getLogger('rag_tutor')
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def shard_snapshot_dir(shard_id: int) -> str:
+    return os.path.join(settings.FAISS_SHARD_DIR, f"{shard_id:03d}")
+
+
+def get_faiss_driver():
+    """The configured index: a single FAISSDriver, or a ShardedFAISSDriver when FAISS_SHARD_COUNT > 1"""
+    if settings.FAISS_SHARD_COUNT > 1:
+        return ShardedFAISSDriver()
+    return FAISSDriver()
+
+
+def merge_shard_results(shard_results: List[List[Dict[str, Any]]], top_k: int) -> List[Dict[str, Any]]:
+    """Global top-k from per-shard top-k lists (inner-product scores, higher is better)"""
+    hits = (hit for hits in shard_results for hit in hits)
+    if not settings.RAG_COLLAPSE_DUPLICATES:
+        return heapq.nlargest(top_k, hits, key=lambda hit: hit['score'])
+    # Editions of a textbook can live on different shards, so collapse near-duplicates again
+    merged, seen_groups = [], set()
+    for hit in sorted(hits, key=lambda hit: hit['score'], reverse=True):
+        group = duplicate_group(hit)
+        if group not in seen_groups:
+            seen_groups.add(group)
+            merged.append(hit)
+            if len(merged) == top_k:
+                break
+    return merged
+
+
+def _search_executor(workers: int) -> ThreadPoolExecutor:
+    """Process-wide pool with one thread per shard"""
+    with _executor_lock:
+        if workers not in _executors:
+            _executors[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='faiss-shard')
+        return _executors[workers]
+
+
+class ShardedFAISSDriver:
+    """FAISS index partitioned into ``FAISS_SHARD_COUNT`` independent shards.
+
+    Each shard is an ordinary FAISSDriver with its own snapshot store and
+    write lock, and owns whole textbooks (see ``shard_for``). Searches
+    scatter to every shard that can hold a match and merge the per-shard
+    top-k into a global top-k. With the ``local`` backend the shards are
+    searched in a thread pool in this process; FAISS releases the GIL while
+    scanning, so shards run in parallel. With the ``celery`` backend each
+    shard is searched by a worker consuming ``faiss_shard_<n>``, so no web
+    process has to hold the whole index; a shard whose worker does not
+    answer in time is searched locally instead.
+    """
+
+    def __init__(self, shard_count: Optional[int] = None, backend: Optional[str] = None,
+                 shards: Optional[List[Any]] = None):
+        self.shard_count = len(shards) if shards is not None else (shard_count or settings.FAISS_SHARD_COUNT)
+        self.backend = backend or settings.FAISS_SHARD_BACKEND
+        self.shard_by = settings.FAISS_SHARD_BY
+        self.stores = [SnapshotStore(shard_snapshot_dir(n)) for n in range(self.shard_count)]
+        self._shards = list(shards) if shards is not None else [None] * self.shard_count
+        self._shards_lock = threading.Lock()
+
+        # Remote shards are loaded by their workers; locally every shard is needed up front
+        if self.backend == 'local' and shards is None:
+            for shard_id in range(self.shard_count):
+                self.shard(shard_id)
+        self._check_layout()
+
+    def shard(self, shard_id: int) -> FAISSDriver:
+        """Shard driver loaded in this process, created on first use"""
+        if self._shards[shard_id] is None:
+            with self._shards_lock:
+                if self._shards[shard_id] is None:
+                    self._shards[shard_id] = FAISSDriver(
+                        snapshot_dir=shard_snapshot_dir(shard_id),
+                        shard_id=shard_id
+                    )
+        return self._shards[shard_id]
+
+    @property
+    def version(self) -> str:
+        return ','.join(
+            shard.version if shard is not None else (store.current_version() or '0')
+            for shard, store in zip(self._shards, self.stores)
+        )
+
+    @property
+    def ntotal(self) -> int:
+        """Vectors across all shards, read from manifests for shards not loaded here"""
+        total = 0
+        for shard, store in zip(self._shards, self.stores):
+            if shard is not None:
+                total += shard.ntotal
+                continue
+            version = store.current_version()
+            if version:
+                try:
+                    total += store.read_manifest(version).get('vector_count', 0)
+                except SnapshotError:
+                    pass
+        return total
+
+    def disk_version(self) -> str:
+        return ','.join(store.current_version() or '0' for store in self.stores)
+
+    def is_stale(self) -> bool:
+        return any(shard is not None and shard.is_stale() for shard in self._shards)
+
+    def _check_layout(self):
+        """Warn when shards on disk were written with a different partitioning"""
+        for shard_id, store in enumerate(self.stores):
+            version = store.current_version()
+            if not version:
+                continue
+            try:
+                manifest = store.read_manifest(version)
+            except SnapshotError:
+                continue
+            if manifest.get('shard_count') != self.shard_count or manifest.get('shard_by') != self.shard_by:
+                logger.warning(
+                    f"FAISS shard {shard_id} was built for {manifest.get('shard_count')} shards by "
+                    f"{manifest.get('shard_by')}; run rebuild_faiss to repartition"
+                )
+
+    def _target_shards(self, filters: Optional[Dict[str, Any]]) -> List[int]:
+        """Shards that can contain matches for the filters"""
+        if filters and self.shard_by == 'subject' and filters.get('subject'):
+            return [shard_for(None, filters['subject'], self.shard_count, self.shard_by)]
+        if filters and self.shard_by == 'hash' and filters.get('textbook_id'):
+            # Hash partitioning places a whole textbook on the shard its id hashes to
+            return [shard_for(filters['textbook_id'], None, self.shard_count, self.shard_by)]
+        return list(range(self.shard_count))
+
+    def search(self,
+               query_embedding: List[float],
+               top_k: int = 5,
+               filters: Optional[Dict[str, Any]] = None,
+               with_vectors: bool = False,
+               neighbor_window: int = 0) -> List[Dict[str, Any]]:
+        """Scatter the query to the shards and merge their results into a global top-k"""
+        # A textbook lives on one shard, so each shard resolves its own hits' neighbours
+        shard_ids = self._target_shards(filters)
+        options = (with_vectors, neighbor_window)
+        if self.backend == 'celery':
+            shard_results = self._search_remote(shard_ids, query_embedding, top_k, filters, *options)
+        else:
+            shard_results = self._search_local(shard_ids, query_embedding, top_k, filters, *options)
+
+        results = merge_shard_results(shard_results, top_k)
+        logger.debug(f"Sharded search over {len(shard_ids)} shards returned {len(results)} results")
+        return results
+
+    def _search_local(self, shard_ids, query_embedding, top_k, filters, *options) -> List[List[Dict[str, Any]]]:
+        if len(shard_ids) == 1:
+            return [self.shard(shard_ids[0]).search(query_embedding, top_k, filters, *options)]
+        executor = _search_executor(self.shard_count)
+        futures = [
+            executor.submit(self.shard(shard_id).search, query_embedding, top_k, filters, *options)
+            for shard_id in shard_ids
+        ]
+        return [future.result() for future in futures]
+
+    def _search_remote(self, shard_ids, query_embedding, top_k, filters, *options) -> List[List[Dict[str, Any]]]:
+        from knowledge_base.tasks import search_shard
+
+        pending = {
+            shard_id: search_shard.apply_async(
+                args=[shard_id, query_embedding, top_k, filters or {}, *options],
+                queue=f"faiss_shard_{shard_id}",
+                expires=settings.FAISS_SHARD_TIMEOUT
+            )
+            for shard_id in shard_ids
+        }
+        shard_results = []
+        for shard_id, result in pending.items():
+            try:
+                shard_results.append(result.get(timeout=settings.FAISS_SHARD_TIMEOUT))
+            except Exception as e:
+                logger.warning(f"FAISS shard {shard_id} worker unavailable ({str(e)}), searching locally")
+                shard_results.append(self.shard(shard_id).search(query_embedding, top_k, filters, *options))
+        return shard_results
+
+    def add_embeddings(self, textbook_id: str, embeddings: List[List[float]]):
+        """Add a textbook's embeddings to the shard that owns it"""
+        from knowledge_base.models import TextbookContent
+
+        textbook = TextbookContent.objects.select_related('subject').get(id=textbook_id)
+        shard_id = shard_for(textbook.id, textbook.subject.name, self.shard_count, self.shard_by)
+        self.shard(shard_id).add_embeddings(textbook_id, embeddings)
+
+    def apply_textbook_updates(self, textbook_ids: List[str]) -> Dict[str, int]:
+        """Re-sync textbooks on every shard; shards without changes skip the snapshot write"""
+        totals = {'removed': 0, 'added': 0}
+        for shard_id in range(self.shard_count):
+            result = self.shard(shard_id).apply_textbook_updates(textbook_ids)
+            totals['removed'] += result['removed']
+            totals['added'] += result['added']
+        return totals
+
+    def remove_textbook(self, textbook_id: str):
+        self.apply_textbook_updates([textbook_id])
+
+    def rebuild_index(self, shard_id: Optional[int] = None):
+        """Rebuild one shard, or every shard in turn"""
+        for n in ([shard_id] if shard_id is not None else range(self.shard_count)):
+            self.shard(n).rebuild_index()
+
+    def force_rebuild_index(self, shard_id: Optional[int] = None):
+        for n in ([shard_id] if shard_id is not None else range(self.shard_count)):
+            self.shard(n).force_rebuild_index()
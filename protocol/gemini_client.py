@@ -1,173 +1,166 @@
 import google.generativeai as genai
-from typing import List, Dict, Any, Optional
+from typing import Iterator, List, Dict, Any, Optional
 from django.conf import settings
 import logging
-import time
-from django.core.cache import cache
-from celery import shared_task
-import numpy as np
+from protocol.cache_namespace import embedding_cache, text_digest
+from protocol.llm_client import BaseLLMClient, LLMError, LLMNotConfigured
 
 logger = logging.getLogger('rag_tutor')
 
-class DummyEmbeddingModel:
-    """Dummy embedding model that returns 1536-dim vectors"""
-    def embed_content(self, content, task_type=None):
-        return type('obj', (object,), {'embedding': [0.0] * 1536})()
-    
-    def embed(self, texts):
-        return {'embeddings': [[0.0] * 1536 for _ in texts]}
-
-class GeminiClient:
-    def __init__(self):
-        # Try to get from cache
-        cached = cache.get('gemini_client')
-        if cached:
-            self.model = cached.model
-            self.embedding_model = cached.embedding_model
-            self.available = cached.available
-            return
-        
+class GeminiClient(BaseLLMClient):
+    """Google Gemini provider. Use through ``protocol.llm_client.LLMClient``, which pools instances.
+
+    ``model_id`` names the embedding model for embedding calls and the chat
+    model for chat calls; the pool keeps one instance per model.
+    """
+
+    def __init__(self, model_id: Optional[str] = None, timeout: Optional[float] = None):
+        self.embedding_model_id = model_id or settings.EMBEDDING_MODEL
+        self.chat_model_id = model_id or settings.CHAT_MODEL
+        self.request_options = {'timeout': timeout or settings.LLM_TIMEOUT_SECONDS}
+
         try:
-            import google.generativeai as genai
-            
             # Check if API key is available
             if not settings.GEMINI_API_KEY:
                 logger.warning("GEMINI_API_KEY not set, using fallback mode")
                 self.available = False
                 self.model = None
-                self.embedding_model = DummyEmbeddingModel()
                 return
-            
+
             genai.configure(api_key=settings.GEMINI_API_KEY)
-            
-            # Initialize chat model
-            self.model = genai.GenerativeModel('gemini-1.5-flash')
-            
-            # Initialize embedding model - use the correct method for Gemini
-            try:
-                # Use the correct embedding model name and method
-                self.embedding_model = genai.get_model('models/embedding-001')
-                logger.info("Successfully initialized Gemini embedding model")
-            except Exception as e1:
-                logger.warning(f"Failed to get embedding model via get_model: {e1}")
-                try:
-                    # Alternative method
-                    self.embedding_model = genai.EmbeddingModel('models/embedding-001')
-                    logger.info("Successfully initialized Gemini embedding model via EmbeddingModel")
-                except Exception as e2:
-                    logger.warning(f"Failed to get embedding model via EmbeddingModel: {e2}")
-                    # Method 3: Create a dummy embedding model
-                    self.embedding_model = DummyEmbeddingModel()
-                    logger.info("Using dummy embedding model")
-            
+
+            # Both calls go through the library's shared gRPC channel; nothing here touches the network
+            self.model = genai.GenerativeModel(self.chat_model_id)
             self.available = True
-            # Cache self for future use
-            cache.set('gemini_client', self, timeout=None)
-            
+
         except Exception as e:
             logger.error(f"Gemini client initialization failed: {e}")
             self.available = False
             self.model = None
-            self.embedding_model = DummyEmbeddingModel()
+
+    @property
+    def cacheable(self) -> bool:
+        return self.available
 
     def generate_embedding(self, text: str) -> List[float]:
-        """Generate embedding vector for text. If Gemini fails, returns a 1536-dim dummy vector for FAISS compatibility."""
+        """Generate embedding vector for text; raises LLMError if the API call fails.
+
+        Without an API key (or for empty text) returns an EMBEDDING_DIMENSION-dim dummy vector for FAISS compatibility.
+        """
+        # Clean text
+        clean_text = text.replace('\n', ' ').strip()
+        if not clean_text or not self.available:
+            return [0.0] * settings.EMBEDDING_DIMENSION
+
+        # Embeddings depend only on model and text, so they survive content churn
+        cache_key = self._cache_key(clean_text)
+        cached_embedding = embedding_cache.get(cache_key)
+        if cached_embedding is not None:
+            return cached_embedding
+
+        embedding = self._embed_uncached([clean_text])[0]
+        embedding_cache.set(cache_key, embedding)
+        return embedding
+
+    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for multiple texts in one request, skipping cached ones; raises LLMError on failure"""
+        clean_texts = [text.replace('\n', ' ').strip() for text in texts]
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        if not self.available:
+            return [[0.0] * settings.EMBEDDING_DIMENSION for _ in texts]
+
+        keys = {i: self._cache_key(text) for i, text in enumerate(clean_texts) if text}
+        cached = embedding_cache.get_many(list(keys.values())) if keys else {}
+        missing = []
+        for i, text in enumerate(clean_texts):
+            if not text:
+                embeddings[i] = [0.0] * settings.EMBEDDING_DIMENSION
+            elif keys[i] in cached:
+                embeddings[i] = cached[keys[i]]
+            else:
+                missing.append(i)
+
+        if missing:
+            fresh = self._embed_uncached([clean_texts[i] for i in missing])
+            embedding_cache.set_many({keys[i]: embedding for i, embedding in zip(missing, fresh)})
+            for i, embedding in zip(missing, fresh):
+                embeddings[i] = embedding
+
+        logger.debug(f"Embedded {len(texts)} texts ({len(missing)} uncached)")
+        return embeddings
+
+    def _cache_key(self, clean_text: str) -> str:
+        return f"{self.embedding_model_id}:{text_digest(clean_text)}"
+
+    def _embed_uncached(self, clean_texts: List[str]) -> List[List[float]]:
+        """One embed_content request for all texts.
+
+        A single call path: a failure is reported to the circuit breaker
+        rather than retried with other methods while the provider is down.
+        """
         try:
-            if not self.embedding_model:
-                logger.warning("No embedding model available, using dummy embedding")
-                return [0.0] * 1536
-            
-            # Clean text
-            clean_text = text.replace('\n', ' ').strip()
-            if not clean_text:
-                return [0.0] * 1536
-            
-            # Try Gemini embedding API with the correct method
-            if hasattr(self.embedding_model, 'embed_content'):
-                try:
-                    result = self.embedding_model.embed_content(
-                        content=clean_text,
-                        task_type="retrieval_document"
-                    )
-                    embedding = result.embedding
-                    logger.info(f"Generated embedding with {len(embedding)} dimensions")
-                    return embedding
-                except Exception as e:
-                    logger.warning(f"embed_content failed: {e}")
-            
-            if hasattr(self.embedding_model, 'embed'):
-                try:
-                    # For OpenAI-compatible API
-                    result = self.embedding_model.embed([clean_text])
-                    embedding = result['embeddings'][0]
-                    logger.info(f"Generated embedding with {len(embedding)} dimensions via embed method")
-                    return embedding
-                except Exception as e:
-                    logger.warning(f"embed method failed: {e}")
-            
-            # If we get here, try direct API call
-            try:
-                import google.generativeai as genai
-                result = genai.embed_content(
-                    model='models/embedding-001',
-                    content=clean_text,
-                    task_type="retrieval_document"
-                )
-                embedding = result['embedding']
-                logger.info(f"Generated embedding with {len(embedding)} dimensions via direct API")
-                return embedding
-            except Exception as e:
-                logger.warning(f"Direct API call failed: {e}")
-            
-            logger.warning("All embedding methods failed, using dummy embedding")
-            return [0.0] * 1536
+            result = genai.embed_content(
+                model=self.embedding_model_id,
+                content=clean_texts,
+                task_type="retrieval_document",
+                request_options=self.request_options
+            )
+            embeddings = result['embedding']
+            logger.debug(f"Generated {len(embeddings)} embeddings with {len(embeddings[0])} dimensions")
+            return embeddings
         except Exception as e:
             logger.error(f"Gemini embedding generation failed: {str(e)}")
-            # Return a dummy embedding for now to prevent crashes
-            return [0.0] * 1536  # Match FAISS index dimension
+            raise LLMError(str(e)) from e
 
-    def generate_chat_response(self, 
-                             prompt: str, 
+    def generate_chat_response(self,
+                             prompt: str,
                              max_tokens: int = 16384,
                              temperature: float = 0.7,
                              system_message: Optional[str] = None) -> str:
-        """Generate chat response using Gemini API"""
-        
+        """Generate chat response using Gemini API; raises LLMError on failure"""
+        if not self.model:
+            raise LLMNotConfigured("Gemini chat model is not available (is GEMINI_API_KEY set?)")
+
         try:
-            if not self.model:
-                return "I'm sorry, the AI model is not available at the moment."
-            
             full_prompt = prompt
             if system_message:
                 full_prompt = f"{system_message}\n\n{prompt}"
-            
+
             response = self.model.generate_content(
                 full_prompt,
                 generation_config={
                     'max_output_tokens': max_tokens,
                     'temperature': temperature
-                }
+                },
+                request_options=self.request_options
             )
             return response.text.strip()
-            
+
         except Exception as e:
             logger.error(f"Gemini chat response generation failed: {str(e)}")
-            return "I'm sorry, I encountered an error while processing your request."
-    
-    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for multiple texts"""
-        embeddings = []
-        
-        for i, text in enumerate(texts):
-            try:
-                logger.info(f"Generating embedding {i+1}/{len(texts)}")
-                embedding = self.generate_embedding(text)
-                embeddings.append(embedding)
-                # Small delay to avoid rate limits
-                time.sleep(0.1)
-            except Exception as e:
-                logger.error(f"Batch embedding generation failed for text {i+1}: {str(e)}")
-                # Use dummy embedding instead of raising
-                embeddings.append([0.0] * 1536)
-        
-        return embeddings 
\ No newline at end of file
+            raise LLMError(str(e)) from e
+
+    def stream_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
+                             temperature: float = 0.7,
+                             system_message: Optional[str] = None) -> Iterator[str]:
+        """Yield the chat response in pieces as the model produces them"""
+        if not self.model:
+            raise LLMNotConfigured("Gemini chat model is not available (is GEMINI_API_KEY set?)")
+
+        full_prompt = f"{system_message}\n\n{prompt}" if system_message else prompt
+        try:
+            for chunk in self.model.generate_content(
+                full_prompt,
+                generation_config={
+                    'max_output_tokens': max_tokens,
+                    'temperature': temperature
+                },
+                stream=True,
+                request_options=self.request_options
+            ):
+                yield chunk.text
+        except Exception as e:
+            logger.error(f"Gemini streaming response generation failed: {str(e)}")
+            raise LLMError(str(e)) from e
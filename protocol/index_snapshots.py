@@ -0,0 +1,270 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger('rag_tutor')
+
+MANIFEST_FILE = 'manifest.json'
+CURRENT_LINK = 'current'
+LOCK_FILE = '.write.lock'
+TMP_PREFIX = '.tmp-'
+
+# Versions that failed verification in this process, so they are not re-read on every check
+_corrupt_versions = set()
+# Versions without recorded file sizes whose checksums this process has already verified
+_verified_versions = set()
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot is missing or fails verification"""
+
+
+class WriteLock:
+    """Exclusive cross-process lock over one snapshot store.
+
+    An advisory ``flock`` serialises writers in different processes (web
+    workers, Celery workers, management commands). It is re-entrant within
+    a process so driver methods can nest without deadlocking.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except Exception:
+                os.close(fd)
+                self._thread_lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+
+_write_locks = {}
+_write_locks_guard = threading.Lock()
+
+
+class SnapshotStore:
+    """Immutable, versioned FAISS index snapshots.
+
+    Layout under ``root``::
+
+        <version>/index.faiss, <version>/metadata.pkl, <version>/manifest.json
+        current -> <version>
+
+    A snapshot is written into a temporary directory, checksummed, renamed
+    into place and then promoted by atomically replacing the ``current``
+    symlink. Readers only ever follow ``current`` into a complete directory,
+    so they never see a torn index or metadata from a different write.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @property
+    def current_link(self) -> str:
+        return os.path.join(self.root, CURRENT_LINK)
+
+    def path(self, version: str) -> str:
+        return os.path.join(self.root, version)
+
+    def write_lock(self) -> WriteLock:
+        """Lock to hold across any read-modify-write of this store's index"""
+        path = os.path.join(self.root, LOCK_FILE)
+        with _write_locks_guard:
+            if path not in _write_locks:
+                _write_locks[path] = WriteLock(path)
+            return _write_locks[path]
+
+    def current_version(self) -> Optional[str]:
+        """Version the ``current`` link points at, or None before the first snapshot"""
+        try:
+            return os.path.basename(os.readlink(self.current_link))
+        except OSError:
+            return None
+
+    def versions(self) -> List[str]:
+        """All complete snapshot versions, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if not name.startswith('.') and name != CURRENT_LINK
+            and os.path.isfile(os.path.join(self.root, name, MANIFEST_FILE))
+        )
+
+    def read_manifest(self, version: str) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self.path(version), MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise SnapshotError(f"Snapshot {version} has no readable manifest: {e}")
+
+    def list_snapshots(self) -> List[Dict[str, Any]]:
+        """Manifests of all snapshots, oldest first, flagging the current one"""
+        current = self.current_version()
+        snapshots = []
+        for version in self.versions():
+            try:
+                manifest = self.read_manifest(version)
+            except SnapshotError:
+                continue
+            manifest['is_current'] = version == current
+            snapshots.append(manifest)
+        return snapshots
+
+    def verify(self, version: str) -> bool:
+        """Check every file in the snapshot against its manifest checksum"""
+        try:
+            manifest = self.read_manifest(version)
+            for name, expected in manifest['files'].items():
+                if _sha256(os.path.join(self.path(version), name)) != expected:
+                    logger.error(f"Snapshot {version}: checksum mismatch for {name}")
+                    return False
+            return True
+        except (SnapshotError, OSError, KeyError) as e:
+            logger.error(f"Snapshot {version} failed verification: {e}")
+            return False
+
+    def intact(self, version: str) -> bool:
+        """Cheap load-time check: every file in the manifest exists with its recorded size.
+
+        Checksums are computed when a snapshot is written and verified before
+        a rollback promotes it, so reloads do not re-hash the whole index.
+        Snapshots written before sizes were recorded are hashed once per process.
+        """
+        try:
+            manifest = self.read_manifest(version)
+            sizes = manifest.get('sizes')
+            if sizes is None:
+                if version not in _verified_versions and not self.verify(version):
+                    return False
+                _verified_versions.add(version)
+                return True
+            for name in manifest['files']:
+                if os.path.getsize(os.path.join(self.path(version), name)) != sizes[name]:
+                    logger.error(f"Snapshot {version}: size mismatch for {name}")
+                    return False
+            return True
+        except (SnapshotError, OSError, KeyError) as e:
+            logger.error(f"Snapshot {version} is incomplete: {e}")
+            return False
+
+    def loadable_version(self) -> Optional[str]:
+        """The current version if it is intact, else the newest older snapshot that is"""
+        current = self.current_version()
+        candidates = [current] if current else []
+        candidates += [v for v in reversed(self.versions()) if v != current]
+        for version in candidates:
+            if version in _corrupt_versions:
+                continue
+            if self.intact(version):
+                if version != current:
+                    logger.warning(f"Current snapshot {current} is unusable, falling back to {version}")
+                return version
+            _corrupt_versions.add(version)
+        return None
+
+    def write(self, writer: Callable[[str], None], manifest: Dict[str, Any], keep: int = 5) -> str:
+        """Write a new snapshot with ``writer(directory)`` and promote it to current"""
+        os.makedirs(self.root, exist_ok=True)
+        version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f') + '-' + uuid.uuid4().hex[:6]
+        tmp_dir = os.path.join(self.root, f"{TMP_PREFIX}{version}")
+        os.makedirs(tmp_dir)
+        try:
+            writer(tmp_dir)
+            names = sorted(os.listdir(tmp_dir))
+            files = {name: _sha256(os.path.join(tmp_dir, name)) for name in names}
+            manifest = dict(
+                manifest,
+                version=version,
+                created_at=datetime.now(timezone.utc).isoformat(),
+                files=files,
+                sizes={name: os.path.getsize(os.path.join(tmp_dir, name)) for name in names},
+                checksum=hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest(),
+            )
+            with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            for name in os.listdir(tmp_dir):
+                _fsync(os.path.join(tmp_dir, name))
+            os.rename(tmp_dir, self.path(version))
+            _fsync_dir(self.root)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.promote(version)
+        self.prune(keep)
+        return version
+
+    def promote(self, version: str):
+        """Atomically point ``current`` at an existing snapshot"""
+        if not os.path.isfile(os.path.join(self.path(version), MANIFEST_FILE)):
+            raise SnapshotError(f"Snapshot {version} does not exist")
+        tmp_link = os.path.join(self.root, f"{TMP_PREFIX}link-{uuid.uuid4().hex}")
+        # Relative target keeps the link valid when the volume is mounted elsewhere
+        os.symlink(version, tmp_link)
+        os.replace(tmp_link, self.current_link)
+        _fsync_dir(self.root)
+        _corrupt_versions.discard(version)
+        logger.info(f"Promoted FAISS snapshot {version}")
+
+    def prune(self, keep: int):
+        """Delete the oldest snapshots beyond ``keep``, never the current one"""
+        if keep <= 0:
+            return
+        current = self.current_version()
+        for version in self.versions()[:-keep]:
+            if version != current:
+                shutil.rmtree(self.path(version), ignore_errors=True)
+                logger.info(f"Pruned FAISS snapshot {version}")
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fsync(path: str):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
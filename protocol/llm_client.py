@@ -1,256 +1,579 @@
-from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
+import asyncio
 import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
 from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from protocol.resilience import AIMDLimiter, CircuitBreaker
 
 logger = logging.getLogger('rag_tutor')
 
+_DONE = object()
+
+
+class LLMError(Exception):
+    """A model call failed or the provider is not configured"""
+
+
+class LLMNotConfigured(LLMError):
+    """The provider has no credentials or client library; says nothing about its health"""
+
+
+class LLMUnavailable(LLMError):
+    """The call was refused without reaching the provider; retry after ``retry_after`` seconds"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMProviderBusy(LLMUnavailable):
+    """Every concurrency slot for the endpoint stayed taken for ``LLM_ACQUIRE_TIMEOUT_SECONDS``"""
+
+
+class LLMCircuitOpen(LLMUnavailable):
+    """The endpoint failed repeatedly and is not being called until its cool-down ends"""
+
+
 class BaseLLMClient(ABC):
-    """Abstract base class for LLM clients"""
-    
+    """One model provider. Instances are shared by every LLMClient in the process"""
+
+    # Whether embeddings from this provider may be stored in the embedding cache
+    cacheable = True
+
     @abstractmethod
     def generate_embedding(self, text: str) -> List[float]:
         """Generate embedding vector for text"""
         pass
-    
+
     @abstractmethod
-    def generate_chat_response(self, 
-                             prompt: str, 
-                             max_tokens: int = 500,
+    def generate_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
                              temperature: float = 0.7,
                              system_message: Optional[str] = None) -> str:
         """Generate chat response"""
         pass
-    
-    @abstractmethod
+
     def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for multiple texts"""
-        pass
+        """Generate embeddings for multiple texts; providers with a batch endpoint override this"""
+        return [self.generate_embedding(text) for text in texts]
 
-class GeminiClient(BaseLLMClient):
-    """Google Gemini API client"""
-    
-    def __init__(self):
-        try:
-            import google.generativeai as genai
-            genai.configure(api_key=settings.GEMINI_API_KEY)
-            self.model = genai.GenerativeModel('gemini-1.5-flash')
-            self.embedding_model = genai.get_model('embedding-001')
-            self.available = True
-        except Exception as e:
-            logger.warning(f"Gemini client not available: {e}")
-            self.available = False
-    
-    def generate_embedding(self, text: str) -> List[float]:
-        if not self.available:
-            raise Exception("Gemini client not available")
-        
-        try:
-            result = self.embedding_model.embed_content(text.replace('\n', ' '))
-            return result['values'][0]['values']
-        except Exception as e:
-            logger.error(f"Gemini embedding generation failed: {str(e)}")
-            raise
-    
-    def generate_chat_response(self, 
-                             prompt: str, 
-                             max_tokens: int = 500,
+    def stream_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
                              temperature: float = 0.7,
-                             system_message: Optional[str] = None) -> str:
-        if not self.available:
-            raise Exception("Gemini client not available")
-        
-        try:
-            full_prompt = prompt
-            if system_message:
-                full_prompt = f"{system_message}\n\n{prompt}"
-            
-            response = self.model.generate_content(
-                full_prompt,
-                generation_config={
-                    'max_output_tokens': max_tokens,
-                    'temperature': temperature
-                }
-            )
-            return response.text.strip()
-        except Exception as e:
-            logger.error(f"Gemini chat response generation failed: {str(e)}")
-            raise
-    
-    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
-        if not self.available:
-            raise Exception("Gemini client not available")
-        
-        embeddings = []
-        for text in texts:
-            try:
-                embedding = self.generate_embedding(text)
-                embeddings.append(embedding)
-            except Exception as e:
-                logger.error(f"Gemini batch embedding generation failed: {str(e)}")
-                raise
-        return embeddings
+                             system_message: Optional[str] = None) -> Iterator[str]:
+        """Yield the response in pieces; providers without streaming yield it whole"""
+        yield self.generate_chat_response(prompt, max_tokens, temperature, system_message)
+
 
 class ClaudeClient(BaseLLMClient):
-    """Anthropic Claude API client"""
-    
-    def __init__(self):
+    """Anthropic Claude API client (chat only; Anthropic has no embedding endpoint)"""
+
+    def __init__(self, model_id: Optional[str] = None, timeout: Optional[float] = None):
+        self.model = model_id or 'claude-3-haiku-20240307'
         try:
             import anthropic
-            self.client = anthropic.Anthropic(api_key=settings.CLAUDE_API_KEY)
-            self.model = "claude-3-haiku-20240307"  # Free tier model
+            # One client per process keeps its HTTP connection pool warm
+            self.client = anthropic.Anthropic(
+                api_key=settings.CLAUDE_API_KEY,
+                timeout=timeout or settings.LLM_TIMEOUT_SECONDS
+            )
             self.available = True
         except Exception as e:
             logger.warning(f"Claude client not available: {e}")
+            self.client = None
             self.available = False
-    
+
     def generate_embedding(self, text: str) -> List[float]:
-        if not self.available:
-            raise Exception("Claude client not available")
-        
-        try:
-            response = self.client.embeddings.create(
-                model="claude-3-haiku-20240307",
-                input=text.replace('\n', ' ')
-            )
-            return response.embedding
-        except Exception as e:
-            logger.error(f"Claude embedding generation failed: {str(e)}")
-            raise
-    
-    def generate_chat_response(self, 
-                             prompt: str, 
-                             max_tokens: int = 500,
+        raise LLMNotConfigured("Claude has no embedding API; register an embedding provider for embeddings")
+
+    def generate_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
                              temperature: float = 0.7,
                              system_message: Optional[str] = None) -> str:
         if not self.available:
-            raise Exception("Claude client not available")
-        
+            raise LLMNotConfigured("Claude client is not available")
+
         try:
-            messages = []
-            if system_message:
-                messages.append({"role": "system", "content": system_message})
-            messages.append({"role": "user", "content": prompt})
-            
-            response = self.client.messages.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
+            response = self.client.messages.create(**self._request(prompt, max_tokens, temperature, system_message))
             return response.content[0].text.strip()
         except Exception as e:
             logger.error(f"Claude chat response generation failed: {str(e)}")
-            raise
-    
-    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
+            raise LLMError(str(e)) from e
+
+    def stream_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
+                             temperature: float = 0.7,
+                             system_message: Optional[str] = None) -> Iterator[str]:
         if not self.available:
-            raise Exception("Claude client not available")
-        
-        embeddings = []
-        for text in texts:
-            try:
-                embedding = self.generate_embedding(text)
-                embeddings.append(embedding)
-            except Exception as e:
-                logger.error(f"Claude batch embedding generation failed: {str(e)}")
-                raise
-        return embeddings
+            raise LLMNotConfigured("Claude client is not available")
+
+        try:
+            with self.client.messages.stream(**self._request(prompt, max_tokens, temperature, system_message)) as stream:
+                for text in stream.text_stream:
+                    yield text
+        except Exception as e:
+            logger.error(f"Claude streaming response generation failed: {str(e)}")
+            raise LLMError(str(e)) from e
+
+    def _request(self, prompt, max_tokens, temperature, system_message) -> Dict:
+        request = {
+            'model': self.model,
+            'messages': [{'role': 'user', 'content': prompt}],
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+        }
+        if system_message:
+            request['system'] = system_message
+        return request
 
-class FallbackLLMClient(BaseLLMClient):
-    """Fallback client that returns dummy responses"""
-    
-    def __init__(self):
+
+class LocalLLMClient(BaseLLMClient):
+    """Deterministic offline models (protocol.local_backend) for load tests and benchmarks"""
+
+    cacheable = False
+
+    def __init__(self, model_id: Optional[str] = None, timeout: Optional[float] = None):
+        from protocol.local_backend import CannedChatModel, LocalEmbeddingModel
+        # model_id picks the embedding method ('hashing' or 'projection') when given
+        self.embedding_model = LocalEmbeddingModel(method=model_id or None)
+        self.model = CannedChatModel()
         self.available = True
-    
+
     def generate_embedding(self, text: str) -> List[float]:
-        """Generate dummy embedding (1536-dimensional)"""
-        import random
-        random.seed(hash(text) % 2**32)
-        return [random.uniform(-1, 1) for _ in range(1536)]
-    
-    def generate_chat_response(self, 
-                             prompt: str, 
-                             max_tokens: int = 500,
+        return self.embedding_model.embed(text.replace('\n', ' ').strip())
+
+    def generate_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
                              temperature: float = 0.7,
                              system_message: Optional[str] = None) -> str:
-        """Generate dummy response"""
-        return f"This is a fallback response to: {prompt[:100]}..."
-    
-    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Generate dummy batch embeddings"""
-        return [self.generate_embedding(text) for text in texts]
+        full_prompt = f"{system_message}\n\n{prompt}" if system_message else prompt
+        return self.model.generate_content(full_prompt).text.strip()
+
+    def stream_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
+                             temperature: float = 0.7,
+                             system_message: Optional[str] = None) -> Iterator[str]:
+        full_prompt = f"{system_message}\n\n{prompt}" if system_message else prompt
+        for chunk in self.model.generate_content(full_prompt, stream=True):
+            yield chunk.text
+
+
+def _gemini(model_id: Optional[str] = None, timeout: Optional[float] = None) -> BaseLLMClient:
+    from protocol.gemini_client import GeminiClient
+    return GeminiClient(model_id=model_id, timeout=timeout)
+
+
+# EmbeddingModel.provider -> factory(model_id, timeout)
+PROVIDERS = {
+    'gemini': _gemini,
+    'google': _gemini,
+    'claude': ClaudeClient,
+    'anthropic': ClaudeClient,
+    'local': LocalLLMClient,
+}
+# Providers without an embedding endpoint, refused for the 'embedding' purpose
+CHAT_ONLY_PROVIDERS = {'claude', 'anthropic'}
+
+_lock = threading.Lock()
+# (provider, model id) -> shared client; (provider, 'embed' or 'chat') -> its breaker and limiter
+_clients: Dict[Tuple[str, str], BaseLLMClient] = {}
+_guards: Dict[Tuple[str, str], Tuple[CircuitBreaker, AIMDLimiter]] = {}
+# (loaded at, {purpose: (provider, model id)}) from the EmbeddingModel table
+_registry: Optional[Tuple[float, Dict[str, Tuple[str, str]]]] = None
+# persona -> (computed at, hedge deadline in ms)
+_deadlines: Dict[str, Tuple[float, float]] = {}
+# (pid, pool) running chat requests; a pool inherited across fork has no threads
+_executor: Optional[Tuple[int, ThreadPoolExecutor]] = None
+
+
+def get_provider_client(provider: str, model_id: str = '') -> BaseLLMClient:
+    """The process-wide client for a provider and model, created on first use"""
+    key = (provider, model_id)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = PROVIDERS[provider](model_id=model_id or None, timeout=settings.LLM_TIMEOUT_SECONDS)
+                _clients[key] = client
+                logger.info(f"Created {provider} client for model {model_id or '(default)'}")
+    return client
+
+
+def _guard(provider: str, endpoint: str) -> Tuple[CircuitBreaker, AIMDLimiter]:
+    key = (provider, endpoint)
+    guard = _guards.get(key)
+    if guard is None:
+        with _lock:
+            guard = _guards.get(key)
+            if guard is None:
+                guard = _guards[key] = (
+                    CircuitBreaker(settings.LLM_BREAKER_FAILURES, settings.LLM_BREAKER_RESET_SECONDS),
+                    AIMDLimiter(
+                        settings.LLM_PROVIDER_LIMITS.get(provider, settings.LLM_MAX_CONCURRENCY),
+                        maximum=settings.LLM_AIMD_MAX_CONCURRENCY,
+                        slow_factor=settings.LLM_AIMD_SLOW_FACTOR
+                    )
+                )
+    return guard
+
+
+@contextmanager
+def provider_guard(provider: str, endpoint: str):
+    """Admit one call to a provider endpoint through its circuit breaker and AIMD limiter.
+
+    Raises ``LLMCircuitOpen`` while the endpoint is failing and
+    ``LLMProviderBusy`` when no slot frees up within
+    ``LLM_ACQUIRE_TIMEOUT_SECONDS``; both leave the provider alone. The
+    outcome of the call feeds both back. The caller may set
+    ``latency_ms`` on the yielded object (e.g. to the time to first token)
+    to report a better latency signal than the whole call's duration.
+    """
+    breaker, limiter = _guard(provider, endpoint)
+    retry_after = breaker.allow()
+    if retry_after:
+        raise LLMCircuitOpen(f"{provider} {endpoint} circuit is open", retry_after)
+    if not limiter.acquire(settings.LLM_ACQUIRE_TIMEOUT_SECONDS):
+        raise LLMProviderBusy(
+            f"{provider} {endpoint} is at its concurrency limit of {int(limiter.limit)}", limiter.retry_after()
+        )
+
+    call = SimpleNamespace(latency_ms=None)
+    start = time.perf_counter()
+    ok = None
+    try:
+        yield call
+        ok = True
+    except LLMNotConfigured:
+        raise
+    except Exception:
+        ok = False
+        raise
+    finally:
+        if ok:
+            breaker.record_success()
+        elif ok is False:
+            breaker.record_failure()
+            if breaker.state == CircuitBreaker.OPEN:
+                logger.warning(f"{provider} {endpoint} circuit opened after {breaker.failures} failures")
+        limiter.release(ok, call.latency_ms if call.latency_ms is not None else (time.perf_counter() - start) * 1000)
+
+
+def guard_states() -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Breaker state and limiter figures of every endpoint called in this process"""
+    return {
+        key: dict(limiter.as_dict(), circuit=breaker.state)
+        for key, (breaker, limiter) in list(_guards.items())
+    }
+
+
+def refresh_providers(**kwargs):
+    """Re-read the EmbeddingModel table on the next call (other processes pick changes up within the refresh interval)"""
+    global _registry
+    _registry = None
+
+
+def _registered_providers() -> Dict[str, Tuple[str, str]]:
+    global _registry
+    registry = _registry
+    if registry is not None and time.monotonic() - registry[0] < settings.LLM_PROVIDER_REFRESH_SECONDS:
+        return registry[1]
+
+    from knowledge_base.models import EmbeddingModel
+    rows, dimensions = {}, {}
+    try:
+        # Newest active row of each purpose wins
+        for row in EmbeddingModel.objects.filter(is_active=True).order_by('created_at'):
+            if row.provider not in PROVIDERS:
+                logger.error(f"Ignoring EmbeddingModel '{row.name}': unknown provider '{row.provider}'")
+                continue
+            if row.purpose == 'embedding' and row.provider in CHAT_ONLY_PROVIDERS:
+                logger.error(f"Ignoring EmbeddingModel '{row.name}': provider '{row.provider}' cannot embed")
+                continue
+            rows[row.purpose] = (row.provider, row.model_id)
+            dimensions[row.purpose] = row.vector_dimension
+    except Exception as e:
+        logger.warning(f"Could not read EmbeddingModel providers, using settings: {e}")
+    if 'embedding' in rows and dimensions.get('embedding') != settings.EMBEDDING_DIMENSION:
+        logger.warning(
+            f"Embedding model {rows['embedding'][1]} is registered with {dimensions['embedding']} dimensions "
+            f"but EMBEDDING_DIMENSION is {settings.EMBEDDING_DIMENSION}; rebuild the index after switching"
+        )
+    _registry = (time.monotonic(), rows)
+    return rows
+
+
+def resolve_provider(purpose: str) -> Tuple[str, str]:
+    """(provider, model id) for 'embedding', 'chat' or 'chat_fallback' calls.
+
+    The active ``EmbeddingModel`` row with that purpose decides; without one
+    ``LLM_BACKEND`` with ``EMBEDDING_MODEL`` / ``CHAT_MODEL`` does, and
+    hedged chat requests go to the chat provider.
+    """
+    registered = _registered_providers().get(purpose)
+    if registered is not None:
+        return registered
+    if purpose == 'chat_fallback':
+        return resolve_provider('chat')
+    if settings.LLM_BACKEND == 'local':
+        return 'local', ''
+    return settings.LLM_BACKEND, settings.EMBEDDING_MODEL if purpose == 'embedding' else settings.CHAT_MODEL
+
+
+def _persona_bucket(persona: Optional[str]) -> Optional[str]:
+    """The persona itself if it is one of TUTOR_PERSONAS; None (the shared bucket) otherwise"""
+    return persona if persona in settings.TUTOR_PERSONAS else None
+
+
+def first_token_stage(persona: Optional[str]) -> str:
+    # Unknown personas share one stage, so callers cannot grow the histograms without bound
+    persona = _persona_bucket(persona)
+    return f"llm_first_token.{persona}" if persona else 'llm_first_token'
+
+
+def hedge_deadline_ms(persona: Optional[str] = None) -> float:
+    """How long a chat call waits for its first token before sending a hedge request.
+
+    ``LLM_HEDGE_DEADLINES_MS[persona]`` when set; otherwise the
+    ``LLM_HEDGE_QUANTILE`` of this process's observed time to first token
+    for the persona, recomputed every ``LLM_HEDGE_REFRESH_SECONDS``, or
+    ``LLM_HEDGE_DEFAULT_MS`` until ``LLM_HEDGE_MIN_SAMPLES`` are in.
+    """
+    persona = _persona_bucket(persona)
+    fixed = settings.LLM_HEDGE_DEADLINES_MS.get(persona or 'default')
+    if fixed is not None:
+        return fixed
+    now = time.monotonic()
+    cached = _deadlines.get(persona or '')
+    if cached is not None and now - cached[0] < settings.LLM_HEDGE_REFRESH_SECONDS:
+        return cached[1]
+
+    from context.instrumentation import stage_latencies
+    count, observed = stage_latencies.percentile(first_token_stage(persona), settings.LLM_HEDGE_QUANTILE)
+    deadline = observed if count >= settings.LLM_HEDGE_MIN_SAMPLES else settings.LLM_HEDGE_DEFAULT_MS
+    _deadlines[persona or ''] = (now, deadline)
+    return deadline
+
+
+def _chat_executor() -> ThreadPoolExecutor:
+    global _executor
+    executor = _executor
+    if executor is None or executor[0] != os.getpid():
+        with _lock:
+            executor = _executor
+            if executor is None or executor[0] != os.getpid():
+                executor = _executor = (
+                    os.getpid(),
+                    ThreadPoolExecutor(settings.LLM_HEDGE_WORKERS, thread_name_prefix='llm-chat')
+                )
+    return executor[1]
+
+
+def _chat_attempt(target: Tuple[str, str], args: tuple, responded: threading.Event, cancelled: threading.Event,
+                  first_token: Optional[str] = None) -> Optional[str]:
+    """Stream one complete chat response; sets ``responded`` on the first token or on failure.
+
+    Once ``cancelled`` is set (the other request answered, or the caller
+    gave up) the stream is closed at its next piece and None is returned,
+    releasing the endpoint's slot and the pool thread.
+
+    For the primary request ``first_token`` names the stage its time to first
+    token is recorded under, and its total time is recorded as
+    ``llm_chat_primary``, the latency callers would see without hedging.
+    """
+    from context.instrumentation import stage_latencies
+    provider, model_id = target
+    start = time.perf_counter()
+    try:
+        if cancelled.is_set():
+            return None
+        with provider_guard(provider, 'chat') as call:
+            pieces = []
+            stream = get_provider_client(provider, model_id).stream_chat_response(*args)
+            try:
+                for piece in stream:
+                    if not pieces:
+                        responded.set()
+                        # Answer length varies; time to first token is what tells a slow provider
+                        call.latency_ms = (time.perf_counter() - start) * 1000
+                        if first_token:
+                            stage_latencies.record(first_token, call.latency_ms)
+                    pieces.append(piece)
+                    if cancelled.is_set():
+                        return None
+            finally:
+                stream.close()
+        if first_token:
+            stage_latencies.record('llm_chat_primary', (time.perf_counter() - start) * 1000)
+        return ''.join(pieces).strip()
+    finally:
+        responded.set()
+
+
+post_save.connect(refresh_providers, sender='knowledge_base.EmbeddingModel')
+post_delete.connect(refresh_providers, sender='knowledge_base.EmbeddingModel')
+
 
 class LLMClient:
-    """Main LLM client with fallback support"""
-    
-    def __init__(self):
-        self.clients = []
-        
-        # Try to initialize clients in order of preference
-        try:
-            self.clients.append(GeminiClient())
-        except:
-            pass
-        
-        try:
-            self.clients.append(ClaudeClient())
-        except:
-            pass
-        
-        # Always add fallback client
-        self.clients.append(FallbackLLMClient())
-        
-        # Find first available client
-        self.active_client = None
-        for client in self.clients:
-            if client.available:
-                self.active_client = client
-                logger.info(f"Using LLM client: {client.__class__.__name__}")
-                break
-    
+    """Entry point for model calls: routes each call to the registered provider.
+
+    Provider clients are pooled per process, so constructing an LLMClient is
+    cheap and every instance shares connections. Every call passes through
+    ``provider_guard`` for its provider's embed or chat endpoint, so a
+    failing or saturated provider is refused fast with an ``LLMUnavailable``
+    carrying a retry-after. Chat calls are
+    hedged (see ``generate_chat_response``). The ``a``-prefixed
+    methods are the asyncio versions; they run the call on a worker thread
+    and give up after the same timeout.
+    """
+
+    def provider(self, purpose: str) -> BaseLLMClient:
+        return get_provider_client(*resolve_provider(purpose))
+
+    @contextmanager
+    def _slot(self, purpose: str):
+        provider, model_id = resolve_provider(purpose)
+        with provider_guard(provider, 'embed' if purpose == 'embedding' else 'chat'):
+            yield get_provider_client(provider, model_id)
+
     def generate_embedding(self, text: str) -> List[float]:
-        """Generate embedding using the first available client"""
-        if not self.active_client:
-            raise Exception("No LLM client available")
-        
-        for client in self.clients:
-            try:
-                return client.generate_embedding(text)
-            except Exception as e:
-                logger.warning(f"Failed with {client.__class__.__name__}: {e}")
-                continue
-        
-        raise Exception("All LLM clients failed")
-    
-    def generate_chat_response(self, 
-                             prompt: str, 
-                             max_tokens: int = 500,
+        with self._slot('embedding') as client:
+            return client.generate_embedding(text)
+
+    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in requests of ``LLM_EMBED_BATCH_SIZE``; each request is admitted separately"""
+        embeddings = []
+        size = settings.LLM_EMBED_BATCH_SIZE
+        for start in range(0, len(texts), size):
+            with self._slot('embedding') as client:
+                embeddings.extend(client.generate_batch_embeddings(texts[start:start + size]))
+        return embeddings
+
+    def generate_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
                              temperature: float = 0.7,
-                             system_message: Optional[str] = None) -> str:
-        """Generate chat response using the first available client"""
-        if not self.active_client:
-            raise Exception("No LLM client available")
-        
-        for client in self.clients:
+                             system_message: Optional[str] = None,
+                             persona: Optional[str] = None) -> str:
+        """Complete chat response, hedged when ``LLM_HEDGE_ENABLED``; raises ``LLMError`` if no request succeeds.
+
+        The primary request streams on the chat pool. If it has no first
+        token by ``hedge_deadline_ms(persona)``, or fails, the same call goes
+        to the ``chat_fallback`` provider and the first complete response is
+        returned. The slower request is cancelled at its next streamed piece.
+        """
+        from context.instrumentation import hedge_stats, stage_latencies
+        start = time.perf_counter()
+        args = (prompt, max_tokens, temperature, system_message)
+        # Counted per persona bucket, like the first-token latencies that set the hedge deadline
+        persona = _persona_bucket(persona)
+        hedge_stats.count(persona, 'requests')
+        if not settings.LLM_HEDGE_ENABLED:
             try:
-                return client.generate_chat_response(prompt, max_tokens, temperature, system_message)
-            except Exception as e:
-                logger.warning(f"Failed with {client.__class__.__name__}: {e}")
-                continue
-        
-        raise Exception("All LLM clients failed")
-    
-    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Generate batch embeddings using the first available client"""
-        if not self.active_client:
-            raise Exception("No LLM client available")
-        
-        for client in self.clients:
+                with self._slot('chat') as client:
+                    response = client.generate_chat_response(*args)
+            except LLMError:
+                hedge_stats.count(persona, 'failed')
+                raise
+            stage_latencies.record('llm_chat', (time.perf_counter() - start) * 1000)
+            return response
+
+        # Resolved here: the registry may need the database, which pool threads should not touch
+        primary_target, hedge_target = resolve_provider('chat'), resolve_provider('chat_fallback')
+        executor = _chat_executor()
+        responded, cancelled = threading.Event(), threading.Event()
+        primary = executor.submit(_chat_attempt, primary_target, args, responded, cancelled, first_token_stage(persona))
+        pending, hedge, error = {primary}, None, None
+        try:
+            hedge_after_ms = hedge_deadline_ms(persona)
+            if not responded.wait(hedge_after_ms / 1000):
+                hedge = executor.submit(_chat_attempt, hedge_target, args, threading.Event(), cancelled)
+                pending.add(hedge)
+                hedge_stats.count(persona, 'hedged')
+                logger.info(f"Chat request hedged to {hedge_target[0]}: no first token after {hedge_after_ms:.0f}ms")
+
+            deadline = start + settings.LLM_TIMEOUT_SECONDS
+            while pending:
+                done, pending = wait(pending, timeout=max(deadline - time.perf_counter(), 0), return_when=FIRST_COMPLETED)
+                if not done:
+                    error = LLMError(f"No chat response within {settings.LLM_TIMEOUT_SECONDS}s")
+                    break
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            hedge_stats.count(persona, 'hedge_won')
+                        stage_latencies.record('llm_chat', (time.perf_counter() - start) * 1000)
+                        return future.result()
+                    error = future.exception()
+                    logger.warning(f"Chat request to {(hedge_target if future is hedge else primary_target)[0]} failed: {error}")
+                if hedge is None:
+                    hedge = executor.submit(_chat_attempt, hedge_target, args, threading.Event(), cancelled)
+                    pending.add(hedge)
+                    hedge_stats.count(persona, 'fallback')
+        finally:
+            # The losing request stops streaming, so it no longer holds a slot, a thread or spends tokens
+            cancelled.set()
+
+        hedge_stats.count(persona, 'failed')
+        raise error if isinstance(error, LLMError) else LLMError(str(error))
+
+    def stream_chat_response(self,
+                             prompt: str,
+                             max_tokens: int = 16384,
+                             temperature: float = 0.7,
+                             system_message: Optional[str] = None) -> Iterator[str]:
+        """Yield response pieces; the slot is held until the stream is exhausted or closed"""
+        with self._slot('chat') as client:
+            yield from client.stream_chat_response(prompt, max_tokens, temperature, system_message)
+
+    async def _run(self, function, *args):
+        return await asyncio.wait_for(asyncio.to_thread(function, *args), settings.LLM_TIMEOUT_SECONDS)
+
+    async def agenerate_embedding(self, text: str) -> List[float]:
+        return await self._run(self.generate_embedding, text)
+
+    async def agenerate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._run(self.generate_batch_embeddings, texts)
+
+    async def agenerate_chat_response(self,
+                                    prompt: str,
+                                    max_tokens: int = 16384,
+                                    temperature: float = 0.7,
+                                    system_message: Optional[str] = None,
+                                    persona: Optional[str] = None) -> str:
+        return await self._run(self.generate_chat_response, prompt, max_tokens, temperature, system_message, persona)
+
+    async def astream_chat_response(self,
+                                  prompt: str,
+                                  max_tokens: int = 16384,
+                                  temperature: float = 0.7,
+                                  system_message: Optional[str] = None) -> AsyncIterator[str]:
+        """Async version of ``stream_chat_response``; the timeout applies to each piece"""
+        pieces = self.stream_chat_response(prompt, max_tokens, temperature, system_message)
+        try:
+            while True:
+                piece = await self._run(next, pieces, _DONE)
+                if piece is _DONE:
+                    return
+                yield piece
+        finally:
             try:
-                return client.generate_batch_embeddings(texts)
-            except Exception as e:
-                logger.warning(f"Failed with {client.__class__.__name__}: {e}")
-                continue
-        
-        raise Exception("All LLM clients failed") 
\ No newline at end of file
+                await asyncio.to_thread(pieces.close)
+            except ValueError:
+                # A timed-out next() is still running on its thread; the generator ends with it
+                pass
@@ -0,0 +1,105 @@
+import hashlib
+import re
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Iterator, List, Optional
+
+import numpy as np
+from django.conf import settings
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+QUESTION_RE = re.compile(r"Student Question:\s*(.+)")
+CONTEXT_RE = re.compile(r"Context from [^\n]*:\n(.*?)\n\s*Student Question:", re.S)
+CANNED_SQL = "SELECT COUNT(*) AS textbooks FROM knowledge_base_textbookcontent"
+
+
+class LocalEmbeddingModel:
+    """Deterministic offline embeddings at ``EMBEDDING_DIMENSION``; no network, no model weights.
+
+    Word unigrams and bigrams are either feature-hashed into signed buckets
+    (``hashing``) or mapped to seeded Gaussian vectors that are summed
+    (``projection``, a random projection of the bag of words). Either way
+    texts sharing vocabulary get nearby unit vectors, so FAISS search over
+    them ranks like it would over real embeddings.
+    """
+
+    # Vectors must never be mistaken for the real model's in the embedding cache
+    cacheable = False
+
+    def __init__(self, dimension: Optional[int] = None, method: Optional[str] = None):
+        self.dimension = dimension or settings.EMBEDDING_DIMENSION
+        self.method = method or settings.LOCAL_EMBEDDING_METHOD
+        self._projection = lru_cache(maxsize=50000)(self._token_vector)
+
+    def embed_content(self, content: str, task_type: Optional[str] = None):
+        """Same call and result shape as the Gemini embedding model"""
+        return SimpleNamespace(embedding=self.embed(content))
+
+    def embed(self, text: str) -> List[float]:
+        words = TOKEN_RE.findall(text.lower())
+        features = [(word, 1.0) for word in words]
+        features += [(f"{first} {second}", 0.5) for first, second in zip(words, words[1:])]
+
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for feature, weight in features:
+            if self.method == 'projection':
+                vector += weight * self._projection(feature)
+            else:
+                digest = self._hash(feature)
+                vector[digest % self.dimension] += weight if digest >> 63 else -weight
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    @staticmethod
+    def _hash(feature: str) -> int:
+        return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'big')
+
+    def _token_vector(self, feature: str) -> np.ndarray:
+        rng = np.random.default_rng(self._hash(feature))
+        return rng.standard_normal(self.dimension).astype(np.float32) / np.sqrt(self.dimension)
+
+
+class CannedChatModel:
+    """Offline stand-in for ``genai.GenerativeModel`` with simulated latency.
+
+    The answer echoes the question and the start of the prompt's context,
+    so it varies with retrieval. ``LOCAL_CHAT_FIRST_TOKEN_MS`` and
+    ``LOCAL_CHAT_TOKEN_MS`` model time to first token and per-token
+    generation; ``stream=True`` yields the answer a word at a time at
+    that pace, as the real streaming API yields chunks.
+    """
+
+    def __init__(self, first_token_ms: Optional[float] = None, token_ms: Optional[float] = None,
+                 answer_words: Optional[int] = None):
+        self.first_token_ms = settings.LOCAL_CHAT_FIRST_TOKEN_MS if first_token_ms is None else first_token_ms
+        self.token_ms = settings.LOCAL_CHAT_TOKEN_MS if token_ms is None else token_ms
+        self.answer_words = answer_words or settings.LOCAL_CHAT_ANSWER_WORDS
+
+    def generate_content(self, prompt: str, generation_config=None, stream: bool = False):
+        words = self.answer(prompt).split(' ')
+        if stream:
+            return self._stream(words)
+        time.sleep((self.first_token_ms + self.token_ms * (len(words) - 1)) / 1000)
+        return SimpleNamespace(text=' '.join(words))
+
+    def answer(self, prompt: str) -> str:
+        if prompt.rstrip().endswith('SQL Query:'):
+            # The SQL agent's generation prompt; any valid read-only query exercises the rest of its path
+            return CANNED_SQL
+        question = QUESTION_RE.search(prompt)
+        context = CONTEXT_RE.search(prompt)
+        words = (context.group(1).split() if context else [])[:self.answer_words]
+        asked = question.group(1).strip() if question else prompt.strip()[:200]
+        if not words:
+            return f"(local model) No textbook context was provided for: {asked}"
+        return f"(local model) Answer to: {asked} Based on the textbook: {' '.join(words)}"
+
+    def _stream(self, words: List[str]) -> Iterator[SimpleNamespace]:
+        # sleep(0) still yields the GIL, which costs more than the rest of the stream
+        if self.first_token_ms:
+            time.sleep(self.first_token_ms / 1000)
+        for index, word in enumerate(words):
+            if index and self.token_ms:
+                time.sleep(self.token_ms / 1000)
+            yield SimpleNamespace(text=word if index == 0 else f" {word}")
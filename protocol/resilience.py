@@ -0,0 +1,116 @@
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint after repeated failures, then probes it with one call.
+
+    ``failure_threshold`` consecutive failures open the circuit for
+    ``reset_seconds``; while open, ``allow()`` refuses immediately. After
+    the cool-down one caller is let through (half-open): its success closes
+    the circuit, its failure opens it for another cool-down.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> float:
+        """0 if a call may go ahead, else seconds until the circuit will try again"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            now = time.monotonic()
+            remaining = self.opened_at + self.reset_seconds - now
+            if remaining <= 0:
+                # Cool-down over, or the last probe never reported back: let one probe through
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return 0.0
+            return max(remaining, 1.0)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class AIMDLimiter:
+    """Concurrency limit that adapts to the endpoint: additive increase, multiplicative decrease.
+
+    Each success raises the limit by ``1 / limit`` (one slot per limit's
+    worth of calls); a failure, or a call slower than ``slow_factor`` times
+    the smoothed latency, multiplies it by ``backoff``, at most once per
+    smoothed latency so one burst of slow calls counts once. Callers that
+    find every slot taken wait at most the acquire timeout, so saturation
+    turns into fast rejections instead of a queue of blocked workers.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64,
+                 backoff: float = 0.5, slow_factor: float = 2.0):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.backoff = backoff
+        self.slow_factor = slow_factor
+        self.in_flight = 0
+        self.latency_ms: Optional[float] = None
+        self.last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, ok: Optional[bool], latency_ms: Optional[float] = None):
+        """Free a slot; ``ok=None`` for calls that say nothing about the endpoint's health"""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+            if ok is None:
+                return
+            slow = (
+                ok and latency_ms is not None and self.latency_ms is not None and self.slow_factor > 0
+                and latency_ms > self.slow_factor * self.latency_ms
+            )
+            if ok and latency_ms is not None:
+                self.latency_ms = latency_ms if self.latency_ms is None else 0.9 * self.latency_ms + 0.1 * latency_ms
+            now = time.monotonic()
+            if not ok or slow:
+                if (now - self.last_decrease) * 1000 >= (self.latency_ms or 0):
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def retry_after(self) -> float:
+        """Seconds a rejected caller should wait: about one smoothed call"""
+        return max(1.0, (self.latency_ms or 0) / 1000)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'latency_ms': round(self.latency_ms, 1) if self.latency_ms is not None else None,
+        }
@@ -0,0 +1,4 @@
+# Load the Celery app with Django so task routes apply when tasks are sent from web processes
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
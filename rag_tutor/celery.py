@@ -1,6 +1,8 @@
 import os
+from typing import Dict, List, Optional
 from celery import Celery
 from django.conf import settings
+from kombu.exceptions import ChannelError
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rag_tutor.settings')
 
@@ -10,4 +12,33 @@ app.autodiscover_tasks()
 
 @app.task(bind=True)
 def debug_task(self):
-    print(f'Request: {self.request!r}')
\ No newline at end of file
+    print(f'Request: {self.request!r}')
+
+
+def monitored_queues() -> List[str]:
+    queues = list(settings.CELERY_MONITORED_QUEUES)
+    if settings.FAISS_SHARD_BACKEND == 'celery':
+        queues += [f"faiss_shard_{shard_id}" for shard_id in range(settings.FAISS_SHARD_COUNT)]
+    return queues
+
+
+def queue_depths(queues: Optional[List[str]] = None) -> Dict[str, int]:
+    """Messages waiting in each queue, all priorities together; excludes tasks already prefetched by workers.
+
+    Raises kombu's OperationalError if the broker cannot be reached.
+    """
+    depths = {}
+    with app.connection_for_read() as connection:
+        connection.ensure_connection(max_retries=1)
+        channel = connection.channel()
+        try:
+            for queue in queues or monitored_queues():
+                try:
+                    depths[queue] = channel.queue_declare(queue, passive=True).message_count
+                except ChannelError:
+                    # Never declared, or (Redis) drained: an empty list is deleted. The channel is closed now
+                    depths[queue] = 0
+                    channel = connection.channel()
+        finally:
+            channel.close()
+    return depths
@@ -21,6 +21,12 @@ from celery import Celery
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
+def _name_values(value, cast):
+    """Parse a "name=value,name=value" environment setting into a dict"""
+    return {name.strip(): cast(item) for name, item in
+            (pair.split('=') for pair in value.split(',') if pair.strip())}
+
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
 
@@ -51,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rag_tutor.tracing.TraceMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -170,50 +177,192 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+# Work is split by resource so bulk uploads cannot starve interactive tasks; each queue has its own
+# worker in docker-compose.yml: celery (pipeline warm-up, analytics), ingestion_extract (CPU-bound,
+# prefork pool), ingestion_embed (waits on the embedding API, threads pool with high concurrency),
+# index_writer (index mutations, concurrency 1) and notifications (webhooks)
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_TASK_ROUTES = {
+    'context.rag_pipeline.initialize_rag_pipeline': {'queue': 'celery', 'priority': 0},
+    'knowledge_base.tasks.rollup_query_analytics': {'queue': 'celery', 'priority': 9},
+    'knowledge_base.tasks.process_textbook_content': {'queue': 'ingestion_extract', 'priority': 6},
+    'knowledge_base.tasks.extract_textbook_text': {'queue': 'ingestion_extract', 'priority': 6},
+    'knowledge_base.tasks.chunk_textbook': {'queue': 'ingestion_extract', 'priority': 6},
+    # Finishing a textbook goes ahead of starting the next one
+    'knowledge_base.tasks.merge_textbook_index': {'queue': 'ingestion_extract', 'priority': 2},
+    'knowledge_base.tasks.embed_chunk_batch': {'queue': 'ingestion_embed', 'priority': 5},
+    'knowledge_base.tasks.apply_index_updates': {'queue': 'index_writer', 'priority': 0},
+    'api.tasks.send_webhook_async': {'queue': 'notifications', 'priority': 5},
+}
+CELERY_TASK_DEFAULT_PRIORITY = 5
+# Redis emulates priorities with one list per step; 0 is the highest priority
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+# Prefetched messages skip the priority order, so workers reserve one task per process by default;
+# the embed and notification workers raise it on the command line for their short IO-bound tasks
+CELERY_WORKER_PREFETCH_MULTIPLIER = config('CELERY_WORKER_PREFETCH_MULTIPLIER', default=1, cast=int)
+# Queues reported by /api/metrics/queues/ (plus faiss_shard_<n> with FAISS_SHARD_BACKEND=celery)
+CELERY_MONITORED_QUEUES = ['celery', 'ingestion_extract', 'ingestion_embed', 'index_writer', 'notifications']
+INDEX_UPDATE_COALESCE_SECONDS = config('INDEX_UPDATE_COALESCE_SECONDS', default=5, cast=int)
+INDEX_UPDATE_BATCH_SIZE = config('INDEX_UPDATE_BATCH_SIZE', default=500, cast=int)
+# Chunks per embed_chunk_batch task; a textbook's batches run as one chord spread over all workers
+INGEST_EMBED_BATCH_SIZE = config('INGEST_EMBED_BATCH_SIZE', default=200, cast=int)
+# New chunks whose SimHash is within INGEST_SIMHASH_MAX_DISTANCE bits (at most 3, the LSH table's
+# guarantee) of an embedded chunk of another textbook reuse its embedding instead of calling the API
+INGEST_DEDUP_ENABLED = config('INGEST_DEDUP_ENABLED', default=True, cast=bool)
+INGEST_SIMHASH_MAX_DISTANCE = config('INGEST_SIMHASH_MAX_DISTANCE', default=3, cast=int)
+
+# Analytics rollups: QueryLog is folded into hourly/daily QueryRollup rows by a beat task
+ANALYTICS_ROLLUP_INTERVAL = config('ANALYTICS_ROLLUP_INTERVAL', default=300, cast=int)  # Seconds between runs
+ANALYTICS_ROLLUP_SETTLE_SECONDS = config('ANALYTICS_ROLLUP_SETTLE_SECONDS', default=300, cast=int)  # Re-read for late commits
+ANALYTICS_ROLLUP_WINDOW_HOURS = config('ANALYTICS_ROLLUP_WINDOW_HOURS', default=24, cast=int)  # Log span aggregated per query
+ANALYTICS_LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+CELERY_BEAT_SCHEDULE = {
+    'rollup-query-analytics': {
+        'task': 'knowledge_base.tasks.rollup_query_analytics',
+        'schedule': ANALYTICS_ROLLUP_INTERVAL,
+    },
+}
 
 # AI/ML Configuration
 GEMINI_API_KEY = config('GEMINI_API_KEY', default='')
 CLAUDE_API_KEY = config('CLAUDE_API_KEY', default='')
+EMBEDDING_MODEL = config('EMBEDDING_MODEL', default='models/embedding-001')
+CHAT_MODEL = config('CHAT_MODEL', default='gemini-1.5-flash')
+EMBEDDING_DIMENSION = config('EMBEDDING_DIMENSION', default=768, cast=int)  # Output size of EMBEDDING_MODEL
+# 'gemini', or 'local' for deterministic offline stand-ins (hashed embeddings, canned answers) in load tests
+LLM_BACKEND = config('LLM_BACKEND', default='gemini')
+LOCAL_EMBEDDING_METHOD = config('LOCAL_EMBEDDING_METHOD', default='hashing')  # 'hashing' or 'projection'
+LOCAL_CHAT_FIRST_TOKEN_MS = config('LOCAL_CHAT_FIRST_TOKEN_MS', default=0, cast=float)  # Simulated time to first token
+LOCAL_CHAT_TOKEN_MS = config('LOCAL_CHAT_TOKEN_MS', default=0, cast=float)  # Simulated time per further token
+LOCAL_CHAT_ANSWER_WORDS = config('LOCAL_CHAT_ANSWER_WORDS', default=80, cast=int)
+# protocol.llm_client.LLMClient routes calls to the active EmbeddingModel row of each purpose
+# ('embedding', 'chat'), falling back to LLM_BACKEND with EMBEDDING_MODEL / CHAT_MODEL
+LLM_TIMEOUT_SECONDS = config('LLM_TIMEOUT_SECONDS', default=30, cast=float)  # Per call
+# Each provider endpoint (embed, chat) has an AIMD concurrency limit per process, starting here and
+# adapting between 1 and LLM_AIMD_MAX_CONCURRENCY; a call finding no free slot within
+# LLM_ACQUIRE_TIMEOUT_SECONDS is refused (503 with Retry-After) rather than queued
+LLM_MAX_CONCURRENCY = config('LLM_MAX_CONCURRENCY', default=8, cast=int)
+# Per-provider overrides of LLM_MAX_CONCURRENCY, e.g. "gemini=16,claude=4"
+LLM_PROVIDER_LIMITS = config('LLM_PROVIDER_LIMITS', default='local=64', cast=lambda value: _name_values(value, int))
+LLM_AIMD_MAX_CONCURRENCY = config('LLM_AIMD_MAX_CONCURRENCY', default=64, cast=int)
+LLM_AIMD_SLOW_FACTOR = config('LLM_AIMD_SLOW_FACTOR', default=2.0, cast=float)  # Slower than this x usual halves the limit; 0 disables
+LLM_ACQUIRE_TIMEOUT_SECONDS = config('LLM_ACQUIRE_TIMEOUT_SECONDS', default=0.5, cast=float)
+# Circuit breaker per provider endpoint: this many failures in a row stop calls for LLM_BREAKER_RESET_SECONDS
+LLM_BREAKER_FAILURES = config('LLM_BREAKER_FAILURES', default=5, cast=int)
+LLM_BREAKER_RESET_SECONDS = config('LLM_BREAKER_RESET_SECONDS', default=30, cast=float)
+LLM_EMBED_BATCH_SIZE = config('LLM_EMBED_BATCH_SIZE', default=100, cast=int)  # Texts per embedding request (Gemini max 100)
+LLM_PROVIDER_REFRESH_SECONDS = config('LLM_PROVIDER_REFRESH_SECONDS', default=60, cast=int)  # EmbeddingModel re-read interval
+# Hedged chat calls: with no first token by the deadline (the observed LLM_HEDGE_QUANTILE of time to
+# first token for the persona, once LLM_HEDGE_MIN_SAMPLES are in), a second request goes to the
+# 'chat_fallback' EmbeddingModel provider (or the same one) and the first complete answer wins
+LLM_HEDGE_ENABLED = config('LLM_HEDGE_ENABLED', default=True, cast=bool)
+LLM_HEDGE_QUANTILE = config('LLM_HEDGE_QUANTILE', default=0.95, cast=float)
+LLM_HEDGE_MIN_SAMPLES = config('LLM_HEDGE_MIN_SAMPLES', default=50, cast=int)
+LLM_HEDGE_DEFAULT_MS = config('LLM_HEDGE_DEFAULT_MS', default=2000, cast=float)  # Deadline until enough samples
+# Fixed per-persona deadlines overriding the observed quantile, e.g. "socratic_tutor=1500,strict_tutor=800"
+LLM_HEDGE_DEADLINES_MS = config('LLM_HEDGE_DEADLINES_MS', default='', cast=lambda value: _name_values(value, float))
+LLM_HEDGE_REFRESH_SECONDS = config('LLM_HEDGE_REFRESH_SECONDS', default=10, cast=float)  # Deadline recompute interval
+LLM_HEDGE_WORKERS = config('LLM_HEDGE_WORKERS', default=32, cast=int)  # Threads running chat requests
 
 VECTOR_DB_PATH = config('VECTOR_DB_PATH', default=os.path.join(BASE_DIR, 'vector_db'))
 
 # Vector Search
 FAISS_INDEX_PATH = os.path.join(VECTOR_DB_PATH, 'faiss_index')
+FAISS_SNAPSHOT_DIR = os.path.join(VECTOR_DB_PATH, 'snapshots')  # Versioned index snapshots + `current` link
+FAISS_SNAPSHOT_RETENTION = config('FAISS_SNAPSHOT_RETENTION', default=5, cast=int)  # Snapshots kept for rollback
+# Sharded index: >1 partitions chunks into independent shards searched scatter-gather
+FAISS_SHARD_COUNT = config('FAISS_SHARD_COUNT', default=1, cast=int)
+FAISS_SHARD_BY = config('FAISS_SHARD_BY', default='hash')  # 'hash' (textbook id) or 'subject'
+FAISS_SHARD_BACKEND = config('FAISS_SHARD_BACKEND', default='local')  # 'local' thread pool or 'celery' shard workers
+FAISS_SHARD_TIMEOUT = config('FAISS_SHARD_TIMEOUT', default=2.0, cast=float)  # Seconds to wait for a shard worker
+FAISS_SHARD_DIR = os.path.join(VECTOR_DB_PATH, 'shards')  # One snapshot store per shard
+# Index compression: 'flat' (exact), 'sq8', 'sqfp16' or 'pq'; quantized indexes re-rank on full-precision vectors
+FAISS_INDEX_TYPE = config('FAISS_INDEX_TYPE', default='flat')
+FAISS_PQ_M = config('FAISS_PQ_M', default=96, cast=int)  # PQ sub-quantizers (bytes per vector); must divide the dimension
+FAISS_RERANK_FACTOR = config('FAISS_RERANK_FACTOR', default=10, cast=int)  # Candidates fetched per result for exact re-ranking
+FAISS_TRAIN_MIN_VECTORS = config('FAISS_TRAIN_MIN_VECTORS', default=10000, cast=int)  # Stay flat below this many vectors
+FAISS_TRAIN_SAMPLE = config('FAISS_TRAIN_SAMPLE', default=100000, cast=int)  # Vectors sampled to train the codebook
+FAISS_PCA_DIM = config('FAISS_PCA_DIM', default=0, cast=int)  # >0 projects embeddings to this many dims with PCA (e.g. 256, 128)
 CHUNK_SIZE = config('CHUNK_SIZE', default=200, cast=int)  # Reduced from 500 to 200
 CHUNK_OVERLAP = config('CHUNK_OVERLAP', default=50, cast=int)  # Reduced from 100 to 50
 TOP_K_RESULTS = config('TOP_K_RESULTS', default=5, cast=int)
 
+# Seconds a generated embedding stays cached (keyed by model and text)
+EMBEDDING_CACHE_TIMEOUT = config('EMBEDDING_CACHE_TIMEOUT', default=60 * 60 * 24 * 7, cast=int)
+# Seconds a cached FAISS index copy (and corpus stats) may outlive its version; a process missing it reloads the snapshot
+RAG_INDEX_CACHE_TTL = config('RAG_INDEX_CACHE_TTL', default=60 * 60, cast=int)
+
+# Tutor personas with their own prompts (context/rag_pipeline.py) and first-token latency series; others share one
+TUTOR_PERSONAS = ['helpful_tutor', 'socratic_tutor', 'encouraging_tutor', 'strict_tutor']
+
+# RAG pipeline bootstrap
+RAG_EAGER_BOOTSTRAP = config('RAG_EAGER_BOOTSTRAP', default=False, cast=bool)  # Load index at process start
+RAG_INDEX_CHECK_INTERVAL = config('RAG_INDEX_CHECK_INTERVAL', default=5, cast=float)  # Seconds between index version checks
+
+# Two-stage retrieval: fetch RAG_RERANK_CANDIDATES from FAISS, re-rank, send the best top_k to the LLM
+RAG_RERANKER = config('RAG_RERANKER', default='features')  # 'features', 'cross_encoder' or 'none'
+RAG_RERANK_CANDIDATES = config('RAG_RERANK_CANDIDATES', default=20, cast=int)
+RAG_RERANK_WORKERS = config('RAG_RERANK_WORKERS', default=2, cast=int)  # Scoring thread pool size
+RAG_RERANK_TIMEOUT_MS = config('RAG_RERANK_TIMEOUT_MS', default=250, cast=int)  # Fall back to vector order after this
+RAG_RERANK_WEIGHTS = {'similarity': 0.6, 'bm25': 0.35, 'position': 0.05}  # Feature re-ranker blend
+RAG_CROSS_ENCODER_MODEL = config('RAG_CROSS_ENCODER_MODEL', default='cross-encoder/ms-marco-MiniLM-L-6-v2')
+
+# Maximal marginal relevance over the candidates' vectors, so overlapping chunks don't fill the prompt
+RAG_MMR_LAMBDA = config('RAG_MMR_LAMBDA', default=0.7, cast=float)  # 1.0 disables; lower favours diversity
+RAG_DUPLICATE_THRESHOLD = config('RAG_DUPLICATE_THRESHOLD', default=0.95, cast=float)  # Cosine at which a chunk counts as a repeat
+RAG_COLLAPSE_DUPLICATES = config('RAG_COLLAPSE_DUPLICATES', default=True, cast=bool)  # One hit per near-duplicate chunk group
+
+# Neighbour expansion: include chunk_index +/- n of each retrieved chunk (per request via "context_window")
+RAG_NEIGHBOR_WINDOW = config('RAG_NEIGHBOR_WINDOW', default=0, cast=int)
+RAG_NEIGHBOR_WINDOW_MAX = config('RAG_NEIGHBOR_WINDOW_MAX', default=3, cast=int)
+
+# SQL round trips one RAG query may take (query log and its chunk links); more is logged as a warning
+RAG_SQL_BUDGET = config('RAG_SQL_BUDGET', default=3, cast=int)
+
+# Per-stage latency histograms are kept in each process and their p50/p95/p99 written to SystemMetrics this often (0 disables)
+RAG_METRICS_FLUSH_INTERVAL = config('RAG_METRICS_FLUSH_INTERVAL', default=60, cast=int)
+
 # Webhook Configuration
 WEBHOOK_SECRET = config('WEBHOOK_SECRET', default='webhook-secret')
 WEBHOOK_ENDPOINTS = config('WEBHOOK_ENDPOINTS', default='').split(',')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Logging
+# Records are queued and written by a background thread (rag_tutor.tracing.QueueLogHandler).
+# Detailed per-request payloads (scores, chunk text) go to the 'rag_tutor.trace' logger for
+# sampled requests only; set RAG_TRACE_SAMPLE_RATE above 0 to collect them.
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+RAG_TRACE_SAMPLE_RATE = config('RAG_TRACE_SAMPLE_RATE', default=0.0, cast=float)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'handlers': {
-        'file': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
+        'queue': {
+            'level': 'DEBUG',
+            'class': 'rag_tutor.tracing.QueueLogHandler',
             'filename': 'rag_tutor.log',
-        },
-        'console': {
-            'level': 'INFO',
-            'class': 'logging.StreamHandler',
+            'fmt': '%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s',
         },
     },
     'loggers': {
         'django': {
-            'handlers': ['file', 'console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
         'rag_tutor': {
-            'handlers': ['file', 'console'],
-            'level': 'INFO',
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
             'propagate': True,
         },
+        'rag_tutor.trace': {
+            'level': 'DEBUG',
+        },
     },
     
 }
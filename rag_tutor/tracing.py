@@ -0,0 +1,129 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+trace_logger = logging.getLogger('rag_tutor.trace')
+
+# (trace id, sampled) of the request being handled in this context
+_current = contextvars.ContextVar('rag_tutor_trace', default=None)
+
+
+def start_trace(trace_id: Optional[str] = None, sampled: Optional[bool] = None) -> contextvars.Token:
+    """Begin a trace for the current request or task; pass the token to ``end_trace``.
+
+    Unless ``sampled`` is given, the trace is sampled with probability
+    ``RAG_TRACE_SAMPLE_RATE``. Only sampled traces emit ``trace()`` events.
+    """
+    if sampled is None:
+        from django.conf import settings
+        sampled = random.random() < settings.RAG_TRACE_SAMPLE_RATE
+    return _current.set((trace_id or uuid.uuid4().hex[:16], sampled))
+
+
+def end_trace(token: contextvars.Token):
+    _current.reset(token)
+
+
+def current_trace_id() -> str:
+    current = _current.get()
+    return current[0] if current else '-'
+
+
+def tracing() -> bool:
+    """True when detailed trace payloads should be built: a sampled trace with trace logging enabled.
+
+    Check it before assembling an expensive payload::
+
+        if tracing():
+            trace('faiss.search', scores=scores.tolist())
+    """
+    current = _current.get()
+    return bool(current and current[1]) and trace_logger.isEnabledFor(logging.DEBUG)
+
+
+def trace(event: str, **fields):
+    """Log a structured trace event (JSON fields) if the current trace is sampled"""
+    if tracing():
+        trace_logger.debug(f"{event} {json.dumps(fields, default=str)}")
+
+
+class TraceMiddleware:
+    """Gives every request a trace id, taken from ``X-Trace-Id`` or generated, and echoes it back"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = start_trace(request.headers.get('X-Trace-Id', '')[:64] or None)
+        try:
+            response = self.get_response(request)
+            response['X-Trace-Id'] = current_trace_id()
+            return response
+        finally:
+            end_trace(token)
+
+
+class TraceIdFilter(logging.Filter):
+    """Stamps each record with the trace id of the context that logged it"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id()
+        return True
+
+
+class QueueLogHandler(QueueHandler):
+    """Non-blocking handler: records are queued and written by a background listener thread.
+
+    The calling thread only stamps the trace id and formats the message;
+    file and console I/O happen on the listener. The queue is bounded and
+    records are dropped (and counted) when it is full rather than stalling
+    a request. The listener is started per process on first use, so it
+    survives gunicorn's pre-fork app loading.
+    """
+
+    def __init__(self, filename: Optional[str] = None, console: bool = True,
+                 fmt: str = '%(message)s', maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.addFilter(TraceIdFilter())
+        formatter = logging.Formatter(fmt)
+        self.targets = []
+        if filename:
+            self.targets.append(logging.FileHandler(filename))
+        if console:
+            self.targets.append(logging.StreamHandler(sys.stderr))
+        for target in self.targets:
+            target.setFormatter(formatter)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener = None
+        self.pid = None
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_listener(self):
+        # A queue or listener inherited across fork has no thread behind it
+        self.queue = queue.Queue(self.maxsize)
+        self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def close(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        for target in self.targets:
+            target.close()
+        super().close()
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rag_tutor.settings')
 
 application = get_wsgi_application()
+
+# Load the RAG pipeline before the first request when eager bootstrap is enabled.
+# With gunicorn's preload_app the index is loaded once and shared by the workers.
+from django.conf import settings
+
+if settings.RAG_EAGER_BOOTSTRAP:
+    from context.bootstrap import pipeline_bootstrap
+    pipeline_bootstrap.warm()